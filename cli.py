@@ -53,7 +53,26 @@ def verbose_check_call(*popen_args, **extra_env):
     )
 
 
+def get_entry_point() -> Path | None:
+    """
+    Returns the installed CLI of the virtualenv, if it's newer than the project dependency files.
+    Calling it directly avoids the "uv run" dependency check on every call, that is slow on small devices.
+    """
+    entry_point = Path(VIRTUAL_ENV) / 'bin' / 'victron-ble2mqtt'
+    try:
+        installed = entry_point.stat().st_mtime
+    except FileNotFoundError:
+        return None
+    for file_name in ('pyproject.toml', 'uv.lock'):
+        if (BASE_PATH / file_name).stat().st_mtime > installed:
+            return None
+    return entry_point
+
+
 def main(argv):
+    if entry_point := get_entry_point():
+        os.execv(entry_point, [entry_point, *argv[1:]])
+
     uv_bin = shutil.which('uv')  # Ensure 'uv' is available in PATH
     if not uv_bin:
         print_uv_error_and_exit()
@@ -69,6 +88,11 @@ def main(argv):
     except KeyboardInterrupt:
         print('Bye!')
         sys.exit(130)
+    else:
+        # The dependencies are in sync now: Use the fast path next time
+        entry_point = Path(VIRTUAL_ENV) / 'bin' / 'victron-ble2mqtt'
+        if entry_point.exists():
+            entry_point.touch()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,81 @@
+"""
+    Aggregate sensor values over a time window, see: "aggregation_window_seconds" setting.
+
+    Instead of dropping the frames between two publishes, every value is added to the window
+    and the statistics are published once at the end of the window. So peaks are not lost.
+"""
+
+from victron_ble2mqtt.change_detection import is_number
+
+
+# The published statistics of numeric measurements: name -> sensor name suffix
+STATISTICS = {
+    'mean': 'Mean',
+    'min': 'Min',
+    'max': 'Max',
+}
+
+
+class WindowStats:
+    """
+    Streaming statistics of one sensor value, with constant memory.
+    Non-numeric values (e.g.: "charge_state") are only stored as last value.
+
+    >>> stats = WindowStats()
+    >>> for value in (10, 30.5, 2, 5):
+    ...     stats.add(value)
+    >>> stats
+    <WindowStats count=4 last=5 mean=11.875 min=2 max=30.5>
+    >>> stats.get_statistics()
+    {'mean': 11.875, 'min': 2, 'max': 30.5}
+
+    >>> stats.reset()
+    >>> stats.add('bulk')
+    >>> stats
+    <WindowStats count=0 last='bulk'>
+    >>> stats.get_statistics()
+    {}
+    """
+
+    __slots__ = ('count', 'last', 'maximum', 'minimum', 'total')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.count = 0  # Number of numeric values
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.last = None
+
+    def add(self, value) -> None:
+        self.last = value
+        if not is_number(value):
+            return
+
+        if self.count == 0:
+            self.minimum = self.maximum = value
+        elif value < self.minimum:
+            self.minimum = value
+        elif value > self.maximum:
+            self.maximum = value
+        self.count += 1
+        self.total += value
+
+    @property
+    def mean(self) -> float | None:
+        if self.count:
+            return self.total / self.count
+        return None
+
+    def get_statistics(self) -> dict:
+        if not self.count:
+            return {}
+        return {'mean': self.mean, 'min': self.minimum, 'max': self.maximum}
+
+    def __repr__(self):
+        info = f'count={self.count} last={self.last!r}'
+        if self.count:
+            info += f' mean={self.mean} min={self.minimum} max={self.maximum}'
+        return f'<{self.__class__.__name__} {info}>'
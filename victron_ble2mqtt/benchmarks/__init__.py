@@ -0,0 +1,17 @@
+"""
+    Micro benchmarks of the hot path: BLE advertisement -> decrypt -> dict -> MQTT
+    Run them via: ./dev-cli.py benchmark
+"""
+
+import timeit
+from collections.abc import Callable
+
+
+def measure(func: Callable, *, repeat: int = 3) -> float:
+    """
+    Returns the best time per call of `func` in microseconds.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1_000_000
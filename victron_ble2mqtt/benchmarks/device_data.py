@@ -0,0 +1,118 @@
+import inspect
+import struct
+from collections.abc import Iterator
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+from victron_ble import devices
+from victron_ble.devices import MODEL_PARSER_OVERRIDE, Device, DeviceData, detect_device_type
+
+from victron_ble2mqtt.victron_ble_utils import get_extractor
+
+
+def iter_device_classes() -> Iterator[type[Device]]:
+    """
+    All device classes from victron_ble, sorted by name.
+
+    >>> [DeviceClass.__name__ for DeviceClass in iter_device_classes()][:3]
+    ['AcCharger', 'BatteryMonitor', 'BatterySense']
+    """
+    device_classes = set()
+    for name in devices.__all__:
+        candidate = getattr(devices, name, None)
+        if inspect.isclass(candidate) and issubclass(candidate, Device) and candidate is not Device:
+            device_classes.add(candidate)
+    yield from sorted(device_classes, key=lambda DeviceClass: DeviceClass.__name__)
+
+
+def iter_candidates(size: int = 16) -> Iterator[bytes]:
+    """
+    All zero bytes first and then all variants with one changed byte.
+    """
+    yield bytes(size)
+    for position in range(size):
+        for value in range(1, 256):
+            candidate = bytearray(size)
+            candidate[position] = value
+            yield bytes(candidate)
+
+
+def get_decrypted_sample(DeviceClass: type[Device]) -> bytes:
+    """
+    Returns a decrypted payload, that can be parsed by the given device class
+    and all "get_*" methods of the resulting DeviceData work.
+
+    >>> from victron_ble.devices import BatteryMonitor, BatterySense
+    >>> get_decrypted_sample(BatteryMonitor).hex()
+    '00000000000000000000000000000000'
+    >>> get_decrypted_sample(BatterySense).hex()  # Needs aux mode "temperature"
+    '00000000000000000200000000000000'
+    """
+    victron_device = DeviceClass('00' * 16)
+    for decrypted in iter_candidates():
+        try:
+            parsed = victron_device.parse_decrypted(decrypted)
+            get_extractor(victron_device.data_type)(victron_device.data_type(0, parsed))
+        except (ValueError, KeyError):  # e.g.: invalid Enum value or missing optional value
+            continue
+        return decrypted
+    raise ValueError(f'No valid sample data found for {DeviceClass.__name__}')
+
+
+def get_device_data(DeviceClass: type[Device], *, model_id: int = 0xA389) -> DeviceData:
+    victron_device = DeviceClass('00' * 16)
+    parsed = victron_device.parse_decrypted(get_decrypted_sample(DeviceClass))
+    return victron_device.data_type(model_id, parsed)
+
+
+DEFAULT_MODEL_ID = 0xA389  # Just a valid model id: "SmartShunt 500A/50mV"
+
+
+def get_frame_header(DeviceClass: type[Device]) -> tuple[int, int]:
+    """
+    Returns the (model id, readout type) that detect_device_type() maps to the given device class.
+
+    >>> from victron_ble.devices import BatterySense, SolarCharger
+    >>> get_frame_header(SolarCharger)
+    (41865, 1)
+    >>> get_frame_header(BatterySense)
+    (41892, 2)
+    """
+    for model_id, OverrideClass in MODEL_PARSER_OVERRIDE.items():
+        if OverrideClass is DeviceClass:
+            return model_id, detect_readout_type(DeviceClass.__mro__[1])
+
+    return DEFAULT_MODEL_ID, detect_readout_type(DeviceClass)
+
+
+def detect_readout_type(DeviceClass: type[Device]) -> int:
+    for readout_type in range(256):
+        header = b'\x10\x00' + struct.pack('<HB', DEFAULT_MODEL_ID, readout_type)
+        if detect_device_type(header) is DeviceClass:
+            return readout_type
+    raise ValueError(f'No readout type found for {DeviceClass.__name__}')
+
+
+def encrypt_frame(DeviceClass: type[Device], *, key: str, decrypted: bytes | None = None, iv: int = 0) -> bytes:
+    """
+    Build a encrypted "instant readout" advertisement, like a real Victron device would send it.
+
+    >>> from victron_ble.devices import BatteryMonitor
+    >>> key = '0123456789abcdef0123456789abcdef'
+    >>> frame = encrypt_frame(BatteryMonitor, key=key, iv=1)
+    >>> frame.hex()
+    '100089a3020100010694267ba398480c6b2b9f649be476cb'
+    >>> BatteryMonitor(key).parse(frame).get_model_name()
+    'SmartShunt 500A/50mV'
+    """
+    if decrypted is None:
+        decrypted = get_decrypted_sample(DeviceClass)
+
+    model_id, readout_type = get_frame_header(DeviceClass)
+    advertisement_key = bytes.fromhex(key)
+    ctr = Counter.new(128, initial_value=iv, little_endian=True)
+    cipher = AES.new(advertisement_key, AES.MODE_CTR, counter=ctr)
+    encrypted = cipher.encrypt(decrypted)
+
+    header = b'\x10\x00' + struct.pack('<HBH', model_id, readout_type, iv)
+    return header + advertisement_key[:1] + encrypted
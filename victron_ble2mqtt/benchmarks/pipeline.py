@@ -0,0 +1,254 @@
+import json
+import platform
+import socket
+import tracemalloc
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from bleak import BLEDevice
+from ha_services.mqtt4homeassistant.data_classes import MqttSettings
+from ha_services.mqtt4homeassistant.device import BaseMqttDevice, MainMqttDevice
+from victron_ble.devices import Device, detect_device_type
+
+import victron_ble2mqtt
+from victron_ble2mqtt.benchmarks import measure
+from victron_ble2mqtt.benchmarks.device_data import encrypt_frame, iter_device_classes
+from victron_ble2mqtt.mqtt import BaseHandler, VictronMqttDeviceHandler, get_handler
+from victron_ble2mqtt.replay import CountingMqttClient
+from victron_ble2mqtt.user_settings import ChangeDetectionSettings, UserSettings
+from victron_ble2mqtt.victron_ble_utils import GenericDevice, values2dict
+
+
+BENCHMARK_KEY = '0123456789abcdef0123456789abcdef'
+
+# All stages of the hot path, in the order they are called:
+STAGES = (
+    'detect_device_type',  # Find the device class from the frame header
+    'parse',  # Device.parse(): Decrypt and unpack the payload
+    'values2dict',  # DeviceData -> dict
+    'handler_publish',  # BaseHandler.publish() (or the subclass) of one frame, with all sensors (without main device)
+    'sensor_publish',  # Sensor.set_state() + Sensor.publish(): Validate and serialize one state (mean of all sensors)
+    'handler_setup',  # BaseHandler.setup() + remove(): Create (and unregister) all sensors of one new device
+)
+
+MEMORY_DEVICES = 60  # Number of devices of the same model, to measure the memory per device
+MEMORY_RESULT = 'memory_bytes'  # Key of the handler memory per device in the stored results
+
+
+class FakeClock:
+    """
+    Replaces time.monotonic() of ha_services components, so that the state throttling
+    can be controlled by the benchmark: Just like a device that sends new data every `step` seconds.
+    """
+
+    def __init__(self, *, step: float = 1.5):
+        self.now = 1000.0
+        self.step = step
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def tick(self) -> None:
+        self.now += self.step
+
+
+def get_address(number: int) -> str:
+    """
+    >>> get_address(1)
+    '00:00:00:00:BE:01'
+    """
+    return f'00:00:00:00:BE:{number:02X}'
+
+
+def tick_and_call(clock: FakeClock, func, **kwargs) -> None:
+    clock.tick()
+    func(**kwargs)
+
+
+def publish_all_sensors(clock: FakeClock, handler: BaseHandler, data_dict: dict) -> None:
+    clock.tick()
+    client = handler.mqtt_client
+    for key, sensor in handler.sensors.items():
+        if (value := data_dict.get(key)) is not None:
+            sensor.set_state(value)
+            sensor.publish(client)
+
+
+def setup_and_remove(handler: BaseHandler, data_dict: dict) -> None:
+    handler.setup(data_dict=data_dict)
+    handler.remove()
+
+
+def measure_handler_memory(
+    victron_device: Device,
+    *,
+    data_dict: dict,
+    main_mqtt_device: MainMqttDevice,
+    user_settings: UserSettings,
+    count: int = MEMORY_DEVICES,
+) -> int:
+    """
+    Returns the allocated bytes per device, if `count` devices of the same model are set up.
+    """
+    HandlerClass = get_handler(victron_device=victron_device)
+    mqtt_client = CountingMqttClient()
+    handlers = []
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for number in range(count):
+            ble_device = BLEDevice(address=f'00:00:00:00:EF:{number:02X}', name='Memory', details={})
+            handler = HandlerClass(
+                ble_device=ble_device,
+                main_mqtt_device=main_mqtt_device,
+                victron_device=victron_device,
+                mqtt_client=mqtt_client,
+                user_settings=user_settings,
+            )
+            handler.setup(data_dict=data_dict)
+            handlers.append(handler)
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    for handler in handlers:
+        handler.remove()
+    return allocated // count
+
+
+def benchmark_device_class(
+    DeviceClass: type[Device],
+    *,
+    number: int,
+    victron_mqtt_handler: VictronMqttDeviceHandler,
+    clock: FakeClock,
+) -> dict:
+    """
+    Returns the time per call in microseconds for every stage of one device class.
+    """
+    raw_data = encrypt_frame(DeviceClass, key=BENCHMARK_KEY)
+    assert detect_device_type(raw_data) is DeviceClass, DeviceClass
+
+    victron_device = DeviceClass(BENCHMARK_KEY)
+    device_data = victron_device.parse(raw_data)
+    data_dict = values2dict(device_data)
+
+    mqtt_client = CountingMqttClient()
+    ble_device = BLEDevice(address=get_address(number), name=DeviceClass.__name__, details={})
+    victron_mqtt_handler.publish(
+        ble_device=ble_device,
+        raw_data=raw_data,
+        generic_device=GenericDevice(victron_device, ble_device=ble_device),
+        rssi=-70,
+        mqtt_client=mqtt_client,
+    )
+    handler = victron_mqtt_handler.handler_map[ble_device.address]
+    sensor_count = sum(1 for key in handler.sensors if data_dict.get(key) is not None) or 1
+
+    results = {
+        'detect_device_type': measure(partial(detect_device_type, raw_data)),
+        'parse': measure(partial(victron_device.parse, raw_data)),
+        'values2dict': measure(partial(values2dict, device_data)),
+        'handler_publish': measure(
+            partial(tick_and_call, clock, handler.publish, data_dict=data_dict, rssi=-70),
+        ),
+        'sensor_publish': measure(partial(publish_all_sensors, clock, handler, data_dict)) / sensor_count,
+    }
+    handler.remove()
+    results['handler_setup'] = measure(partial(setup_and_remove, handler, data_dict))
+    return results
+
+
+def benchmark_handler_memory(*, count: int = MEMORY_DEVICES) -> dict:
+    """
+    Returns {device class name: allocated bytes per device} of the handler setup.
+    """
+    user_settings = UserSettings(mqtt=MqttSettings(main_uid='benchmark'))
+    components_backup = dict(BaseMqttDevice.components)
+    try:
+        victron_mqtt_handler = VictronMqttDeviceHandler(user_settings=user_settings)
+        results = {}
+        for DeviceClass in iter_device_classes():
+            raw_data = encrypt_frame(DeviceClass, key=BENCHMARK_KEY)
+            victron_device = DeviceClass(BENCHMARK_KEY)
+            results[DeviceClass.__name__] = measure_handler_memory(
+                victron_device,
+                data_dict=values2dict(victron_device.parse(raw_data)),
+                main_mqtt_device=victron_mqtt_handler.main_mqtt_device,
+                user_settings=user_settings,
+                count=count,
+            )
+    finally:
+        BaseMqttDevice.components.clear()
+        BaseMqttDevice.components.update(components_backup)
+    return results
+
+
+def benchmark_pipeline() -> dict:
+    """
+    Time every stage of the hot path for all victron_ble device classes.
+    Returns {device class name: {stage: µs per call}}
+
+    Note: The change detection is disabled, so the worst case "all values changed" will be measured.
+    The system sensors of the main device (psutil polling, throttled to one update per second
+    for all devices together) are not part of the measurement.
+    """
+    user_settings = UserSettings(
+        mqtt=MqttSettings(main_uid='benchmark'),
+        change_detection=ChangeDetectionSettings(enabled=False),
+    )
+    clock = FakeClock()
+
+    components_backup = dict(BaseMqttDevice.components)
+    try:
+        with patch('ha_services.mqtt4homeassistant.components.time', SimpleNamespace(monotonic=clock.monotonic)):
+            victron_mqtt_handler = VictronMqttDeviceHandler(user_settings=user_settings)
+            victron_mqtt_handler.main_mqtt_device.poll_and_publish = lambda client: None
+            results = {}
+            for number, DeviceClass in enumerate(iter_device_classes()):
+                results[DeviceClass.__name__] = benchmark_device_class(
+                    DeviceClass,
+                    number=number,
+                    victron_mqtt_handler=victron_mqtt_handler,
+                    clock=clock,
+                )
+    finally:
+        BaseMqttDevice.components.clear()
+        BaseMqttDevice.components.update(components_backup)
+    return results
+
+
+def add_memory_results(results: dict, memory: dict) -> dict:
+    """
+    Store the handler memory per device next to the stage timings of the device class.
+
+    >>> add_memory_results({'Foo': {'parse': 1.5}}, {'Foo': 4096})
+    {'Foo': {'parse': 1.5, 'memory_bytes': 4096}}
+    """
+    for name, allocated in memory.items():
+        results[name][MEMORY_RESULT] = allocated
+    return results
+
+
+def get_environment_info() -> dict:
+    return {
+        'victron_ble2mqtt': victron_ble2mqtt.__version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'hostname': socket.gethostname(),
+    }
+
+
+def save_results(path: Path, results: dict, *, unit: str = f'µs per call, {MEMORY_RESULT}: bytes per device') -> None:
+    data = {
+        'environment': get_environment_info(),
+        'unit': unit,
+        'results': results,
+    }
+    path.write_text(json.dumps(data, indent=2, ensure_ascii=False, sort_keys=True))
+
+
+def load_results(path: Path) -> dict:
+    return json.loads(path.read_text())['results']
@@ -0,0 +1,67 @@
+"""
+    Startup benchmark: Time from the interpreter start until the first BLE advertisement is processed.
+    Every stage runs in a fresh Python process, so nothing is cached in sys.modules.
+    Run them via: ./dev-cli.py startup-benchmark
+
+    Only the standard library is imported here: The startup time of the measurement itself doesn't count.
+"""
+
+import subprocess
+import sys
+import time
+
+
+# Stage name -> Python code to run in a fresh interpreter:
+STARTUP_STAGES = {
+    'python': 'pass',  # Just the interpreter start, as reference
+    'cli_import': 'import victron_ble2mqtt.cli_app',  # Register all commands, e.g.: for "--help"
+    'first_callback': 'import victron_ble2mqtt.benchmarks.startup as s; s.run_until_first_callback()',
+}
+
+BENCHMARK_KEY = '0123456789abcdef0123456789abcdef'
+BENCHMARK_FRAME = '100089a3020100010694267ba398480c6b2b9f649be476cb'  # BatteryMonitor frame, encrypted with the key
+
+
+def run_until_first_callback() -> None:
+    """
+    Do the same as "publish-loop" until the first BLE callback is processed, but without Bluetooth and MQTT broker.
+    """
+    from bleak import AdvertisementData, BleakScanner, BLEDevice  # noqa: F401 - Import like "publish-loop"
+    from ha_services.mqtt4homeassistant.data_classes import MqttSettings
+
+    import victron_ble2mqtt.cli_app.mqtt  # noqa: F401 - The CLI imports all commands
+    from victron_ble2mqtt.cli_app.settings import get_settings  # noqa: F401
+    from victron_ble2mqtt.publisher import MqttPublisher
+    from victron_ble2mqtt.replay import CountingMqttClient
+    from victron_ble2mqtt.user_settings import UserSettings
+
+    user_settings = UserSettings(mqtt=MqttSettings(main_uid='startup_benchmark'))
+    publisher = MqttPublisher(keys=[BENCHMARK_KEY], user_settings=user_settings, mqtt_client=CountingMqttClient())
+    advertisement = AdvertisementData(
+        local_name=None,
+        manufacturer_data={0x02E1: bytes.fromhex(BENCHMARK_FRAME)},
+        service_data={},
+        service_uuids=[],
+        tx_power=None,
+        rssi=-60,
+        platform_data=(),
+    )
+    device = BLEDevice(address='00:00:00:00:BE:01', name='Benchmark', details={})
+    publisher.detection_callback(device, advertisement)
+    assert publisher.process_durations.count == 1, 'Advertisement not processed'
+
+
+def measure_startup(code: str, *, repeat: int = 5) -> float:
+    """
+    Returns the best wall time in milliseconds to run `code` in a fresh Python interpreter.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, capture_output=True)
+        durations.append(time.perf_counter() - start)
+    return min(durations) * 1000
+
+
+def benchmark_startup(*, repeat: int = 5) -> dict:
+    return {stage: measure_startup(code, repeat=repeat) for stage, code in STARTUP_STAGES.items()}
@@ -0,0 +1,44 @@
+import inspect
+from enum import Enum
+from functools import partial
+
+from victron_ble.devices import DeviceData
+
+from victron_ble2mqtt.benchmarks import measure
+from victron_ble2mqtt.benchmarks.device_data import get_device_data, iter_device_classes
+from victron_ble2mqtt.victron_ble_utils import get_extractor
+
+
+def reflection_values2dict(obj: DeviceData) -> dict:
+    """
+    The old values2dict() implementation: Used as reference for the benchmark.
+    """
+    data = {}
+    for name, method in inspect.getmembers(obj, predicate=inspect.ismethod):
+        if name.startswith('get_'):
+            value = method()
+            if isinstance(value, Enum):
+                value = value.name.lower()
+            if value is not None:
+                data[name[4:]] = value
+    return data
+
+
+def benchmark_values2dict() -> dict:
+    """
+    Compare the reflection based values2dict() with the cached DataExtractor for every victron_ble device class.
+    Returns the time per call in microseconds.
+    """
+    results = {}
+    for DeviceClass in iter_device_classes():
+        device_data = get_device_data(DeviceClass)
+        extractor = get_extractor(type(device_data))
+
+        # Both must return the same data:
+        assert extractor(device_data) == reflection_values2dict(device_data), DeviceClass
+
+        results[DeviceClass.__name__] = {
+            'reflection': measure(partial(reflection_values2dict, device_data)),
+            'extractor': measure(partial(extractor, device_data)),
+        }
+    return results
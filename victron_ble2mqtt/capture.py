@@ -0,0 +1,368 @@
+"""
+Compact, append-only binary capture of raw BLE advertisements.
+
+A capture session is stored in one or more files, rotated by size:
+
+    <stem>-0000.vblecap, <stem>-0001.vblecap, ...
+
+Every capture file starts with a header (magic, format version, wall clock time of the session start)
+followed by the records. Every record starts with a fixed size struct, followed by the local name
+and the manufacturer data. The timestamp of a record is the monotonic time in seconds since the
+session start, so all files of one session share the same time base.
+
+A sidecar index file (<capture file>.idx) stores (timestamp, file offset) pairs for every
+`index_interval` records. This allows reading time-range slices without reading the whole file.
+
+Files of several sessions can be read together: The timestamps are rebased to the start of the
+first session (via the wall clock time in the headers) and the records are merged by time.
+"""
+
+import bisect
+import dataclasses
+import heapq
+import logging
+import struct
+import time
+from collections.abc import Iterable, Iterator
+from operator import attrgetter
+from pathlib import Path
+
+from bleak import AdvertisementData, BLEDevice
+
+
+logger = logging.getLogger(__name__)
+
+FILE_SUFFIX = '.vblecap'
+INDEX_SUFFIX = '.idx'
+
+MAGIC = b'VBLECAP'
+FORMAT_VERSION = 1
+FILE_HEADER = struct.Struct('<7sBd')  # magic, version, session start as Unix timestamp
+
+# timestamp, MAC, RSSI, flags, company id, length of the local name, length of the manufacturer data:
+RECORD_HEADER = struct.Struct('<d6sbBHBH')
+
+INDEX_ENTRY = struct.Struct('<dQ')  # timestamp, file offset of the record
+
+VICTRON_COMPANY_ID = 0x02E1
+
+# Advertisement flags of a record:
+FLAG_INSTANT_READOUT = 0x01  # Victron "instant readout" advertisement (data starts with 0x10)
+FLAG_LOCAL_NAME = 0x02  # The name was send in this advertisement (otherwise it's the cached device name)
+
+
+def mac2bytes(address: str) -> bytes:
+    """
+    >>> mac2bytes('AA:BB:CC:DD:EE:FF')
+    b'\\xaa\\xbb\\xcc\\xdd\\xee\\xff'
+    >>> mac2bytes('Not a MAC address')
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid MAC address: 'Not a MAC address'
+    """
+    try:
+        mac = bytes.fromhex(address.replace(':', ''))
+    except ValueError:
+        mac = b''
+    if len(mac) != 6:
+        raise ValueError(f'Invalid MAC address: {address!r}')
+    return mac
+
+
+def bytes2mac(mac: bytes) -> str:
+    """
+    >>> bytes2mac(b'\\xaa\\xbb\\xcc\\xdd\\xee\\xff')
+    'AA:BB:CC:DD:EE:FF'
+    """
+    return ':'.join(f'{byte:02X}' for byte in mac)
+
+
+def encode_name(name: str | None) -> bytes:
+    """
+    UTF-8 encoded name, truncated to 255 bytes without splitting a character.
+    >>> encode_name('Solar ☀')
+    b'Solar \\xe2\\x98\\x80'
+    >>> len(encode_name('x' * 254 + '☀'))
+    254
+    >>> encode_name(None)
+    b''
+    """
+    return (name or '').encode('utf-8')[:255].decode('utf-8', errors='ignore').encode('utf-8')
+
+
+def get_flags(advertisement: AdvertisementData, data: bytes) -> int:
+    flags = 0
+    if data.startswith(b'\x10'):
+        flags |= FLAG_INSTANT_READOUT
+    if advertisement.local_name:
+        flags |= FLAG_LOCAL_NAME
+    return flags
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class CaptureRecord:
+    timestamp: float  # Seconds since session start
+    address: str
+    rssi: int
+    flags: int
+    company_id: int
+    name: str | None
+    data: bytes
+
+    def pack(self) -> bytes:
+        name = encode_name(self.name)
+        return (
+            RECORD_HEADER.pack(
+                self.timestamp,
+                mac2bytes(self.address),
+                max(-128, min(127, self.rssi)),
+                self.flags,
+                self.company_id,
+                len(name),
+                len(self.data),
+            )
+            + name
+            + self.data
+        )
+
+
+def get_capture_path(*, directory: Path, stem: str, number: int) -> Path:
+    """
+    >>> get_capture_path(directory=Path('/tmp'), stem='garage', number=1)
+    PosixPath('/tmp/garage-0001.vblecap')
+    """
+    return directory / f'{stem}-{number:04d}{FILE_SUFFIX}'
+
+
+def get_index_path(capture_path: Path) -> Path:
+    return capture_path.with_name(capture_path.name + INDEX_SUFFIX)
+
+
+class CaptureWriter:
+    """
+    Write advertisements into capture files. Use as context manager, to flush all buffers at the end.
+    """
+
+    def __init__(
+        self,
+        *,
+        directory: Path,
+        stem: str = 'capture',
+        max_file_size: int = 100 * 1024 * 1024,
+        buffer_size: int = 64 * 1024,
+        index_interval: int = 1000,
+    ):
+        self.directory = directory
+        self.stem = stem
+        self.max_file_size = max_file_size
+        self.buffer_size = buffer_size
+        self.index_interval = index_interval
+
+        self.start_wall_time = time.time()
+        self.start_monotonic = time.monotonic()
+
+        self.file_number = -1
+        self.file_path = None
+        self.file = None
+        self.index_file = None
+        self.file_size = 0
+        self.file_records = 0
+
+        self.records = 0
+        self.skipped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open_next_file(self) -> None:
+        self.close()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        while True:
+            self.file_number += 1
+            self.file_path = get_capture_path(directory=self.directory, stem=self.stem, number=self.file_number)
+            if not self.file_path.exists():  # Never overwrite old captures
+                break
+
+        logger.info('Write capture to %s', self.file_path)
+        self.file = self.file_path.open('wb', buffering=self.buffer_size)
+        self.index_file = get_index_path(self.file_path).open('wb', buffering=self.buffer_size)
+
+        header = FILE_HEADER.pack(MAGIC, FORMAT_VERSION, self.start_wall_time)
+        self.file.write(header)
+        self.file_size = len(header)
+        self.file_records = 0
+
+    def write_record(self, record: CaptureRecord) -> None:
+        packed = record.pack()
+        if self.file is None or (self.file_records and self.file_size + len(packed) > self.max_file_size):
+            self.open_next_file()
+
+        if self.file_records % self.index_interval == 0:
+            self.index_file.write(INDEX_ENTRY.pack(record.timestamp, self.file_size))
+
+        self.file.write(packed)
+        self.file_size += len(packed)
+        self.file_records += 1
+        self.records += 1
+
+    def write_advertisement(self, device: BLEDevice, advertisement: AdvertisementData) -> None:
+        timestamp = time.monotonic() - self.start_monotonic
+        for company_id, data in advertisement.manufacturer_data.items():
+            record = CaptureRecord(
+                timestamp=timestamp,
+                address=device.address,
+                rssi=advertisement.rssi,
+                flags=get_flags(advertisement, data),
+                company_id=company_id,
+                name=advertisement.local_name or device.name,
+                data=data,
+            )
+            try:
+                self.write_record(record)
+            except (ValueError, struct.error) as err:  # e.g.: No MAC address on macOS or too much data
+                self.skipped += 1
+                logger.debug('Skip advertisement from %s: %s', device.address, err)
+
+    def flush(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+            self.index_file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.index_file.close()
+            self.file = self.index_file = None
+
+    def get_stats(self) -> dict:
+        return {
+            'records': self.records,
+            'skipped': self.skipped,
+            'files': self.file_number + 1,
+            'file_size': self.file_size,
+        }
+
+
+class CaptureReader:
+    """
+    Read the records of one capture file, optional only a time-range slice.
+    Only the (small) index is loaded into memory, the records are read as stream.
+    """
+
+    def __init__(self, file_path: Path):
+        self.file_path = file_path
+        with file_path.open('rb') as file:
+            header = file.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size:
+            raise ValueError(f'No capture file: {file_path}')
+        magic, version, self.start_wall_time = FILE_HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f'No capture file: {file_path}')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported capture format version {version}: {file_path}')
+
+        self.index_timestamps = []
+        self.index_offsets = []
+        index_path = get_index_path(file_path)
+        if index_path.exists():
+            index_data = index_path.read_bytes()
+            usable_size = len(index_data) - len(index_data) % INDEX_ENTRY.size
+            for timestamp, offset in INDEX_ENTRY.iter_unpack(index_data[:usable_size]):
+                self.index_timestamps.append(timestamp)
+                self.index_offsets.append(offset)
+
+    def get_start_offset(self, start: float | None) -> int:
+        """
+        Returns the file offset of the last indexed record before the `start` timestamp.
+        """
+        if start is not None and self.index_timestamps:
+            position = bisect.bisect_right(self.index_timestamps, start) - 1
+            if position >= 0:
+                return self.index_offsets[position]
+        return FILE_HEADER.size
+
+    def iter_records(self, *, start: float | None = None, end: float | None = None) -> Iterator[CaptureRecord]:
+        """
+        Yields all records with `start <= timestamp <= end` (Seconds since the session start)
+        """
+        with self.file_path.open('rb') as file:
+            file.seek(self.get_start_offset(start))
+            while True:
+                header = file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break  # End of file or incomplete record, e.g.: recording was killed
+                timestamp, mac, rssi, flags, company_id, name_length, data_length = RECORD_HEADER.unpack(header)
+                payload = file.read(name_length + data_length)
+                if len(payload) < name_length + data_length:
+                    break
+
+                if end is not None and timestamp > end:
+                    break
+                if start is not None and timestamp < start:
+                    continue
+
+                yield CaptureRecord(
+                    timestamp=timestamp,
+                    address=bytes2mac(mac),
+                    rssi=rssi,
+                    flags=flags,
+                    company_id=company_id,
+                    name=payload[:name_length].decode('utf-8', errors='replace') or None,
+                    data=payload[name_length:],
+                )
+
+
+def get_capture_files(path: Path) -> list[Path]:
+    """
+    Returns all capture files, sorted by the file name (the files of a session by the file number).
+    `path` can be one capture file or a directory.
+    """
+    if path.is_dir():
+        return sorted(path.glob(f'*{FILE_SUFFIX}'))
+    return [path]
+
+
+def iter_session(
+    readers: list[CaptureReader], *, offset: float, start: float | None, end: float | None
+) -> Iterator[CaptureRecord]:
+    """
+    Yields the records of all files of one session. `offset` is added to the timestamps.
+    """
+    if offset:
+        start = None if start is None else start - offset
+        end = None if end is None else end - offset
+    for reader in readers:
+        for record in reader.iter_records(start=start, end=end):
+            if offset:
+                record = dataclasses.replace(record, timestamp=record.timestamp + offset)
+            yield record
+
+
+def iter_capture(
+    paths: Iterable[Path], *, start: float | None = None, end: float | None = None
+) -> Iterator[CaptureRecord]:
+    """
+    Yields the records of all given capture files, sorted by time.
+    The timestamps (and `start`/`end`) are seconds since the start of the first session.
+    """
+    sessions = {}  # Session start as Unix timestamp -> readers of the session files
+    for path in sorted(paths):
+        reader = CaptureReader(path)
+        sessions.setdefault(reader.start_wall_time, []).append(reader)
+    if not sessions:
+        return
+
+    first_start = min(sessions)
+    if len(sessions) > 1:
+        logger.info('Merge %i capture sessions', len(sessions))
+    yield from heapq.merge(
+        *(
+            iter_session(readers, offset=session_start - first_start, start=start, end=end)
+            for session_start, readers in sessions.items()
+        ),
+        key=attrgetter('timestamp'),
+    )
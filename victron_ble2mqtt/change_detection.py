@@ -0,0 +1,89 @@
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+NOT_PUBLISHED = object()
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class ChangeFilter:
+    """
+    Decide if a new sensor value should be published:
+
+     * Numbers are compared with the given precision (e.g.: from Sensor.suggested_display_precision)
+     * Changes inside the absolute or relative deadband are ignored
+     * After `max_silence` seconds the value will be published, even if nothing changed
+
+    commit() must be called after the value was really published,
+    otherwise the value is still a change for the next should_publish() call.
+
+    >>> change_filter = ChangeFilter(precision=1, relative=0.1)
+    >>> change_filter.should_publish(10.0)  # The first value is always published
+    True
+    >>> change_filter.should_publish(10.0)  # Not committed, e.g.: The MQTT client is not connected
+    True
+    >>> change_filter.commit(10.0)
+    >>> change_filter.should_publish(10.04)  # Same value with precision 1
+    False
+    >>> change_filter.should_publish(10.9)  # Inside the deadband of 10%
+    False
+    >>> change_filter.should_publish(11.1)
+    True
+    >>> change_filter.commit('bulk')
+    >>> change_filter.should_publish('bulk')
+    False
+    """
+
+    def __init__(
+        self,
+        *,
+        precision: int | None = None,
+        absolute: float = 0,
+        relative: float = 0,
+        max_silence: float = 0,
+    ):
+        self.precision = precision
+        self.absolute = absolute
+        self.relative = relative
+        self.max_silence = max_silence
+
+        self.last_value = NOT_PUBLISHED
+        self.last_publish = 0.0
+
+        self.published = 0
+        self.suppressed = 0
+
+    def is_changed(self, value) -> bool:
+        last_value = self.last_value
+        if not (is_number(value) and is_number(last_value)):
+            return value != last_value
+
+        if self.precision is not None and round(value, self.precision) == round(last_value, self.precision):
+            return False
+
+        deadband = max(self.absolute, abs(last_value) * self.relative)
+        return abs(value - last_value) > deadband
+
+    def should_publish(self, value) -> bool:
+        if self.last_value is NOT_PUBLISHED or self.is_heartbeat_due() or self.is_changed(value):
+            return True
+
+        self.suppressed += 1
+        return False
+
+    def is_heartbeat_due(self) -> bool:
+        return bool(self.max_silence) and time.monotonic() - self.last_publish >= self.max_silence
+
+    def commit(self, value) -> None:
+        """
+        The value was published: Compare the next values with this one.
+        """
+        self.last_value = value
+        self.last_publish = time.monotonic()
+        self.published += 1
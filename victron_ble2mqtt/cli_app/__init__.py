@@ -18,7 +18,10 @@ logger = logging.getLogger(__name__)
 
 app = SubcommandApp()
 
-# Register all CLI commands, just by import all files in this package:
+# Register all CLI commands, just by import all files in this package.
+# Note: The command modules should only import light-weight modules at module level:
+# bleak, paho, victron_ble, ha_services and the publish pipeline are imported inside the command functions,
+# so that e.g. "--help" or "systemd-status" starts fast on a small device like a Raspberry Pi Zero.
 import_all_files(package=__package__, init_file=__file__)
 
 
@@ -0,0 +1,146 @@
+"""
+    CLI for usage
+"""
+
+import logging
+from pathlib import Path
+
+from cli_base.cli_tools.verbosity import setup_logging
+from cli_base.toml_settings.api import TomlSettings
+from cli_base.tyro_commands import TyroVerbosityArgType
+from rich import print
+
+from victron_ble2mqtt.cli_app import app
+from victron_ble2mqtt.cli_app.settings import get_settings
+from victron_ble2mqtt.user_settings import UserSettings
+
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_FLUSH_INTERVAL = 10  # Flush the capture buffers every 10 seconds
+
+
+@app.command
+def record(
+    verbosity: TyroVerbosityArgType,
+    directory: Path = Path('captures'),
+    stem: str = 'capture',
+    max_file_size_mb: int = 100,
+    all_devices: bool = False,
+):
+    """
+    Record raw BLE advertisements into binary capture files (Stop with Ctrl-C)
+    Only Victron advertisements are stored, if not --all-devices is given.
+    """
+    import asyncio
+
+    from bleak import AdvertisementData, BleakScanner, BLEDevice
+
+    from victron_ble2mqtt.capture import VICTRON_COMPANY_ID, CaptureWriter
+
+    setup_logging(verbosity=verbosity)
+
+    writer = CaptureWriter(
+        directory=directory,
+        stem=stem,
+        max_file_size=max_file_size_mb * 1024 * 1024,
+    )
+
+    def detection_callback(device: BLEDevice, advertisement: AdvertisementData):
+        if not all_devices and VICTRON_COMPANY_ID not in advertisement.manufacturer_data:
+            return
+        writer.write_advertisement(device, advertisement)
+
+    async def scan():
+        scanner = BleakScanner(detection_callback=detection_callback)
+        await scanner.start()
+        print(f'Recording into {directory.resolve()} ... (Stop with Ctrl-C)')
+        try:
+            while True:
+                await asyncio.sleep(CAPTURE_FLUSH_INTERVAL)
+                writer.flush()
+                logger.info('Capture: %s', writer.get_stats())
+        finally:
+            await scanner.stop()
+
+    try:
+        asyncio.run(scan())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+    print(f'Capture stats: {writer.get_stats()}')
+
+
+@app.command
+def replay(
+    verbosity: TyroVerbosityArgType,
+    path: Path = Path('captures'),
+    speed: float = 1.0,
+    fake_mqtt: bool = False,
+    no_throttle: bool = False,
+    start: float | None = None,
+    end: float | None = None,
+):
+    """
+    Replay recorded advertisements through the complete publish pipeline.
+    --speed: 1 = real time, N = N× faster, 0 = as fast as possible
+    --fake-mqtt: Don't connect to the MQTT broker, just count the messages.
+    --no-throttle: Publish every frame (The change detection still applies)
+    --start/--end: Replay only a time range (seconds since the first recording start)
+    """
+    from ha_services.mqtt4homeassistant.mqtt import get_connected_client
+    from rich.table import Table
+
+    from victron_ble2mqtt.capture import get_capture_files, iter_capture
+    from victron_ble2mqtt.publisher import MqttPublisher
+    from victron_ble2mqtt.replay import CountingMqttClient, ReplaySource
+
+    setup_logging(verbosity=verbosity)
+
+    toml_settings: TomlSettings = get_settings()
+    user_settings: UserSettings = toml_settings.get_user_settings(debug=verbosity > 1)
+    if no_throttle:
+        user_settings.publish_throttle_seconds = 0
+        user_settings.publish_max_per_minute = 0
+
+    if fake_mqtt:
+        mqtt_client = CountingMqttClient()
+    else:
+        mqtt_client = get_connected_client(settings=user_settings.mqtt, verbosity=verbosity)
+        mqtt_client.loop_start()
+
+    publisher = MqttPublisher(
+        keys=user_settings.device_keys,
+        user_settings=user_settings,
+        mqtt_client=mqtt_client,
+        queue_size=user_settings.publish_queue_size,
+    )
+    capture_files = get_capture_files(path)
+    print(f'Replay {len(capture_files)} capture files from {path} with speed {speed or "max."}')
+
+    source = ReplaySource(publisher=publisher, speed=speed, throttle=not no_throttle)
+    stats = source.replay(iter_capture(capture_files, start=start, end=end))
+    publisher.log_stats()
+
+    if not fake_mqtt:
+        mqtt_client.loop_stop()
+
+    table = Table(title=f'Replay of {stats.capture_duration:.1f} sec. capture in {stats.duration:.1f} sec.')
+    table.add_column('Device')
+    table.add_column('frames', justify='right')
+    table.add_column('CPU', justify='right')
+    table.add_column('latency avg.', justify='right')
+    table.add_column('latency max.', justify='right')
+    for address, device_stats in sorted(stats.devices.items()):
+        table.add_row(
+            address,
+            str(device_stats.frames),
+            f'{device_stats.cpu_time:.3f}s',
+            f'{device_stats.latency_total / device_stats.frames * 1_000_000:.1f}µs',
+            f'{device_stats.latency_max * 1_000_000:.1f}µs',
+        )
+    print(table)
+    print(f'{stats.frames} frames, {stats.get_frames_per_second():.1f} frames/sec.')
+    if fake_mqtt:
+        print(f'{mqtt_client.sent} MQTT messages, {mqtt_client.sent_bytes} payload bytes')
@@ -2,22 +2,17 @@
     CLI for usage
 """
 
-import asyncio
 import logging
 from datetime import datetime
 
-from bleak import AdvertisementData, BLEDevice
 from cli_base.cli_tools.verbosity import setup_logging
 from cli_base.toml_settings.api import TomlSettings
 from cli_base.tyro_commands import TyroVerbosityArgType
 from rich import print
-from victron_ble.devices import Device
-from victron_ble.scanner import Scanner as BaseScanner
 
 from victron_ble2mqtt.cli_app import app
 from victron_ble2mqtt.cli_app.settings import get_settings
 from victron_ble2mqtt.user_settings import UserSettings
-from victron_ble2mqtt.victron_ble_utils import DeviceHandler
 
 
 logger = logging.getLogger(__name__)
@@ -28,6 +23,11 @@ def discover(verbosity: TyroVerbosityArgType):
     """
     Discover Victron devices with Instant Readout
     """
+    import asyncio
+
+    from victron_ble.devices import Device
+    from victron_ble.scanner import Scanner as BaseScanner
+
     setup_logging(verbosity=verbosity)
 
     class Scanner(BaseScanner):
@@ -51,6 +51,13 @@ def debug_read(verbosity: TyroVerbosityArgType, keys: list[str] | None = None):
     Read data from devices and print them.
     Device keys are used from config file, if not given.
     """
+    import asyncio
+
+    from bleak import AdvertisementData, BLEDevice
+    from victron_ble.scanner import Scanner as BaseScanner
+
+    from victron_ble2mqtt.victron_ble_utils import DeviceHandler
+
     setup_logging(verbosity=verbosity)
 
     toml_settings: TomlSettings = get_settings()
@@ -2,95 +2,211 @@
     CLI for usage
 """
 
-import asyncio
 import logging
-import time
+import signal
+import socket
+from collections.abc import Callable
+from pathlib import Path
 
-from bleak import AdvertisementData, BLEDevice
 from cli_base.cli_tools.verbosity import setup_logging
 from cli_base.toml_settings.api import TomlSettings
 from cli_base.tyro_commands import TyroVerbosityArgType
-from ha_services.mqtt4homeassistant.mqtt import get_connected_client
 from rich import print
-from victron_ble.scanner import BaseScanner
 
 from victron_ble2mqtt.cli_app import app
 from victron_ble2mqtt.cli_app.settings import get_settings
-from victron_ble2mqtt.mqtt import VictronMqttDeviceHandler
 from victron_ble2mqtt.user_settings import UserSettings
-from victron_ble2mqtt.victron_ble_utils import DeviceHandler
 
 
 logger = logging.getLogger(__name__)
 
+STATS_LOG_INTERVAL = 5 * 60  # Log publish statistics every 5 minutes
+SETTINGS_CHECK_INTERVAL = 10  # Check the settings file for new device keys every 10 seconds
+
+
+def run_forever(*, on_shutdown: Callable[[], None]) -> None:
+    """
+    Run the event loop until SIGTERM (e.g.: "systemctl stop") or SIGINT (Ctrl-C) and call `on_shutdown`.
+    Without the signal handlers, Python exits on SIGTERM without running any "finally" block.
+    """
+    import asyncio
+
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        on_shutdown()
+
 
 @app.command
-def publish_loop(verbosity: TyroVerbosityArgType):
+def publish_loop(verbosity: TyroVerbosityArgType, profile: bool = False):
     """
     Publish MQTT messages in endless loop (Entrypoint from systemd)
+    --profile: Write cProfile dumps periodically, see "profiling" settings and "profile-summary" command.
     """
+    import asyncio
+
+    from bleak import BleakScanner
+
+    from victron_ble2mqtt.device_cache import DeviceCache
+    from victron_ble2mqtt.election import GatewayElection
+    from victron_ble2mqtt.energy import EnergyStore
+    from victron_ble2mqtt.metrics import PublishLoopMetrics, start_metrics_server
+    from victron_ble2mqtt.mqtt_transport import get_transport
+    from victron_ble2mqtt.profiling import RollingProfiler
+    from victron_ble2mqtt.publisher import DEFAULT_ADAPTER, MqttPublisher
+    from victron_ble2mqtt.store_forward import DiskRingBuffer, StoreAndForward
+    from victron_ble2mqtt.victron_ble_utils import DeviceHandler
+
     setup_logging(verbosity=verbosity)
 
     toml_settings: TomlSettings = get_settings()
     user_settings: UserSettings = toml_settings.get_user_settings(debug=verbosity > 1)
 
+    profiler = None
+    if profile or user_settings.profiling.enabled:
+        profiler = RollingProfiler(
+            directory=Path(user_settings.profiling.directory).expanduser(),
+            interval=user_settings.profiling.interval_seconds,
+            keep=user_settings.profiling.keep_files,
+        )
+        print(f'Write profiles to {profiler.directory} every {profiler.interval} sec.')
+
+    energy_store = None
+    if user_settings.energy.enabled:
+        energy_store = EnergyStore(
+            path=Path(user_settings.energy.state_file).expanduser(),
+            max_gap=user_settings.energy.max_gap_seconds,
+        )
+        energy_store.load()
+
+    device_cache = None
+    if user_settings.device_cache.enabled:
+        device_cache = DeviceCache(path=Path(user_settings.device_cache.cache_file).expanduser())
+        device_cache.load()
+
     keys = user_settings.device_keys
     print(f'Use device {len(keys)} device keys.')
 
-    class MqttPublisher(BaseScanner):
-        def __init__(
-            self,
-            *,
-            keys: list[str],
-            user_settings: UserSettings,
-        ):
-            super().__init__()
-            self.device_handler = DeviceHandler(keys)
-            self.victron_mqtt_handler = VictronMqttDeviceHandler(user_settings=user_settings)
-
-            self.mqtt_client = get_connected_client(settings=user_settings.mqtt, verbosity=verbosity)
-            self.mqtt_client.loop_start()
-
-            self.rssi_info = {}
-
-            self.next_publish = 0
-
-        def _detection_callback(self, device: BLEDevice, advertisement: AdvertisementData):
-            self.rssi_info[device.address] = advertisement.rssi
-            return super()._detection_callback(device, advertisement)
-
-        def callback(self, ble_device: BLEDevice, raw_data: bytes, advertisement: AdvertisementData):
-            logger.debug(f'Received data from {ble_device.address.lower()}: {raw_data.hex()}')
-            logger.debug('advertisement: %r', advertisement)
-
-            if generic_device := self.device_handler.get_generic_device(ble_device, raw_data):
-                if time.monotonic() < self.next_publish:
-                    logger.debug(f'Skipping publish for {ble_device.name} ({ble_device.address}) due to throttle.')
-                    return
-
-                self.victron_mqtt_handler.publish(
-                    ble_device=ble_device,
-                    raw_data=raw_data,
-                    generic_device=generic_device,
-                    rssi=self.rssi_info.get(ble_device.address),
-                    mqtt_client=self.mqtt_client,
-                )
-                self.next_publish = time.monotonic() + user_settings.publish_throttle_seconds
-            else:
-                logger.warning(f'Unsupported: {ble_device.name} ({ble_device.address})')
+    async def watch_settings(*, device_handler: DeviceHandler):
+        """
+        Take over changed device keys from the settings file, without restarting the service.
+        """
+        last_mtime = toml_settings.file_path.stat().st_mtime
+        while True:
+            await asyncio.sleep(SETTINGS_CHECK_INTERVAL)
+            mtime = toml_settings.file_path.stat().st_mtime
+            if mtime == last_mtime:
+                continue
+            last_mtime = mtime
+
+            new_keys = get_settings().get_user_settings().device_keys
+            if new_keys != device_handler.keys:
+                logger.info('Device keys changed in settings: %i -> %i keys', len(device_handler.keys), len(new_keys))
+                device_handler.set_keys(new_keys)
 
     async def scan(*, keys: list[str], user_settings: UserSettings):
-        scanner = MqttPublisher(
+        store_forward = None
+        if user_settings.store_forward.enabled:
+            store_forward = StoreAndForward(
+                buffer=DiskRingBuffer(
+                    directory=Path(user_settings.store_forward.directory).expanduser(),
+                    max_bytes=user_settings.store_forward.max_size_mb * 1024 * 1024,
+                ),
+                backfill_topic=user_settings.store_forward.backfill_topic,
+                batch_size=user_settings.store_forward.batch_size,
+                batch_interval=user_settings.store_forward.batch_interval_seconds,
+            )
+            print(f'Store-and-forward buffer: {store_forward.buffer.directory} ({store_forward.buffer.size} bytes)')
+        transport = get_transport(
+            user_settings.mqtt_transport,
+            settings=user_settings.mqtt,
+            verbosity=verbosity,
+            max_pending=user_settings.mqtt_max_pending,
+            store_forward=store_forward,
+        )
+        metrics = PublishLoopMetrics() if user_settings.metrics_port else None
+        election = None
+        if user_settings.gateway_election.enabled:
+            election = GatewayElection(
+                gateway_id=user_settings.gateway_election.gateway_id or socket.gethostname(),
+                topic=user_settings.gateway_election.topic,
+                interval=user_settings.gateway_election.announce_interval_seconds,
+                hysteresis=user_settings.gateway_election.hysteresis_db,
+            )
+            print(f'Gateway election as {election.gateway_id!r} via {election.topic!r}')
+            election.subscribe(transport.client)
+        publisher = MqttPublisher(
             keys=keys,
             user_settings=user_settings,
+            mqtt_client=transport.client,
+            queue_size=user_settings.publish_queue_size,
+            metrics=metrics,
+            energy_store=energy_store,
+            election=election,
+            device_cache=device_cache,
         )
-        await scanner.start()
+        if device_cache is not None:
+            print(f'Restored {publisher.restore_devices()} devices from {device_cache.path}')
+        if metrics is not None:
+            metrics.bind(publisher=publisher, transport=transport)
+            await start_metrics_server(
+                metrics.registry,
+                host=user_settings.metrics_host,
+                port=user_settings.metrics_port,
+            )
+            asyncio.ensure_future(metrics.measure_loop_lag())
+        publisher.victron_mqtt_handler.subscribe_ha_status(transport.client)
+
+        print(f'Connect to MQTT broker via {transport.name} transport...')
+        await transport.start()
+
+        if election is not None:
+            asyncio.ensure_future(election.run(transport.client))
+        if publisher.queue is not None:
+            asyncio.ensure_future(publisher.run_worker(wait_for_capacity=transport.wait_for_capacity))
+        if store_forward is not None:
+            asyncio.ensure_future(store_forward.run(transport.client, wait_for_capacity=transport.wait_for_capacity))
+
+        scanners = []  # Keep a reference to all running scanners
+        for adapter in user_settings.bluetooth_adapters or [DEFAULT_ADAPTER]:
+            scanner = BleakScanner(
+                detection_callback=publisher.get_detection_callback(adapter),
+                bluez={} if adapter == DEFAULT_ADAPTER else {'adapter': adapter},
+            )
+            print(f'Start BLE scanner on {adapter} adapter')
+            await scanner.start()
+            scanners.append(scanner)
+
+        asyncio.ensure_future(watch_settings(device_handler=publisher.device_handler))
+
+        while True:
+            await asyncio.sleep(STATS_LOG_INTERVAL)
+            publisher.expire()
+            publisher.log_stats()
+            logger.info('MQTT transport: %s', transport.get_stats())
+            if energy_store is not None:
+                energy_store.save()
+            if device_cache is not None:
+                device_cache.save()
 
-    loop = asyncio.get_event_loop()
     asyncio.ensure_future(
         scan(
             keys=keys,
             user_settings=user_settings,
         )
     )
-    loop.run_forever()
+    if profiler is not None:
+        asyncio.ensure_future(profiler.run())
+
+    def shutdown():
+        if profiler is not None:
+            profiler.stop()  # Don't lose the last profile window
+        if energy_store is not None:
+            energy_store.save()
+        if device_cache is not None:
+            device_cache.save()
+
+    run_forever(on_shutdown=shutdown)
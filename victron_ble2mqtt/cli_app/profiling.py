@@ -0,0 +1,66 @@
+"""
+    CLI for usage
+"""
+
+import logging
+from pathlib import Path
+
+from cli_base.cli_tools.verbosity import setup_logging
+from cli_base.toml_settings.api import TomlSettings
+from cli_base.tyro_commands import TyroVerbosityArgType
+from rich import print
+from rich.table import Table
+
+from victron_ble2mqtt.cli_app import app
+from victron_ble2mqtt.cli_app.settings import get_settings
+from victron_ble2mqtt.profiling import FunctionStats, get_hot_spots, get_profile_files, get_stage_stats, load_profiles
+from victron_ble2mqtt.user_settings import UserSettings
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_stats_table(title: str, first_column: str, rows: list[tuple[str, FunctionStats]]) -> Table:
+    table = Table(title=title)
+    table.add_column(first_column)
+    table.add_column('calls', justify='right')
+    table.add_column('own time', justify='right')
+    table.add_column('cumulative', justify='right')
+    table.add_column('per call', justify='right')
+    for name, function_stats in rows:
+        per_call = function_stats.cumulative_time / function_stats.calls if function_stats.calls else 0
+        table.add_row(
+            name,
+            str(function_stats.calls),
+            f'{function_stats.total_time:.3f}s',
+            f'{function_stats.cumulative_time:.3f}s',
+            f'{per_call * 1_000_000:.1f}µs',
+        )
+    return table
+
+
+@app.command
+def profile_summary(verbosity: TyroVerbosityArgType, path: Path | None = None, limit: int = 20):
+    """
+    Summarize the profiles written by "publish-loop --profile": Pipeline stages and top hot spots.
+    --path: Profile file or directory (Default: The "profiling" directory from the settings)
+    """
+    setup_logging(verbosity=verbosity)
+
+    if path is None:
+        toml_settings: TomlSettings = get_settings()
+        user_settings: UserSettings = toml_settings.get_user_settings(debug=verbosity > 1)
+        path = Path(user_settings.profiling.directory).expanduser()
+
+    profile_files = get_profile_files(path)
+    if not profile_files:
+        print(f'[red]No profiles found in {path}')
+        return
+    print(f'Summarize {len(profile_files)} profiles: {profile_files[0].name} ... {profile_files[-1].name}')
+    stats = load_profiles(profile_files)
+
+    stage_stats = get_stage_stats(stats)
+    print(get_stats_table('Pipeline stages (nested times)', 'Stage', list(stage_stats.items())))
+
+    hot_spots = get_hot_spots(stats, limit=limit)
+    print(get_stats_table(f'Top {limit} hot spots', 'Function', [(spot.label, spot) for spot in hot_spots]))
@@ -2,7 +2,6 @@ import logging
 import sys
 from pathlib import Path
 
-from cli_base.cli_tools import git_history
 from cli_base.cli_tools.verbosity import setup_logging
 from cli_base.tyro_commands import TyroVerbosityArgType
 from rich import print
@@ -23,6 +22,8 @@ def update_readme_history(verbosity: TyroVerbosityArgType):
     Also, callable via e.g.:
         python -m cli_base update-readme-history -v
     """
+    from cli_base.cli_tools import git_history
+
     setup_logging(verbosity=verbosity)
 
     logger.debug('%s called. CWD: %s', __name__, Path.cwd())
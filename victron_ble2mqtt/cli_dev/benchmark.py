@@ -0,0 +1,130 @@
+import logging
+from pathlib import Path
+
+from cli_base.cli_tools.verbosity import setup_logging
+from cli_base.tyro_commands import TyroVerbosityArgType
+from rich import print
+from rich.table import Table
+
+from victron_ble2mqtt.benchmarks.pipeline import (
+    MEMORY_DEVICES,
+    MEMORY_RESULT,
+    STAGES,
+    add_memory_results,
+    benchmark_handler_memory,
+    benchmark_pipeline,
+    load_results,
+    save_results,
+)
+from victron_ble2mqtt.benchmarks.startup import STARTUP_STAGES, benchmark_startup
+from victron_ble2mqtt.benchmarks.values2dict import benchmark_values2dict
+from victron_ble2mqtt.cli_dev import app
+
+
+logger = logging.getLogger(__name__)
+
+
+def format_result(value: float, baseline: float | None, unit: str = 'µs') -> str:
+    """
+    >>> format_result(12.345, None)
+    '12.35µs'
+    >>> format_result(12, 10)
+    '12.00µs [red]+20%[/red]'
+    >>> format_result(9, 10)
+    '9.00µs [green]-10%[/green]'
+    >>> format_result(250, None, unit='ms')
+    '250.00ms'
+    """
+    text = f'{value:.2f}{unit}'
+    if baseline:
+        change = (value - baseline) / baseline * 100
+        color = 'red' if change > 0 else 'green'
+        text += f' [{color}]{change:+.0f}%[/{color}]'
+    return text
+
+
+@app.command
+def benchmark(
+    verbosity: TyroVerbosityArgType,
+    json_path: Path | None = None,
+    baseline: Path | None = None,
+):
+    """
+    Run micro benchmarks of the BLE -> MQTT hot path
+    Store the results via --json-path and compare them later with --baseline
+    """
+    setup_logging(verbosity=verbosity)
+
+    table = Table(title='values2dict() per call')
+    table.add_column('Device class')
+    table.add_column('reflection', justify='right')
+    table.add_column('extractor', justify='right')
+    table.add_column('speedup', justify='right')
+    for name, result in benchmark_values2dict().items():
+        table.add_row(
+            name,
+            f'{result["reflection"]:.2f}µs',
+            f'{result["extractor"]:.2f}µs',
+            f'{result["reflection"] / result["extractor"]:.1f}x',
+        )
+    print(table)
+
+    baseline_results = load_results(baseline) if baseline else {}
+
+    results = benchmark_pipeline()
+    table = Table(title='Hot path stages per call')
+    table.add_column('Device class')
+    for stage in STAGES:
+        table.add_column(stage, justify='right')
+    for name, stage_results in results.items():
+        baseline_stages = baseline_results.get(name, {})
+        table.add_row(
+            name,
+            *(format_result(stage_results[stage], baseline_stages.get(stage)) for stage in STAGES),
+        )
+    print(table)
+
+    memory = benchmark_handler_memory()
+    table = Table(title=f'Handler memory per device ({MEMORY_DEVICES} devices of the same model)')
+    table.add_column('Device class')
+    table.add_column('allocated', justify='right')
+    for name, allocated in memory.items():
+        baseline_allocated = baseline_results.get(name, {}).get(MEMORY_RESULT)
+        table.add_row(
+            name,
+            format_result(allocated / 1024, baseline_allocated and baseline_allocated / 1024, unit='KiB'),
+        )
+    print(table)
+
+    if json_path:
+        add_memory_results(results, memory)
+        save_results(json_path, results)
+        print(f'Results stored into: {json_path}')
+
+
+@app.command
+def startup_benchmark(
+    verbosity: TyroVerbosityArgType,
+    json_path: Path | None = None,
+    baseline: Path | None = None,
+    repeat: int = 5,
+):
+    """
+    Measure the startup time until the first BLE callback, each stage in a fresh Python process
+    Store the results via --json-path and compare them later with --baseline
+    """
+    setup_logging(verbosity=verbosity)
+
+    baseline_results = load_results(baseline).get('startup', {}) if baseline else {}
+
+    results = benchmark_startup(repeat=repeat)
+    table = Table(title=f'Startup time (best of {repeat})')
+    table.add_column('Stage')
+    table.add_column('wall time', justify='right')
+    for stage in STARTUP_STAGES:
+        table.add_row(stage, format_result(results[stage], baseline_results.get(stage), unit='ms'))
+    print(table)
+
+    if json_path:
+        save_results(json_path, {'startup': results}, unit='ms wall time')
+        print(f'Results stored into: {json_path}')
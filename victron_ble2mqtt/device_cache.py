@@ -0,0 +1,118 @@
+"""
+    Remember the known devices between restarts, see: "device_cache" settings.
+
+    The cache is a JSON file: MAC address -> {
+        "name": BLE name,
+        "device_class": victron_ble device class, e.g.: "BatteryMonitor",
+        "key_index": index of the matching key in the "device_keys" setting,
+        "key_hash": hash of the matching key, to detect changed "device_keys",
+        "handler": MQTT handler class, e.g.: "BatteryMonitorHandler",
+        "setup_data": values of the first frame, e.g.: "model_name", used to set up the sensors
+    }
+
+    The device keys themselves are not stored. On startup the handlers of all cached devices are set up
+    before the first advertisement arrives and the matching key is tried first, see: MqttPublisher.restore_devices()
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_key_hash(key: str) -> str:
+    """
+    >>> get_key_hash('0123456789abcdef0123456789abcdef')
+    '3eb1bd439947eb76'
+    >>> get_key_hash('0123456789ABCDEF0123456789ABCDEF')
+    '3eb1bd439947eb76'
+    """
+    return hashlib.sha256(key.lower().encode()).hexdigest()[:16]
+
+
+def find_key(keys: list[str], *, key_index: int, key_hash: str) -> str | None:
+    """
+    Returns the cached key, if it's still in the "device_keys" setting.
+
+    >>> keys = ['aa00', 'bb00']
+    >>> find_key(keys, key_index=1, key_hash=get_key_hash('bb00'))
+    'bb00'
+    >>> find_key(keys, key_index=0, key_hash=get_key_hash('bb00'))  # The keys were reordered
+    'bb00'
+    >>> find_key(keys, key_index=5, key_hash=get_key_hash('cc00')) is None
+    True
+    """
+    if 0 <= key_index < len(keys) and get_key_hash(keys[key_index]) == key_hash:
+        return keys[key_index]
+    for key in keys:
+        if get_key_hash(key) == key_hash:
+            return key
+    return None
+
+
+class DeviceCache:
+    def __init__(self, *, path: Path):
+        self.path = path
+        self.devices = {}  # MAC address -> cache entry
+        self.changed = False
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.devices
+
+    def __len__(self) -> int:
+        return len(self.devices)
+
+    def add(
+        self,
+        address: str,
+        *,
+        name: str | None,
+        device_class: str,
+        key_index: int,
+        key_hash: str,
+        handler: str,
+        setup_data: dict,
+    ) -> None:
+        logger.info('Add %s (%s) to the device cache', address, device_class)
+        self.devices[address] = {
+            'name': name,
+            'device_class': device_class,
+            'key_index': key_index,
+            'key_hash': key_hash,
+            'handler': handler,
+            'setup_data': setup_data,
+        }
+        self.changed = True
+
+    def remove(self, address: str) -> None:
+        if self.devices.pop(address, None) is not None:
+            logger.info('Remove %s from the device cache', address)
+            self.changed = True
+
+    def load(self) -> None:
+        try:
+            data = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            logger.info('No device cache file %s, all devices will be detected', self.path)
+            return
+        except ValueError as err:
+            logger.error('Ignore invalid device cache file %s: %s', self.path, err)
+            return
+
+        self.devices = data
+        self.changed = False
+        logger.info('Loaded %i devices from %s', len(self.devices), self.path)
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix('.tmp')
+        temp_path.write_text(json.dumps(self.devices, indent=4, sort_keys=True, default=str))
+        os.replace(temp_path, self.path)
+        self.changed = False
+        logger.debug('Saved %i devices to %s', len(self.devices), self.path)
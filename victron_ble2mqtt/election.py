@@ -0,0 +1,198 @@
+"""
+    Elect one gateway per Victron device, if several victron-ble2mqtt instances publish to the same broker.
+
+    Every gateway announces the smoothed RSSI of the devices it receives as retained MQTT message:
+
+        <topic>/<device mac>/<gateway id> -> {"rssi": -72.5, "time": <unix timestamp>, "owner": <gateway id>}
+
+    All gateways collect these announcements and elect the same owner: The gateway with the best RSSI.
+    The "owner" is the election result of the announcing gateway. All gateways start from this claimed owner,
+    so a gateway that joins later doesn't elect itself. Other gateways take over only if their RSSI is
+    `hysteresis` dB better, or if the owner's announcement is stale or removed (The owner stopped hearing the device).
+    Frames of devices owned by another gateway are dropped before decryption, see: MqttPublisher.intake()
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+
+from paho.mqtt.client import Client, MQTTMessage
+
+from victron_ble2mqtt.mqtt import add_subscription
+
+
+logger = logging.getLogger(__name__)
+
+RSSI_SMOOTHING = 0.2  # Weight of a new RSSI value in the exponential moving average
+STALE_INTERVALS = 3  # Announcements older than this number of intervals are ignored
+
+
+def get_address_slug(address: str) -> str:
+    """
+    >>> get_address_slug('AA:BB:CC:DD:EE:FF')
+    'aabbccddeeff'
+    """
+    return address.lower().replace(':', '')
+
+
+def get_address(slug: str) -> str:
+    """
+    >>> get_address('aabbccddeeff')
+    'AA:BB:CC:DD:EE:FF'
+    """
+    return ':'.join(slug[pos : pos + 2] for pos in range(0, len(slug), 2)).upper()
+
+
+class GatewayElection:
+    def __init__(self, *, gateway_id: str, topic: str, interval: float, hysteresis: float):
+        self.gateway_id = gateway_id
+        self.topic = topic
+        self.interval = interval
+        self.hysteresis = hysteresis
+        self.stale_after = interval * STALE_INTERVALS
+
+        self.rssi = {}  # address -> smoothed RSSI of this gateway
+        self.last_seen = {}  # address -> time.monotonic() of the last advertisement
+        self.announcements = {}  # address -> {gateway id: (RSSI, time.time() of the announcement, claimed owner)}
+        self.owners = {}  # address -> gateway id
+        self.received = deque()  # Filled from the MQTT network thread, see: process_announcements()
+
+        self.dropped = 0  # Advertisements of devices, owned by other gateways
+        self.owner_changes = 0
+
+    def observe(self, address: str, rssi: int) -> None:
+        """
+        Called for every received advertisement of a device.
+        """
+        try:
+            smoothed = self.rssi[address]
+        except KeyError:
+            self.rssi[address] = rssi
+        else:
+            self.rssi[address] = smoothed + RSSI_SMOOTHING * (rssi - smoothed)
+        self.last_seen[address] = time.monotonic()
+
+    def is_owner(self, address: str) -> bool:
+        """
+        Should this gateway publish the device? Until a election result exists, every gateway publishes.
+        """
+        if self.received:
+            self.process_announcements()
+        if self.owners.get(address, self.gateway_id) == self.gateway_id:
+            return True
+        self.dropped += 1
+        return False
+
+    def get_fresh_announcements(self, address: str) -> dict[str, tuple[float, float, str | None]]:
+        deadline = time.time() - self.stale_after
+        return {
+            gateway_id: announcement
+            for gateway_id, announcement in self.announcements.get(address, {}).items()
+            if announcement[1] >= deadline
+        }
+
+    def elect(self, address: str) -> None:
+        announcements = self.get_fresh_announcements(address)
+        candidates = {gateway_id: rssi for gateway_id, (rssi, _, _) in announcements.items()}
+        if address in self.rssi:
+            candidates[self.gateway_id] = self.rssi[address]  # Our own value is always up-to-date
+        previous = self.owners.get(address)
+        if not candidates:
+            self.owners.pop(address, None)
+            return
+
+        # Best RSSI wins, on a tie the gateway id decides, so all gateways get the same result:
+        def rank(gateway_id: str) -> tuple[float, str]:
+            return candidates[gateway_id], gateway_id
+
+        owner = max(candidates, key=rank)
+
+        # Use the owner claimed in the announcements, not our own previous result:
+        # All gateways see the same announcements, so they apply the hysteresis to the same owner.
+        claimed = {claimed for _, _, claimed in announcements.values() if claimed in candidates}
+        if claimed:
+            current = max(claimed, key=rank)  # Claims can differ for a moment, e.g.: two gateways started together
+            if candidates[owner] < candidates[current] + self.hysteresis:
+                owner = current  # Not enough better: Keep the current owner
+
+        if owner != previous:
+            logger.info('New owner of %s: %s (RSSI %.1f, was: %s)', address, owner, candidates[owner], previous)
+            self.owners[address] = owner
+            self.owner_changes += 1
+
+    def subscribe(self, mqtt_client: Client) -> None:
+        """
+        Receive the announcements of all gateways. Must be called before the client connects.
+        """
+        add_subscription(mqtt_client, f'{self.topic}/+/+', self.on_announcement)
+
+    def on_announcement(self, client: Client, userdata, message: MQTTMessage) -> None:
+        """
+        Called in the MQTT network thread: Only parse the message, the election runs in the event loop.
+        """
+        address_slug, gateway_id = message.topic.rsplit('/', 2)[1:]
+        address = get_address(address_slug)
+        if not message.payload:
+            announcement = None  # The gateway doesn't receive the device anymore
+        else:
+            try:
+                data = json.loads(message.payload)
+                announcement = (float(data['rssi']), float(data['time']), data.get('owner'))
+            except (ValueError, KeyError, TypeError, AttributeError) as err:
+                logger.warning('Ignore invalid announcement %s: %s', message.topic, err)
+                return
+        self.received.append((address, gateway_id, announcement))
+
+    def process_announcements(self) -> None:
+        addresses = set()
+        while self.received:
+            address, gateway_id, announcement = self.received.popleft()
+            announcements = self.announcements.setdefault(address, {})
+            if announcement is None:
+                announcements.pop(gateway_id, None)
+            else:
+                announcements[gateway_id] = announcement
+            addresses.add(address)
+        for address in addresses:
+            self.elect(address)
+
+    def announce(self, mqtt_client: Client) -> None:
+        """
+        Publish the smoothed RSSI of all received devices and remove the announcements of lost devices.
+        """
+        self.process_announcements()
+
+        now = time.monotonic()
+        for address, last_seen in list(self.last_seen.items()):
+            if now - last_seen > self.stale_after:
+                logger.info('Lost device %s: Remove announcement', address)
+                del self.rssi[address]
+                del self.last_seen[address]
+                topic = f'{self.topic}/{get_address_slug(address)}/{self.gateway_id}'
+                mqtt_client.publish(topic, payload=None, retain=True)  # Delete the retained message
+
+        # Failover: Forget stale announcements of other gateways
+        for address in self.announcements.keys() | self.rssi.keys():
+            self.elect(address)
+
+        for address, rssi in self.rssi.items():
+            topic = f'{self.topic}/{get_address_slug(address)}/{self.gateway_id}'
+            payload = {'rssi': round(rssi, 1), 'time': round(time.time(), 1), 'owner': self.owners.get(address)}
+            mqtt_client.publish(topic, payload=json.dumps(payload), retain=True)
+
+    async def run(self, mqtt_client: Client) -> None:
+        while True:
+            self.announce(mqtt_client)
+            await asyncio.sleep(self.interval)
+
+    def get_stats(self) -> dict:
+        owned = sum(1 for owner in self.owners.values() if owner == self.gateway_id)
+        return {
+            'gateway_id': self.gateway_id,
+            'devices': len(self.owners),
+            'owned': owned,
+            'owner_changes': self.owner_changes,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,121 @@
+"""
+    Integrate the derived power sensors (W) into energy counters (Wh), see: "energy" settings.
+
+    Every decoded frame is integrated, also the throttled ones and repeated frames (same power as before).
+    The counters are stored in a JSON file, so they survive restarts.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+class EnergyIntegrator:
+    """
+    Integrate power samples with the trapezoidal rule.
+    Positive and negative power (e.g.: charge/discharge a battery) are counted separately,
+    so both counters only increase. Gaps longer than `max_gap` seconds are not integrated.
+
+    >>> integrator = EnergyIntegrator(max_gap=60)
+    >>> integrator.add(100, now=0)  # The first sample just starts the integration
+    >>> integrator.add(100, now=36)
+    >>> integrator.positive_wh
+    1.0
+    >>> integrator.add(-100, now=72)  # Zero crossing in the middle
+    >>> integrator.positive_wh, integrator.negative_wh
+    (1.25, 0.25)
+    >>> integrator.add(-100, now=1000)  # Too long gap
+    >>> integrator.negative_wh
+    0.25
+    """
+
+    __slots__ = ('last_power', 'last_time', 'max_gap', 'negative_wh', 'positive_wh')
+
+    def __init__(self, *, max_gap: float, positive_wh: float = 0.0, negative_wh: float = 0.0):
+        self.max_gap = max_gap
+        self.positive_wh = positive_wh
+        self.negative_wh = negative_wh
+        self.last_power = None
+        self.last_time = None
+
+    def add(self, power: float, *, now: float) -> None:
+        last_power, last_time = self.last_power, self.last_time
+        self.last_power, self.last_time = power, now
+        if last_time is None:
+            return
+
+        duration = now - last_time
+        if duration <= 0 or duration > self.max_gap:
+            return
+
+        if (last_power < 0) != (power < 0) and last_power != power:
+            # The sign changes: Split the interval at the zero crossing of the linear interpolation
+            crossing = duration * last_power / (last_power - power)
+            self.count(last_power * crossing / 2)
+            self.count(power * (duration - crossing) / 2)
+        else:
+            self.count((last_power + power) / 2 * duration)
+
+    def count(self, watt_seconds: float) -> None:
+        if watt_seconds > 0:
+            self.positive_wh += watt_seconds / 3600
+        else:
+            self.negative_wh -= watt_seconds / 3600
+
+    def extend(self, *, now: float) -> None:
+        """
+        The power is the same as before, e.g.: Device sends the same frame again.
+        """
+        if self.last_power is not None:
+            self.add(self.last_power, now=now)
+
+
+class EnergyStore:
+    """
+    All energy counters, stored in a JSON file. Key is "<device uid>-<power sensor key>"
+    """
+
+    def __init__(self, *, path: Path, max_gap: float):
+        self.path = path
+        self.max_gap = max_gap
+        self.integrators = {}
+
+    def get_integrator(self, key: str) -> EnergyIntegrator:
+        try:
+            return self.integrators[key]
+        except KeyError:
+            integrator = self.integrators[key] = EnergyIntegrator(max_gap=self.max_gap)
+            return integrator
+
+    def load(self) -> None:
+        try:
+            data = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            logger.info('No energy state file %s, start with zero counters', self.path)
+            return
+        except ValueError as err:
+            logger.error('Ignore invalid energy state file %s: %s', self.path, err)
+            return
+
+        for key, counters in data.items():
+            self.integrators[key] = EnergyIntegrator(
+                max_gap=self.max_gap,
+                positive_wh=counters['positive_wh'],
+                negative_wh=counters['negative_wh'],
+            )
+        logger.info('Loaded %i energy counters from %s', len(self.integrators), self.path)
+
+    def save(self) -> None:
+        data = {
+            key: {'positive_wh': integrator.positive_wh, 'negative_wh': integrator.negative_wh}
+            for key, integrator in sorted(self.integrators.items())
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix('.tmp')
+        temp_path.write_text(json.dumps(data, indent=4))
+        os.replace(temp_path, self.path)  # Never leave a half written state file
+        logger.debug('Saved %i energy counters to %s', len(data), self.path)
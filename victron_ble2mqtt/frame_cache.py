@@ -0,0 +1,78 @@
+import logging
+
+from victron_ble2mqtt.registry import ExpiringRegistry
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_frame(raw_data: bytes) -> bytes:
+    """
+    Returns the part of a "instant readout" advertisement that changes with new data:
+    The nonce (IV counter), the key check byte and the encrypted payload.
+
+    >>> get_frame(bytes.fromhex('100089a3020100010694267ba398480c')).hex()
+    '0100010694267ba398480c'
+    """
+    return raw_data[5:]
+
+
+class FrameCache:
+    """
+    Remember the last frame of every device.
+
+    Victron devices send the same encrypted frame (with the same nonce) many times,
+    until their data changes. Repeated frames can be skipped without any decryption.
+
+    >>> frame_cache = FrameCache()
+    >>> frame_cache.is_repeated('AA:BB', b'frame 1')
+    False
+    >>> frame_cache.remember('AA:BB', b'frame 1')
+    >>> frame_cache.is_repeated('AA:BB', b'frame 1')
+    True
+    >>> frame_cache.is_repeated('AA:BB', b'frame 2')
+    False
+    >>> frame_cache.get_stats()
+    {'size': 1, 'hits': 1, 'misses': 2, 'hit_rate': 0.333}
+    """
+
+    def __init__(self, *, max_size: int = 0, ttl: float = 0):
+        self.frames = ExpiringRegistry(name='frames', max_size=max_size, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def is_repeated(self, address: str, raw_data: bytes) -> bool:
+        if self.frames.peek(address) == get_frame(raw_data):
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        return False
+
+    def remember(self, address: str, raw_data: bytes) -> None:
+        """
+        Store the frame after it was processed.
+        Note: Don't remember frames that are dropped without decryption, otherwise they will never be published.
+        Throttled frames, whose energy was integrated, are fine: The device sends a new frame with the next values.
+        """
+        self.frames[address] = get_frame(raw_data)
+
+    def remove(self, address: str) -> None:
+        self.frames.pop(address)
+
+    def expire(self) -> None:
+        self.frames.expire()
+
+    def get_hit_rate(self) -> float:
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return self.hits / total
+
+    def get_stats(self) -> dict:
+        return {
+            'size': len(self.frames),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.get_hit_rate(), 3),
+        }
@@ -0,0 +1,450 @@
+"""
+    Prometheus metrics of the publish loop, served via a small asyncio HTTP server.
+
+    No client library is used: The hot path only increments pre-bound values and most counters are
+    collected from the existing statistics of the publisher (e.g.: the frame cache hits) when they are scraped.
+"""
+
+import asyncio
+import bisect
+import logging
+from collections.abc import Callable, Iterator
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+LOOP_LAG_INTERVAL = 1  # Seconds between two event loop lag measurements
+OTHER_ADDRESS = 'other'  # Label of the MQTT messages, that don't belong to a device, e.g.: gateway election
+
+
+def format_labels(labels: dict) -> str:
+    """
+    >>> format_labels({})
+    ''
+    >>> format_labels({'address': 'AA:BB', 'name': 'a "quoted" \\\\ name'})
+    '{address="AA:BB",name="a \\\\"quoted\\\\" \\\\\\\\ name"}'
+    """
+    if not labels:
+        return ''
+    items = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        items.append(f'{key}="{value}"')
+    return '{' + ','.join(items) + '}'
+
+
+def format_value(value: float) -> str:
+    """
+    >>> format_value(3)
+    '3'
+    >>> format_value(0.25)
+    '0.25'
+    >>> format_value(float('inf'))
+    '+Inf'
+    """
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class BaseMetric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, *, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def get_samples(self) -> Iterator[tuple[str, dict, float]]:
+        """
+        Yields (name suffix, labels, value) tuples.
+        """
+        raise NotImplementedError
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        for suffix, labels, value in self.get_samples():
+            yield f'{self.name}{suffix}{format_labels(labels)} {format_value(value)}'
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class HistogramValue:
+    __slots__ = ('buckets', 'count', 'counts', 'sum')
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # Not cumulative, summed up in get_samples()
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class DeviceMetrics:
+    """
+    The pre-bound values of one BLE address, see: PublishLoopMetrics.get_device()
+    """
+
+    __slots__ = ('advertisements', 'mqtt_bytes', 'mqtt_messages')
+
+    def __init__(self, *, advertisements: CounterValue, mqtt_messages: CounterValue, mqtt_bytes: CounterValue):
+        self.advertisements = advertisements
+        self.mqtt_messages = mqtt_messages
+        self.mqtt_bytes = mqtt_bytes
+
+
+class BaseLabeledMetric(BaseMetric):
+    """
+    Use labels() once to get the value object of one label combination and keep it (pre-bound).
+    Without label names, the value object is available as `value`.
+    """
+
+    def __init__(self, name: str, documentation: str, *, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames=labelnames)
+        self.children = {}  # label values -> value object
+        if not labelnames:
+            self.value = self.labels()
+
+    def new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        try:
+            return self.children[values]
+        except KeyError:
+            assert len(values) == len(self.labelnames), f'{self.name}: {values=} does not match {self.labelnames=}'
+            child = self.children[values] = self.new_value()
+            return child
+
+    def remove(self, *values: str) -> None:
+        self.children.pop(values, None)
+
+    def iter_children(self) -> Iterator[tuple[dict, object]]:
+        for values, child in self.children.items():
+            yield dict(zip(self.labelnames, values, strict=True)), child
+
+
+class Counter(BaseLabeledMetric):
+    """
+    >>> counter = Counter('frames_total', 'Received frames', labelnames=('address',))
+    >>> counter.labels('AA').inc()
+    >>> print('\\n'.join(counter.render()))
+    # HELP frames_total Received frames
+    # TYPE frames_total counter
+    frames_total{address="AA"} 1
+    """
+
+    type = 'counter'
+
+    def new_value(self) -> CounterValue:
+        return CounterValue()
+
+    def get_samples(self) -> Iterator[tuple[str, dict, float]]:
+        for labels, child in self.iter_children():
+            yield '', labels, child.value
+
+
+class Histogram(BaseLabeledMetric):
+    """
+    >>> histogram = Histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    >>> histogram.value.observe(0.5)
+    >>> histogram.value.observe(2)
+    >>> print('\\n'.join(histogram.render()))
+    # HELP latency_seconds Latency
+    # TYPE latency_seconds histogram
+    latency_seconds_bucket{le="0.1"} 0
+    latency_seconds_bucket{le="1.0"} 1
+    latency_seconds_bucket{le="+Inf"} 2
+    latency_seconds_sum 2.5
+    latency_seconds_count 2
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, *, buckets: tuple[float, ...], labelnames: tuple = ()):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames=labelnames)
+
+    def new_value(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def get_samples(self) -> Iterator[tuple[str, dict, float]]:
+        for labels, child in self.iter_children():
+            cumulative = 0
+            for bucket, count in zip(self.buckets, child.counts, strict=True):
+                cumulative += count
+                yield '_bucket', {**labels, 'le': repr(bucket)}, cumulative
+            yield '_bucket', {**labels, 'le': '+Inf'}, child.count
+            yield '_sum', labels, child.sum
+            yield '_count', labels, child.count
+
+
+class CallbackMetric(BaseMetric):
+    """
+    A counter or gauge, that gets the values from a function when the metrics are scraped.
+    The function returns one value or a dict with the label values as key.
+
+    >>> metric = CallbackMetric('size', 'Size', metric_type='gauge', labelnames=('name',), func=lambda: {'foo': 2})
+    >>> print('\\n'.join(metric.render()))
+    # HELP size Size
+    # TYPE size gauge
+    size{name="foo"} 2
+    """
+
+    def __init__(self, name: str, documentation: str, *, metric_type: str, func: Callable, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames=labelnames)
+        assert metric_type in ('counter', 'gauge'), f'Unsupported {metric_type=}'
+        self.type = metric_type
+        self.func = func
+
+    def get_samples(self) -> Iterator[tuple[str, dict, float]]:
+        values = self.func()
+        if not self.labelnames:
+            yield '', {}, values
+            return
+        for label_values, value in values.items():
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            yield '', dict(zip(self.labelnames, label_values, strict=True)), value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric: BaseMetric) -> BaseMetric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class PublishLoopMetrics:
+    """
+    All metrics of the publish loop. The publisher updates the pre-bound values in the hot path
+    and bind() adds the statistics that the publisher and the MQTT transport collect anyway.
+    """
+
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        add = self.registry.add
+
+        self.advertisements = add(
+            Counter('victron_ble_advertisements_total', 'Received BLE advertisements of all devices')
+        ).value
+        self.device_advertisements = add(
+            Counter(
+                'victron_ble_device_advertisements_total',
+                'Received Victron instant readout advertisements per device',
+                labelnames=('address',),
+            )
+        )
+        self.frames_decrypted = CounterValue()
+        frame_errors = add(
+            Counter(
+                'victron_ble_frame_errors_total',
+                'Frames of known devices that could not be decrypted or parsed',
+                labelnames=('error',),
+            )
+        )
+        self.key_mismatches = frame_errors.labels('key_mismatch')
+        self.parse_errors = frame_errors.labels('parse_error')
+        self.publish_latency = add(
+            Histogram(
+                'victron_ble_handler_publish_seconds',
+                'Time to decrypt and publish one frame',
+                buckets=LATENCY_BUCKETS,
+            )
+        ).value
+        self.mqtt_messages = add(
+            Counter(
+                'victron_mqtt_messages_total',
+                f'Published MQTT messages per device ("{OTHER_ADDRESS}": not device related)',
+                labelnames=('address',),
+            )
+        )
+        self.mqtt_bytes = add(
+            Counter(
+                'victron_mqtt_payload_bytes_total',
+                f'Published MQTT payload bytes per device ("{OTHER_ADDRESS}": not device related)',
+                labelnames=('address',),
+            )
+        )
+        self.loop_lag = add(
+            Histogram('victron_event_loop_lag_seconds', 'Delay of the asyncio event loop', buckets=LOOP_LAG_BUCKETS)
+        ).value
+
+        self.devices = {}  # BLE address -> DeviceMetrics, removed together with the RSSI info of the publisher
+        self.other_mqtt_messages = self.mqtt_messages.labels(OTHER_ADDRESS)
+        self.other_mqtt_bytes = self.mqtt_bytes.labels(OTHER_ADDRESS)
+
+        self.sent_messages = 0  # Last seen MQTT client counters, see: count_mqtt()
+        self.sent_bytes = 0
+
+    def bind(self, *, publisher, transport) -> None:
+        """
+        Collect the statistics of the MqttPublisher and the MQTT transport, when the metrics are scraped.
+        """
+        add = self.registry.add
+        add(
+            CallbackMetric(
+                'victron_ble_frames_total',
+                'Frames of known devices by result',
+                metric_type='counter',
+                labelnames=('result',),
+                func=lambda: {
+                    'decrypted': self.frames_decrypted.value,
+                    'deduplicated': publisher.frame_cache.hits,
+                    'throttled': publisher.scheduler.dropped_total.total(),
+                },
+            )
+        )
+        add(
+            CallbackMetric(
+                'victron_ble_discovery_errors_total',
+                'Failed trial decryptions of new devices',
+                metric_type='counter',
+                labelnames=('error',),
+                func=lambda: {
+                    'key_mismatch': publisher.device_handler.key_mismatches,
+                    'parse_error': publisher.device_handler.parse_errors,
+                },
+            )
+        )
+        add(
+            CallbackMetric(
+                'victron_ble_rejected_addresses_total',
+                'Ignored BLE addresses: Unknown device type or no matching key',
+                metric_type='counter',
+                func=lambda: publisher.device_handler.rejected_count,
+            )
+        )
+        add(
+            CallbackMetric(
+                'victron_ble_devices',
+                'Known Victron devices',
+                metric_type='gauge',
+                func=lambda: len(publisher.device_handler.devices),
+            )
+        )
+        add(
+            CallbackMetric(
+                'victron_mqtt_pending_messages',
+                'MQTT messages not yet published to the broker',
+                metric_type='gauge',
+                func=lambda: transport.client.pending,
+            )
+        )
+        add(
+            CallbackMetric(
+                'victron_mqtt_disconnects_total',
+                'MQTT broker disconnects',
+                metric_type='counter',
+                func=lambda: transport.disconnects,
+            )
+        )
+
+    def get_device(self, address: str) -> DeviceMetrics:
+        """
+        Returns the pre-bound values of one BLE address.
+        """
+        try:
+            return self.devices[address]
+        except KeyError:
+            device_metrics = self.devices[address] = DeviceMetrics(
+                advertisements=self.device_advertisements.labels(address),
+                mqtt_messages=self.mqtt_messages.labels(address),
+                mqtt_bytes=self.mqtt_bytes.labels(address),
+            )
+            return device_metrics
+
+    def count_mqtt(self, device_metrics: DeviceMetrics | None, *, messages: int, payload_bytes: int) -> None:
+        """
+        Assign the MQTT messages since the last call to the given device (None: to OTHER_ADDRESS).
+        `messages` and `payload_bytes` are the total counters of the MQTT client.
+        Call it with None before a device publishes, to separate e.g.: the gateway election messages.
+        """
+        if device_metrics is None:
+            self.other_mqtt_messages.inc(messages - self.sent_messages)
+            self.other_mqtt_bytes.inc(payload_bytes - self.sent_bytes)
+        else:
+            device_metrics.mqtt_messages.inc(messages - self.sent_messages)
+            device_metrics.mqtt_bytes.inc(payload_bytes - self.sent_bytes)
+        self.sent_messages = messages
+        self.sent_bytes = payload_bytes
+
+    def remove_address(self, address: str) -> None:
+        """
+        Forget the metrics of a BLE address, e.g.: if it was not seen for a long time.
+        """
+        self.devices.pop(address, None)
+        self.device_advertisements.remove(address)
+        self.mqtt_messages.remove(address)
+        self.mqtt_bytes.remove(address)
+
+    async def measure_loop_lag(self, *, interval: float = LOOP_LAG_INTERVAL) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(0.0, loop.time() - start - interval))
+
+
+async def handle_request(registry: MetricsRegistry, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():  # Skip the headers
+            pass
+
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', registry.render().encode()
+        else:
+            status, body = '404 Not Found', b'Use /metrics\n'
+
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode()
+            + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError) as err:
+        logger.debug('Metrics request failed: %s', err)
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(registry: MetricsRegistry, *, host: str, port: int) -> asyncio.Server:
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_request(registry, reader, writer),
+        host=host,
+        port=port,
+    )
+    logger.info('Serve metrics on http://%s:%i/metrics', host, port)
+    return server
+
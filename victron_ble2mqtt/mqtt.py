@@ -1,23 +1,152 @@
+import json
 import logging
 import socket
+import time
+from collections.abc import Callable
 
 from bleak import BLEDevice
+from ha_services.mqtt4homeassistant.components import NO_STATE, get_origin_data
 from ha_services.mqtt4homeassistant.components.sensor import Sensor
-from ha_services.mqtt4homeassistant.device import MainMqttDevice, MqttDevice
-from paho.mqtt.client import Client
+from ha_services.mqtt4homeassistant.data_classes import ComponentConfig
+from ha_services.mqtt4homeassistant.device import BaseMqttDevice, MainMqttDevice, MqttDevice
+from paho.mqtt.client import MQTT_ERR_SUCCESS, Client, MQTTMessage, MQTTMessageInfo
 from victron_ble.devices import BatteryMonitor, Device, SolarCharger
 
 import victron_ble2mqtt
-from victron_ble2mqtt.user_settings import UserSettings
+from victron_ble2mqtt.aggregation import WindowStats
+from victron_ble2mqtt.change_detection import ChangeFilter
+from victron_ble2mqtt.energy import EnergyIntegrator, EnergyStore
+from victron_ble2mqtt.registry import ExpiringRegistry
+from victron_ble2mqtt.sensors import SensorSpec, SpecSensor, get_statistic_specs
+from victron_ble2mqtt.user_settings import ChangeDetectionSettings, UserSettings
 from victron_ble2mqtt.victron_ble_utils import GenericDevice
 
 
 logger = logging.getLogger(__name__)
 
+HA_BIRTH_PAYLOAD = 'online'
+DISCOVERY_ONCE = 365 * 24 * 60 * 60  # Config throttle, if the configs are only republished on HA birth messages
+
+
+def get_config_throttle_sec(user_settings: UserSettings) -> int:
+    """
+    >>> get_config_throttle_sec(UserSettings())
+    31536000
+    >>> get_config_throttle_sec(UserSettings(ha_status_topic=''))
+    20
+    """
+    if user_settings.ha_status_topic:
+        return DISCOVERY_ONCE
+    return user_settings.mqtt.publish_config_throttle_seconds
+
+
+def add_on_connect(mqtt_client: Client, callback: Callable) -> None:
+    """
+    Call `callback` on every (re)connect, after the already set on_connect callback.
+    """
+    on_connect = mqtt_client.on_connect
+
+    def chained_on_connect(client: Client, *args):
+        if on_connect is not None:
+            on_connect(client, *args)
+        callback(client, *args)
+
+    mqtt_client.on_connect = chained_on_connect
+
+
+def add_subscription(mqtt_client: Client, topic: str, callback: Callable) -> None:
+    """
+    Route the messages of `topic` to `callback`. Must be called before the client connects:
+    The subscription is renewed on every (re)connect.
+    """
+    mqtt_client.message_callback_add(topic, callback)
+    add_on_connect(mqtt_client, lambda client, *args: client.subscribe(topic))
+
+
+def is_sent(info: MQTTMessageInfo | None) -> bool:
+    """
+    Was the message handed over to the MQTT client? e.g.: paho drops QoS 0 messages, while it's not connected.
+    Fake clients like MqttClientMock return None.
+
+    >>> is_sent(MQTTMessageInfo(1))
+    True
+    >>> from paho.mqtt.client import MQTT_ERR_NO_CONN
+    >>> info = MQTTMessageInfo(2)
+    >>> info.rc = MQTT_ERR_NO_CONN
+    >>> is_sent(info)
+    False
+    """
+    return info is None or info.rc == MQTT_ERR_SUCCESS
+
+
+def get_device_config_topic(device: MqttDevice) -> str:
+    """
+    The topic of the device-based discovery message, that announces all sensors of one device.
+    """
+    return f'{device.topic_prefix}/device/{device.uid}/config'
+
+
+def get_device_component_config(component: Sensor) -> dict:
+    """
+    The config of one component inside a device-based discovery message:
+    Without the device information, without unset values and with "~" as abbreviation of the topic prefix.
+    """
+    payload = component.get_config().payload
+    del payload['device']
+    payload['p'] = payload.pop('component')  # "platform"
+    payload['~'] = component.topic_prefix
+    for key, value in payload.items():
+        if isinstance(value, str) and value.startswith(f'{component.topic_prefix}/'):
+            payload[key] = value.replace(component.topic_prefix, '~', 1)
+    return {key: value for key, value in payload.items() if value is not None}
+
+
+def get_json_state_topic(device: MqttDevice) -> str:
+    """
+    The topic of the JSON state messages, that contains the values of all sensors of one device.
+    """
+    return f'{device.topic_prefix}/sensor/{device.uid}/state'
+
+
+class JsonStateSensor(SpecSensor):
+    """
+    A sensor that gets his value from the JSON state message of the device, see: BaseHandler.publish_json_state()
+    """
+
+    @property
+    def json_key(self) -> str:
+        return self.spec.uid
+
+    def get_config(self) -> ComponentConfig:
+        config = super().get_config()
+        config.payload['state_topic'] = get_json_state_topic(self.device)
+        config.payload['value_template'] = f'{{{{ value_json.{self.json_key} }}}}'
+        return config
+
+
+def get_energy_spec(*, name: str, uid: str) -> SensorSpec:
+    return SensorSpec(
+        name=name,
+        uid=uid,
+        device_class='energy',
+        state_class='total_increasing',
+        unit_of_measurement='Wh',
+        suggested_display_precision=1,
+    )
+
 
 class BaseHandler:
     VictronDeviceClass = None
 
+    RSSI_SENSOR = SensorSpec(name='RSSI', uid='rssi', state_class='measurement')
+
+    # The sensors of the values in the data dict, shared by all devices of this model:
+    SENSORS = ()
+
+    # The energy sensors of the derived power values, see: get_power_values()
+    # (power key, EnergyIntegrator counter, SensorSpec)
+    ENERGY_SENSORS = ()
+
     def __init__(
         self,
         *,
@@ -26,18 +155,45 @@ class BaseHandler:
         victron_device: Device,
         mqtt_client: Client,
         user_settings: UserSettings,
+        energy_store: EnergyStore | None = None,
     ):
         self.ble_device = ble_device
         self.main_mqtt_device = main_mqtt_device
         self.victron_device = victron_device
         self.mqtt_client = mqtt_client
         self.user_settings = user_settings
+        self.energy_store = energy_store
 
         self.device = None
+        self.setup_data = None  # The data dict of the first frame, see: DeviceCache
         self.rssi_sensor = None
         self.sensors = {}
+        self.change_filters = {}  # Sensor uid -> ChangeFilter
+
+        if user_settings.json_state:
+            self.sensor_class = JsonStateSensor
+            self.json_state = {}  # Last values of all sensors
+            self.json_state_changed = False
+            self.json_state_commits = {}  # Sensor uid -> (ChangeFilter, value), committed after the publish
+        else:
+            self.sensor_class = SpecSensor
+            self.json_state = None
+
+        self.device_discovery = user_settings.device_discovery
+        self.announced_uids = set()  # Sensors in the last device discovery message
+        self.device_config_changed = False
+        self.next_device_config_publish = 0
+
+        self.aggregation_window = user_settings.aggregation_window_seconds
+        self.window = {}  # Sensor uid -> (Sensor, WindowStats) of the current aggregation window
+        self.statistic_sensors = {}  # Sensor uid -> {statistic name: Sensor}
+        self.window_end = 0  # The first values are published directly
+
+        self.power_integrators = {}  # Power key -> EnergyIntegrator
+        self.energy_sensors = {}  # Sensor uid -> Sensor
 
     def setup(self, *, data_dict):
+        self.setup_data = data_dict
         mac_address = self.ble_device.address
         uid = mac_address.lower().replace(':', '')
         self.device = MqttDevice(
@@ -46,13 +202,270 @@ class BaseHandler:
             uid=uid,
             manufacturer='Victron Energy',
             model=data_dict['model_name'],  # e.g.: 'SmartSolar MPPT 100|20 48V' | 'SmartShunt 500A/50mV',
+            config_throttle_sec=get_config_throttle_sec(self.user_settings),
         )
-        self.rssi_sensor = Sensor(
-            device=self.device,
-            name='RSSI',
-            uid='rssi',
-            state_class='measurement',
+        self.rssi_sensor = self.create_sensor(self.RSSI_SENSOR)
+        self.sensors = {spec.key: self.create_sensor(spec) for spec in self.SENSORS}
+
+    def create_sensor(self, spec: SensorSpec) -> SpecSensor:
+        return self.sensor_class(device=self.device, spec=spec)
+
+    def remove(self) -> None:
+        """
+        Unregister all MQTT components of this device, e.g.: if the device was not seen for a long time.
+        """
+        if self.device is None:
+            return
+
+        prefix = f'{self.device.uid}-'
+        for uid in [uid for uid in BaseMqttDevice.components if uid.startswith(prefix)]:
+            del BaseMqttDevice.components[uid]
+        logger.info('Removed MQTT device %s', self.device.uid)
+        self.device = None
+        self.change_filters.clear()
+        self.announced_uids.clear()
+        self.next_device_config_publish = 0
+        self.window.clear()
+        self.statistic_sensors.clear()
+        self.window_end = 0
+        self.power_integrators.clear()  # The counters are still in the energy store
+        self.energy_sensors.clear()
+        if self.json_state is not None:
+            self.json_state.clear()
+            self.json_state_commits.clear()
+
+    def get_change_filter(self, sensor: Sensor) -> ChangeFilter | None:
+        settings: ChangeDetectionSettings = self.user_settings.change_detection
+        if not settings.enabled:
+            return None
+
+        try:
+            return self.change_filters[sensor.uid]
+        except KeyError:
+            change_filter = self.change_filters[sensor.uid] = ChangeFilter(
+                precision=sensor.suggested_display_precision,
+                absolute=settings.absolute_deadband,
+                relative=settings.relative_deadband,
+                max_silence=settings.max_silence_seconds,
+            )
+            return change_filter
+
+    def is_heartbeat_due(self) -> bool:
+        """
+        Must the unchanged values be published again? See: "max_silence_seconds" setting
+        """
+        return any(change_filter.is_heartbeat_due() for change_filter in self.change_filters.values())
+
+    def publish_sensor_config(self, sensor: Sensor) -> None:
+        if not self.device_discovery:
+            if not is_sent(sensor.publish_config(self.mqtt_client)):
+                sensor._next_config_publish = 0  # Not connected: Don't wait for the config throttle
+        elif sensor.uid not in self.announced_uids:
+            # Announce the new sensor with the next device discovery message:
+            self.announced_uids.add(sensor.uid)
+            self.device_config_changed = True
+
+    def get_device_config(self) -> ComponentConfig:
+        components = {uid: get_device_component_config(BaseMqttDevice.components[uid]) for uid in self.announced_uids}
+        return ComponentConfig(
+            topic=get_device_config_topic(self.device),
+            payload={
+                'dev': dict(self.device.get_mqtt_payload()),
+                'o': get_origin_data(),
+                'cmps': dict(sorted(components.items())),
+            },
+        )
+
+    def publish_device_config(self, *, force: bool = False) -> bool:
+        """
+        Publish one discovery message for all sensors of this device, if new sensors are set.
+        Only used if the "device_discovery" setting is enabled. Returns True, if the config was published.
+        """
+        if not self.device_discovery or self.device is None:
+            return False
+
+        now = time.monotonic()
+        if not (force or self.device_config_changed or now >= self.next_device_config_publish):
+            return False
+
+        config = self.get_device_config()
+        logger.info('Publishing %s device config with %i components', self.device.uid, len(config.payload['cmps']))
+        info = self.mqtt_client.publish(
+            topic=config.topic,
+            payload=json.dumps(config.payload, ensure_ascii=False),
+            qos=config.qos,
+            retain=config.retain,
         )
+        if not is_sent(info):
+            return False  # Not connected: Retry with the next frame
+
+        self.device_config_changed = False
+        self.next_device_config_publish = now + get_config_throttle_sec(self.user_settings)
+        return True
+
+    def publish_sensor(self, sensor: Sensor, value) -> None:
+        """
+        Publish the new value, or collect it until the end of the aggregation window.
+        """
+        if self.aggregation_window:
+            try:
+                _, stats = self.window[sensor.uid]
+            except KeyError:
+                stats = WindowStats()
+                self.window[sensor.uid] = (sensor, stats)
+            stats.add(value)
+        else:
+            self.publish_value(sensor, value)
+
+    def publish_value(self, sensor: Sensor, value) -> None:
+        """
+        Set the new state and publish it, if the value has changed.
+        """
+        change_filter = self.get_change_filter(sensor)
+        changed = change_filter is None or change_filter.should_publish(value)
+
+        if self.json_state is not None:
+            # Collect the value for publish_json_state():
+            sensor.set_state(value)
+            self.publish_sensor_config(sensor)
+            self.json_state[sensor.json_key] = value
+            if changed:
+                self.json_state_changed = True
+                if change_filter is not None:
+                    self.json_state_commits[sensor.uid] = (change_filter, value)
+            return
+
+        if not changed:
+            logger.debug('Skip unchanged %s: %r', sensor.uid, value)
+            return
+
+        sensor.set_state(value)
+        self.publish_sensor_config(sensor)
+        if change_filter is None:
+            sensor.publish_state(self.mqtt_client)
+            return
+
+        sensor._next_publish = 0  # The change filter decides, not the state throttle of the component
+        if is_sent(sensor.publish_state(self.mqtt_client)):
+            change_filter.commit(value)
+
+    def get_statistic_sensors(self, sensor: SpecSensor) -> dict[str, SpecSensor]:
+        """
+        Returns the extra sensors for the window statistics of the given sensor, e.g.: "current_max"
+        """
+        try:
+            return self.statistic_sensors[sensor.uid]
+        except KeyError:
+            sensors = self.statistic_sensors[sensor.uid] = {
+                name: self.create_sensor(spec) for name, spec in get_statistic_specs(sensor.spec).items()
+            }
+            return sensors
+
+    def publish_window(self) -> bool:
+        """
+        Publish the last values and the mean/min/max of all measurements at the end of the aggregation window.
+        Only used if the "aggregation_window_seconds" setting is set. Returns True, if the window was published.
+        """
+        if not self.aggregation_window or not self.window:
+            return False
+
+        now = time.monotonic()
+        if now < self.window_end:
+            return False
+
+        for sensor, stats in self.window.values():
+            self.publish_value(sensor, stats.last)
+            if sensor.state_class == 'measurement' and (statistics := stats.get_statistics()):
+                statistic_sensors = self.get_statistic_sensors(sensor)
+                for name, value in statistics.items():
+                    self.publish_value(statistic_sensors[name], value)
+
+        self.window.clear()
+        self.window_end = now + self.aggregation_window
+        return True
+
+    def get_power_values(self, data_dict: dict) -> dict[str, float]:
+        """
+        Returns the derived power values (W) of one frame, e.g.: {'power': 12.3}
+        """
+        return {}
+
+    def get_power_integrator(self, key: str) -> EnergyIntegrator:
+        try:
+            return self.power_integrators[key]
+        except KeyError:
+            integrator = self.power_integrators[key] = self.energy_store.get_integrator(f'{self.device.uid}-{key}')
+            return integrator
+
+    def integrate_power(self, data_dict: dict) -> None:
+        """
+        Add the power values of one frame to the energy counters. Called for every decoded frame,
+        also if the frame is not published because of "publish_throttle_seconds".
+        """
+        if self.energy_store is None or self.device is None:
+            return
+
+        now = time.monotonic()
+        for key, power in self.get_power_values(data_dict).items():
+            self.get_power_integrator(key).add(power, now=now)
+
+    def extend_power(self) -> None:
+        """
+        The device sends the same frame again: The power values are unchanged.
+        """
+        if self.power_integrators:
+            now = time.monotonic()
+            for integrator in self.power_integrators.values():
+                integrator.extend(now=now)
+
+    def publish_energy(self) -> None:
+        for key, counter, spec in self.ENERGY_SENSORS:
+            if (integrator := self.power_integrators.get(key)) is None:
+                continue
+
+            try:
+                sensor = self.energy_sensors[spec.uid]
+            except KeyError:
+                sensor = self.energy_sensors[spec.uid] = self.create_sensor(spec)
+            self.publish_sensor(sensor, round(getattr(integrator, counter), 3))
+
+    def publish_json_state(self) -> None:
+        """
+        Publish the values of all sensors as one JSON message, if at least one value has changed.
+        Only used if the "json_state" setting is enabled.
+        """
+        if self.json_state is None or not self.json_state_changed:
+            return
+
+        info = self.mqtt_client.publish(
+            topic=get_json_state_topic(self.device),
+            payload=json.dumps(self.json_state),
+        )
+        if not is_sent(info):
+            return  # Try again with the next frame
+
+        for change_filter, value in self.json_state_commits.values():
+            change_filter.commit(value)
+        self.json_state_commits.clear()
+        self.json_state_changed = False
+
+    def republish_states(self) -> None:
+        """
+        Publish the last known values again, e.g.: Home Assistant was restarted and has lost the states.
+        """
+        if self.device is None:
+            return
+
+        if self.json_state is not None:
+            self.json_state_changed = True
+            self.publish_json_state()
+            return
+
+        prefix = f'{self.device.uid}-'
+        for uid, sensor in list(BaseMqttDevice.components.items()):
+            if uid.startswith(prefix) and sensor.state is not NO_STATE:
+                sensor._next_publish = 0  # Bypass the state throttle
+                sensor.publish_state(self.mqtt_client)
 
     def publish(self, *, data_dict: dict, rssi: int | None) -> None:
         if self.device is None:
@@ -60,16 +473,14 @@ class BaseHandler:
 
         self.main_mqtt_device.poll_and_publish(self.mqtt_client)
 
-        self.rssi_sensor.set_state(rssi)
-        self.rssi_sensor.publish(self.mqtt_client)
+        self.publish_sensor(self.rssi_sensor, rssi)
 
         for key, value in data_dict.items():
             if key == 'model_name':
                 continue
 
             if sensor := self.sensors.get(key):
-                sensor.set_state(value)
-                sensor.publish(self.mqtt_client)
+                self.publish_sensor(sensor, value)
             else:
                 logger.warning(f'No sensor for key: {key}')
 
@@ -111,6 +522,97 @@ def calc_midpoint_shift_percent(voltage: float, midpoint_voltage: float) -> floa
 
 class BatteryMonitorHandler(BaseHandler):
     VictronDeviceClass = BatteryMonitor
+    SENSORS = (
+        SensorSpec(name='Auxiliary Mode', uid='aux_mode'),
+        #
+        # Note: HA doesn't have 'Ah' as unit!
+        # See:
+        # * https://community.home-assistant.io/t/energy-total-ah-not-supported-what-to-use/934286
+        # * https://github.com/home-assistant/architecture/discussions/1052
+        # So don't set device_class yet:
+        SensorSpec(
+            name='Consumed Ah',
+            uid='consumed_ah',
+            # device_class='energy',
+            state_class='total',
+            unit_of_measurement='Ah',
+            suggested_display_precision=1,
+        ),
+        SensorSpec(
+            name='Current',
+            uid='current',
+            device_class='current',
+            state_class='measurement',
+            unit_of_measurement='A',
+            suggested_display_precision=3,
+        ),
+        SensorSpec(
+            name='Midpoint Voltage',
+            uid='midpoint_voltage',
+            device_class='voltage',
+            state_class='measurement',
+            unit_of_measurement='V',
+            suggested_display_precision=2,
+        ),
+        SensorSpec(
+            name='Temperature',
+            uid='temperature',
+            device_class='temperature',
+            state_class='measurement',
+            unit_of_measurement='°C',
+            suggested_display_precision=1,
+        ),
+        SensorSpec(
+            name='Remaining Minutes',
+            uid='remaining_mins',
+            device_class='duration',
+            state_class='measurement',
+            unit_of_measurement='min',
+        ),
+        SensorSpec(
+            name='State of Charge',
+            uid='soc',
+            device_class='battery',
+            state_class='measurement',
+            unit_of_measurement='%',
+            suggested_display_precision=1,
+        ),
+        SensorSpec(
+            name='Voltage',
+            uid='voltage',
+            device_class='voltage',
+            state_class='measurement',
+            unit_of_measurement='V',
+            suggested_display_precision=2,
+        ),
+    )
+    POWER_SENSOR = SensorSpec(
+        name='Power',
+        uid='power',
+        device_class='power',
+        state_class='measurement',
+        unit_of_measurement='W',
+        suggested_display_precision=2,
+    )
+    MIDPOINT_SHIFT_SENSOR = SensorSpec(
+        name='Midpoint Shift',
+        uid='midpoint_shift',
+        device_class='voltage',
+        state_class='measurement',
+        unit_of_measurement='V',
+        suggested_display_precision=2,
+    )
+    MIDPOINT_SHIFT_PERCENT_SENSOR = SensorSpec(
+        name='Midpoint Shift',
+        uid='midpoint_shift_percent',
+        state_class='measurement',
+        unit_of_measurement='%',
+        suggested_display_precision=2,
+    )
+    ENERGY_SENSORS = (
+        ('power', 'positive_wh', get_energy_spec(name='Charged Energy', uid='charged_energy')),
+        ('power', 'negative_wh', get_energy_spec(name='Discharged Energy', uid='discharged_energy')),
+    )
     # example_data = {
     #     'aux_mode': 'midpoint_voltage',
     #     'consumed_ah': 0.0,
@@ -126,135 +628,106 @@ class BatteryMonitorHandler(BaseHandler):
     def setup(self, *, data_dict):
         super().setup(data_dict=data_dict)
 
-        # Check available combinations here:
-        # https://developers.home-assistant.io/docs/core/entity/sensor/#available-device-classes
-        self.sensors = {
-            'aux_mode': Sensor(
-                device=self.device,
-                name='Auxiliary Mode',
-                uid='aux_mode',
-            ),
-            #
-            # Note: HA doesn't have 'Ah' as unit!
-            # See:
-            # * https://community.home-assistant.io/t/energy-total-ah-not-supported-what-to-use/934286
-            # * https://github.com/home-assistant/architecture/discussions/1052
-            # So don't set device_class yet:
-            'consumed_ah': Sensor(
-                device=self.device,
-                name='Consumed Ah',
-                uid='consumed_ah',
-                # device_class='energy',
-                state_class='total',
-                unit_of_measurement='Ah',
-                suggested_display_precision=1,
-            ),
-            'current': Sensor(
-                device=self.device,
-                name='Current',
-                uid='current',
-                device_class='current',
-                state_class='measurement',
-                unit_of_measurement='A',
-                suggested_display_precision=3,
-            ),
-            'midpoint_voltage': Sensor(
-                device=self.device,
-                name='Midpoint Voltage',
-                uid='midpoint_voltage',
-                device_class='voltage',
-                state_class='measurement',
-                unit_of_measurement='V',
-                suggested_display_precision=2,
-            ),
-           'temperature': Sensor(
-                device=self.device,
-                name='Temperature',
-                uid='temperature',
-                device_class='temperature',
-                state_class='measurement',
-                unit_of_measurement='°C',
-                suggested_display_precision=1,
-            ),
-            'remaining_mins': Sensor(
-                device=self.device,
-                name='Remaining Minutes',
-                uid='remaining_mins',
-                device_class='duration',
-                state_class='measurement',
-                unit_of_measurement='min',
-            ),
-            'soc': Sensor(
-                device=self.device,
-                name='State of Charge',
-                uid='soc',
-                device_class='battery',
-                state_class='measurement',
-                unit_of_measurement='%',
-                suggested_display_precision=1,
-            ),
-            'voltage': Sensor(
-                device=self.device,
-                name='Voltage',
-                uid='voltage',
-                device_class='voltage',
-                state_class='measurement',
-                unit_of_measurement='V',
-                suggested_display_precision=2,
-            ),
-        }
-        ####################################################################################
-        # Extra sensors
-
-        self.power_sensor = Sensor(
-            device=self.device,
-            name='Power',
-            uid='power',
-            device_class='power',
-            state_class='measurement',
-            unit_of_measurement='W',
-            suggested_display_precision=2,
-        )
-
+        # Extra sensors:
+        self.power_sensor = self.create_sensor(self.POWER_SENSOR)
         if data_dict.get('aux_mode', None) == 'midpoint_voltage':
-            self.midpoint_shift = Sensor(
-                device=self.device,
-                name='Midpoint Shift',
-                uid='midpoint_shift',
-                device_class='voltage',
-                state_class='measurement',
-                unit_of_measurement='V',
-                suggested_display_precision=2,
-            )
-            self.midpoint_shift_percent = Sensor(
-                device=self.device,
-                name='Midpoint Shift',
-                uid='midpoint_shift_percent',
-                state_class='measurement',
-                unit_of_measurement='%',
-                suggested_display_precision=2,
-            )
+            self.midpoint_shift = self.create_sensor(self.MIDPOINT_SHIFT_SENSOR)
+            self.midpoint_shift_percent = self.create_sensor(self.MIDPOINT_SHIFT_PERCENT_SENSOR)
+
+    def get_power_values(self, data_dict: dict) -> dict[str, float]:
+        voltage = data_dict.get('voltage')
+        if voltage is not None and (current := data_dict.get('current')) is not None:
+            # Note: e.g.: BatterySense (a BatteryMonitor subclass) has no current
+            return {'power': voltage * current}
+        return {}
 
     def publish(self, *, data_dict: dict, rssi: int | None) -> None:
         super().publish(data_dict=data_dict, rssi=rssi)
 
         # Extra sensors
 
-        self.power_sensor.set_state(data_dict['voltage'] * data_dict['current'])
-        self.power_sensor.publish(self.mqtt_client)
+        if (power := self.get_power_values(data_dict).get('power')) is not None:
+            self.publish_sensor(self.power_sensor, power)
 
         if data_dict.get('aux_mode', None) == 'midpoint_voltage':
             midpoint_shift = calc_midpoint_shift(data_dict['voltage'], data_dict['midpoint_voltage'])
-            self.midpoint_shift.set_state(midpoint_shift)
-            self.midpoint_shift.publish(self.mqtt_client)
+            self.publish_sensor(self.midpoint_shift, midpoint_shift)
 
             midpoint_shift_percent = calc_midpoint_shift_percent(data_dict['voltage'], data_dict['midpoint_voltage'])
-            self.midpoint_shift_percent.set_state(midpoint_shift_percent)
-            self.midpoint_shift_percent.publish(self.mqtt_client)
+            self.publish_sensor(self.midpoint_shift_percent, midpoint_shift_percent)
 
 
 class SolarChargerHandler(BaseHandler):
     VictronDeviceClass = SolarCharger
+    SENSORS = (
+        SensorSpec(
+            name='Battery Charging',
+            uid='battery_charging_current',
+            device_class='current',
+            state_class='measurement',
+            unit_of_measurement='A',
+            suggested_display_precision=1,
+            # Max current is 20A (just add a buffer):
+            min_value=-20 * 1.1,
+            max_value=20 + 1.1,
+        ),
+        SensorSpec(
+            name='Battery',
+            uid='battery_voltage',
+            device_class='voltage',
+            state_class='measurement',
+            unit_of_measurement='V',
+            suggested_display_precision=2,
+            min_value=0,
+            max_value=48 * 1.2,  # 48V + buffer
+        ),
+        SensorSpec(name='Charge State', uid='charge_state'),
+        SensorSpec(
+            name='Load',
+            uid='load',
+            data_key='external_device_load',
+            device_class='current',
+            state_class='measurement',
+            unit_of_measurement='A',
+            suggested_display_precision=1,
+        ),
+        SensorSpec(
+            name='Solar',
+            uid='solar_power',
+            device_class='power',
+            state_class='measurement',
+            unit_of_measurement='W',
+            suggested_display_precision=0,
+        ),
+        SensorSpec(
+            name='Yield Today',
+            uid='yield_today',
+            device_class='energy',
+            state_class='total',
+            unit_of_measurement='Wh',
+            suggested_display_precision=0,
+        ),
+    )
+    CHARGING_POWER_SENSOR = SensorSpec(
+        name='Charging Power',
+        uid='charging_power',
+        device_class='power',
+        state_class='measurement',
+        unit_of_measurement='W',
+        suggested_display_precision=1,
+    )
+    LOAD_POWER_SENSOR = SensorSpec(
+        name='Load Power',
+        uid='load_power',
+        device_class='power',
+        state_class='measurement',
+        unit_of_measurement='W',
+        suggested_display_precision=1,
+    )
+    ENERGY_SENSORS = (
+        ('charging_power', 'positive_wh', get_energy_spec(name='Charging Energy', uid='charging_energy')),
+        ('load_power', 'positive_wh', get_energy_spec(name='Load Energy', uid='load_energy')),
+    )
     # example_data = {
     #     'battery_charging_current': 0.8,
     #     'battery_voltage': 25.91,
@@ -269,95 +742,32 @@ class SolarChargerHandler(BaseHandler):
     def setup(self, *, data_dict):
         super().setup(data_dict=data_dict)
 
-        self.sensors = {
-            'battery_charging_current': Sensor(
-                device=self.device,
-                name='Battery Charging',
-                uid='battery_charging_current',
-                device_class='current',
-                state_class='measurement',
-                unit_of_measurement='A',
-                suggested_display_precision=1,
-                # Max current is 20A (just add a buffer):
-                min_value=-20 * 1.1,
-                max_value=20 + 1.1,
-            ),
-            'battery_voltage': Sensor(
-                device=self.device,
-                name='Battery',
-                uid='battery_voltage',
-                device_class='voltage',
-                state_class='measurement',
-                unit_of_measurement='V',
-                suggested_display_precision=2,
-                min_value=0,
-                max_value=48 * 1.2,  # 48V + buffer
-            ),
-            'charge_state': Sensor(
-                device=self.device,
-                uid='charge_state',
-                name='Charge State',
-            ),
-            'external_device_load': Sensor(
-                device=self.device,
-                name='Load',
-                uid='load',
-                device_class='current',
-                state_class='measurement',
-                unit_of_measurement='A',
-                suggested_display_precision=1,
-            ),
-            'solar_power': Sensor(
-                device=self.device,
-                name='Solar',
-                uid='solar_power',
-                device_class='power',
-                state_class='measurement',
-                unit_of_measurement='W',
-                suggested_display_precision=0,
-            ),
-            'yield_today': Sensor(
-                device=self.device,
-                name='Yield Today',
-                uid='yield_today',
-                device_class='energy',
-                state_class='total',
-                unit_of_measurement='Wh',
-                suggested_display_precision=0,
-            ),
-        }
-        ####################################################################################
-        # Extra sensors
+        # Extra sensors:
+        self.charging_power = self.create_sensor(self.CHARGING_POWER_SENSOR)
+        self.load_power = self.create_sensor(self.LOAD_POWER_SENSOR)
 
-        self.charging_power = Sensor(
-            device=self.device,
-            name='Charging Power',
-            uid='charging_power',
-            device_class='power',
-            state_class='measurement',
-            unit_of_measurement='W',
-            suggested_display_precision=1,
-        )
-        self.load_power = Sensor(
-            device=self.device,
-            name='Load Power',
-            uid='load_power',
-            device_class='power',
-            state_class='measurement',
-            unit_of_measurement='W',
-            suggested_display_precision=1,
-        )
+    def get_power_values(self, data_dict: dict) -> dict[str, float]:
+        battery_voltage = data_dict.get('battery_voltage')
+        if battery_voltage is None:
+            return {}
+
+        power_values = {}
+        if (charging_current := data_dict.get('battery_charging_current')) is not None:
+            power_values['charging_power'] = battery_voltage * charging_current
+        if (load_current := data_dict.get('external_device_load')) is not None:  # Not all devices have a load output
+            power_values['load_power'] = battery_voltage * load_current
+        return power_values
 
     def publish(self, *, data_dict: dict, rssi: int | None) -> None:
         super().publish(data_dict=data_dict, rssi=rssi)
 
         # Extra sensors
 
-        self.charging_power.set_state(data_dict['battery_voltage'] * data_dict['battery_charging_current'])
-        self.charging_power.publish(self.mqtt_client)
-
-        self.load_power.set_state(data_dict['battery_voltage'] * data_dict['external_device_load'])
-        self.load_power.publish(self.mqtt_client)
+        power_values = self.get_power_values(data_dict)
+        if (charging_power := power_values.get('charging_power')) is not None:
+            self.publish_sensor(self.charging_power, charging_power)
+        if (load_power := power_values.get('load_power')) is not None:
+            self.publish_sensor(self.load_power, load_power)
 
 
 class FallbackHandler(BaseHandler):
@@ -372,11 +782,7 @@ class FallbackHandler(BaseHandler):
 
             logger.warning('Setup fallback sensor for: %s', key)
 
-            self.sensors[key] = Sensor(
-                device=self.device,
-                name=key.capitalize(),
-                uid=key,
-            )
+            self.sensors[key] = self.create_sensor(SensorSpec(name=key.capitalize(), uid=key))
 
 
 VICRON_DEVICE_HANDLERS = (
@@ -395,17 +801,120 @@ def get_handler(*, victron_device: Device) -> type[BaseHandler]:
     return FallbackHandler
 
 
+def get_handler_class(name: str) -> type[BaseHandler] | None:
+    """
+    >>> get_handler_class('SolarChargerHandler')
+    <class 'victron_ble2mqtt.mqtt.SolarChargerHandler'>
+    >>> get_handler_class('Unknown') is None
+    True
+    """
+    for HandlerClass in (*VICRON_DEVICE_HANDLERS, FallbackHandler):
+        if HandlerClass.__name__ == name:
+            return HandlerClass
+    return None
+
+
 class VictronMqttDeviceHandler:
-    def __init__(self, *, user_settings: UserSettings):
+    def __init__(self, *, user_settings: UserSettings, energy_store: EnergyStore | None = None):
         self.user_settings = user_settings
+        self.energy_store = energy_store
         self.main_mqtt_device = MainMqttDevice(
             name=f'victron-ble2mqtt@{socket.gethostname()}',
             uid=user_settings.mqtt.main_uid,
             manufacturer='victron-ble2mqtt',
             sw_version=victron_ble2mqtt.__version__,
-            config_throttle_sec=user_settings.mqtt.publish_config_throttle_seconds,
+            config_throttle_sec=get_config_throttle_sec(user_settings),
+        )
+        self.republish_requested = False  # Set from the MQTT network thread, handled in publish()
+        self.handler_map = ExpiringRegistry(
+            name='handlers',
+            ttl=user_settings.device_expire_seconds,
+            on_evict=self.on_handler_evict,
         )
-        self.handler_map = {}
+
+    def on_handler_evict(self, mac_address: str, handler: BaseHandler) -> None:
+        logger.info('Device %s not seen for %i sec.', mac_address, self.handler_map.ttl)
+        handler.remove()
+
+    def subscribe_ha_status(self, mqtt_client: Client) -> None:
+        """
+        Listen to the Home Assistant birth messages. Must be called before the client connects.
+        The discovery is also republished on every (re)connect: paho drops the messages,
+        while it's not connected, e.g.: the configs of the first frames before the CONNACK.
+        """
+        if topic := self.user_settings.ha_status_topic:
+            add_subscription(mqtt_client, topic, self.on_ha_status)
+            add_on_connect(mqtt_client, self.on_connect)
+
+    def on_ha_status(self, client: Client, userdata, message: MQTTMessage) -> None:
+        payload = message.payload.decode(errors='replace')
+        logger.info('Home Assistant status: %r', payload)
+        if payload == HA_BIRTH_PAYLOAD:
+            self.republish_requested = True
+
+    def on_connect(self, client: Client, *args) -> None:
+        self.republish_requested = True
+
+    def handle_birth(self, mqtt_client: Client) -> None:
+        """
+        Republish the discovery after a Home Assistant birth message or a MQTT (re)connect.
+        """
+        if self.republish_requested:
+            self.republish_requested = False
+            self.republish_discovery(mqtt_client)
+
+    def republish_discovery(self, mqtt_client: Client) -> None:
+        """
+        Publish the already announced discovery configs and the last states again.
+        """
+        components = [component for component in BaseMqttDevice.components.values() if component._next_config_publish]
+        logger.info('Republish discovery of %i components', len(components))
+        for component in components:
+            component._next_config_publish = 0  # Bypass the config throttle
+            component.publish_config(mqtt_client)
+
+        for handler in self.handler_map.values():
+            handler.publish_device_config(force=True)
+            handler.republish_states()
+
+    def restore(
+        self,
+        *,
+        ble_device: BLEDevice,
+        victron_device: Device,
+        HandlerClass: type[BaseHandler],
+        setup_data: dict,
+        mqtt_client: Client,
+    ) -> BaseHandler:
+        """
+        Set up the handler of a known device, before the first advertisement arrives.
+        """
+        handler = self.handler_map[ble_device.address] = HandlerClass(
+            ble_device=ble_device,
+            main_mqtt_device=self.main_mqtt_device,
+            victron_device=victron_device,
+            mqtt_client=mqtt_client,
+            user_settings=self.user_settings,
+            energy_store=self.energy_store,
+        )
+        handler.setup(data_dict=setup_data)
+
+        # Render the discovery configs now, so they are ready for the first frame:
+        prefix = f'{handler.device.uid}-'
+        for uid, component in list(BaseMqttDevice.components.items()):
+            if uid.startswith(prefix):
+                component._get_config_kwargs()
+        return handler
+
+    def integrate(self, *, ble_device: BLEDevice, raw_data: bytes, generic_device: GenericDevice) -> bool:
+        """
+        Count the energy of a not published frame. Returns True, if the frame was decrypted.
+        """
+        handler = self.handler_map.get(ble_device.address)
+        if handler is None or self.energy_store is None:
+            return False
+        handler.integrate_power(generic_device.parse(raw_data=raw_data))
+        return True
 
     def publish(
         self,
@@ -418,6 +927,8 @@ class VictronMqttDeviceHandler:
     ) -> None:
         logger.debug('MQTT data from %s', ble_device.name)
 
+        self.handle_birth(mqtt_client)
+
         mac_address = ble_device.address
         try:
             handler = self.handler_map[mac_address]
@@ -429,9 +940,16 @@ class VictronMqttDeviceHandler:
                 victron_device=generic_device.victron_device,
                 mqtt_client=mqtt_client,
                 user_settings=self.user_settings,
+                energy_store=self.energy_store,
             )
 
-        handler.publish(
-            data_dict=generic_device.parse(raw_data=raw_data),
-            rssi=rssi,
-        )
+        data_dict = generic_device.parse(raw_data=raw_data)
+        handler.publish(data_dict=data_dict, rssi=rssi)
+        if self.energy_store is not None:
+            handler.integrate_power(data_dict)
+            handler.publish_energy()
+        handler.publish_window()
+        if handler.publish_device_config():
+            # Home Assistant ignores states of not yet announced sensors:
+            handler.republish_states()
+        handler.publish_json_state()
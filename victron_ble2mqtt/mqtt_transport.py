@@ -0,0 +1,294 @@
+"""
+    MQTT backends for the publish loop.
+
+    The handlers just call `publish()` on a paho client. The transport decides how the network I/O is done:
+
+     * ThreadedMqttTransport: paho's own network thread via loop_start()
+     * AsyncioMqttTransport: paho socket callbacks, driven by the asyncio event loop of bleak
+
+    Both count the sent/published messages, so the publish worker can wait for the broker (backpressure).
+    With a StoreAndForward the not retained messages are stored on disk while the client is not connected.
+    A unreachable broker on startup is not fatal: Both transports retry to connect in the background.
+"""
+
+import asyncio
+import logging
+import threading
+from collections.abc import Callable
+from functools import partial
+
+import paho.mqtt.client as mqtt
+from ha_services.mqtt4homeassistant.data_classes import MqttSettings
+from ha_services.mqtt4homeassistant.mqtt import OnConnectCallback, get_client_id
+
+from victron_ble2mqtt.store_forward import StoreAndForward
+
+
+logger = logging.getLogger(__name__)
+
+TRANSPORT_THREAD = 'thread'
+TRANSPORT_ASYNCIO = 'asyncio'
+
+POLL_INTERVAL = 0.01  # Seconds between checks in flush() and wait_for_capacity()
+MISC_INTERVAL = 1  # Seconds between paho loop_misc() calls (keepalive, reconnect check)
+MAX_RECONNECT_DELAY = 60
+
+
+class TrackingClient(mqtt.Client):
+    """
+    paho client that counts the sent messages. The published ones are counted in the on_publish callback.
+    Note: Every counter has only one writer, so no lock is needed, even with paho's network thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = 0
+        self.sent_bytes = 0  # Payload bytes of the sent messages
+        self.published = 0
+        self.on_publish = self.count_published
+        self.store_forward = None
+
+    def publish(self, topic: str, payload=None, *args, **kwargs) -> mqtt.MQTTMessageInfo:
+        if isinstance(payload, str):
+            payload = payload.encode()  # paho would do the same, but we need the size
+        elif isinstance(payload, int | float):
+            payload = str(payload).encode()
+
+        store_forward = self.store_forward
+        if store_forward is not None and not kwargs.get('retain') and not self.is_connected():
+            # Keep the state for the backfill. Retained messages (e.g.: discovery configs) are sent again anyway.
+            store_forward.store(topic, payload)
+            info = mqtt.MQTTMessageInfo(0)
+            info.rc = mqtt.MQTT_ERR_NO_CONN
+            return info
+
+        info = super().publish(topic, payload, *args, **kwargs)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS or kwargs.get('qos', 0) > 0:
+            # QoS 0 messages are dropped, if not connected. All others are queued by paho.
+            self.sent += 1
+            if payload is not None:
+                self.sent_bytes += len(payload)
+        return info
+
+    def count_published(self, client, userdata, mid, reason_code, properties):
+        self.published += 1
+
+    def reset_pending(self) -> None:
+        """
+        Called on disconnect: Unsent QoS 0 messages are lost, so nobody should wait for them.
+        """
+        self.published = self.sent
+
+    @property
+    def pending(self) -> int:
+        return self.sent - self.published
+
+
+class BaseMqttTransport:
+    name = None
+
+    def __init__(
+        self,
+        *,
+        settings: MqttSettings,
+        verbosity: int,
+        max_pending: int = 1000,
+        store_forward: StoreAndForward | None = None,
+    ):
+        self.settings = settings
+        self.verbosity = verbosity
+        self.max_pending = max_pending
+        self.store_forward = store_forward
+
+        self.client = TrackingClient(mqtt.CallbackAPIVersion.VERSION2, client_id=get_client_id())
+        self.client.store_forward = store_forward
+        self.client.on_connect = OnConnectCallback(verbosity=verbosity)
+        self.client.enable_logger(logger=logger)
+        if settings.user_name and settings.password:
+            self.client.username_pw_set(settings.user_name, settings.password)
+        self.client.on_disconnect = self.on_disconnect
+
+        self.backpressure_waits = 0
+        self.disconnects = 0
+
+    def on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        logger.warning('MQTT disconnected: %s', reason_code)
+        self.disconnects += 1
+        self.client.reset_pending()
+
+    async def start(self) -> None:
+        raise NotImplementedError
+
+    def stop(self) -> None:
+        raise NotImplementedError
+
+    async def flush(self, *, timeout: float = 10) -> bool:
+        """
+        Wait until all sent messages are published. Returns False on timeout.
+        """
+        try:
+            async with asyncio.timeout(timeout):
+                while self.client.pending > 0:
+                    await asyncio.sleep(POLL_INTERVAL)
+        except TimeoutError:
+            logger.warning('MQTT flush timeout: %i messages pending', self.client.pending)
+            return False
+        return True
+
+    async def wait_for_capacity(self) -> None:
+        """
+        Backpressure: Wait while too many messages are not published yet, e.g.: slow broker.
+        """
+        if self.client.pending < self.max_pending:
+            return
+        self.backpressure_waits += 1
+        logger.debug('MQTT backpressure: %i messages pending', self.client.pending)
+        while self.client.pending >= self.max_pending:
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def get_stats(self) -> dict:
+        stats = {
+            'transport': self.name,
+            'sent': self.client.sent,
+            'sent_bytes': self.client.sent_bytes,
+            'published': self.client.published,
+            'pending': self.client.pending,
+            'backpressure_waits': self.backpressure_waits,
+            'disconnects': self.disconnects,
+        }
+        if self.store_forward is not None:
+            stats['store_forward'] = self.store_forward.get_stats()
+        return stats
+
+
+class ThreadedMqttTransport(BaseMqttTransport):
+    name = TRANSPORT_THREAD
+
+    async def start(self) -> None:
+        # The network thread connects and retries, if the broker is not reachable (yet)
+        self.client.connect_async(self.settings.host, port=self.settings.port)
+        self.client.loop_start()
+
+    def stop(self) -> None:
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class AsyncioMqttTransport(BaseMqttTransport):
+    """
+    Run the paho network I/O inside the asyncio event loop, without a extra thread.
+    Based on the paho "loop_asyncio" example: The socket callbacks register
+    the MQTT socket as reader/writer in the event loop.
+    Only the blocking (re)connect runs in the default executor, so a unreachable broker
+    doesn't block the BLE intake for the TCP connect timeout.
+    """
+
+    name = TRANSPORT_ASYNCIO
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.loop = None
+        self.loop_thread_id = None
+        self.misc_task = None
+        self.reconnects = 0
+
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def call_in_loop(self, func: Callable, *args) -> None:
+        """
+        The socket callbacks are called from the executor thread, while (re)connecting.
+        """
+        if threading.get_ident() == self.loop_thread_id:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        logger.debug('MQTT socket opened')
+        self.call_in_loop(self.loop.add_reader, sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        logger.debug('MQTT socket closed')
+        self.call_in_loop(self.loop.remove_reader, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.remove_writer, sock)
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        connect = partial(self.client.connect, self.settings.host, port=self.settings.port)
+        try:
+            await self.loop.run_in_executor(None, connect)
+        except OSError as err:
+            # The connection parameters are set anyway: misc_loop() will reconnect
+            logger.warning('MQTT connect failed: %s', err)
+        self.misc_task = asyncio.ensure_future(self.misc_loop())
+
+    def stop(self) -> None:
+        if self.misc_task:
+            self.misc_task.cancel()
+        self.client.disconnect()
+
+    async def misc_loop(self) -> None:
+        while True:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                await self.reconnect()
+            await asyncio.sleep(MISC_INTERVAL)
+
+    async def reconnect(self) -> None:
+        delay = 1
+        while True:
+            try:
+                await self.loop.run_in_executor(None, self.client.reconnect)
+            except OSError as err:
+                logger.warning('MQTT reconnect failed: %s (Retry in %i sec.)', err, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            else:
+                self.reconnects += 1
+                logger.info('MQTT reconnected')
+                return
+
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        stats['reconnects'] = self.reconnects
+        return stats
+
+
+TRANSPORTS = {
+    TRANSPORT_THREAD: ThreadedMqttTransport,
+    TRANSPORT_ASYNCIO: AsyncioMqttTransport,
+}
+
+
+def get_transport(
+    name: str,
+    *,
+    settings: MqttSettings,
+    verbosity: int,
+    max_pending: int,
+    store_forward: StoreAndForward | None = None,
+) -> BaseMqttTransport:
+    """
+    >>> get_transport('foo', settings=MqttSettings(), verbosity=0, max_pending=1)
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown MQTT transport: 'foo' (Use one of: thread, asyncio)
+    """
+    try:
+        TransportClass = TRANSPORTS[name]
+    except KeyError:
+        raise ValueError(f'Unknown MQTT transport: {name!r} (Use one of: {", ".join(TRANSPORTS)})') from None
+    return TransportClass(
+        settings=settings,
+        verbosity=verbosity,
+        max_pending=max_pending,
+        store_forward=store_forward,
+    )
@@ -0,0 +1,193 @@
+"""
+    Profile the running publish loop with cProfile over rolling time windows.
+
+    Every window is written as one ".pstats" file, only the newest files are kept.
+    The dumps can be summarized with the "profile-summary" CLI command or any pstats compatible tool.
+"""
+
+import cProfile
+import dataclasses
+import logging
+import pstats
+import time
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SUFFIX = '.pstats'
+
+
+def get_stage_functions() -> dict:
+    """
+    Returns the functions of the pipeline stages, in call order.
+    Imported here, so that "profile-summary" doesn't need to import the whole pipeline at CLI startup.
+    """
+    from paho.mqtt.client import Client
+    from victron_ble.devices.base import Device
+
+    from victron_ble2mqtt.mqtt import VictronMqttDeviceHandler
+    from victron_ble2mqtt.publisher import MqttPublisher
+    from victron_ble2mqtt.victron_ble_utils import DataExtractor
+
+    return {
+        'BLE callback': MqttPublisher.detection_callback,
+        'decrypt': Device.decrypt,
+        'values2dict': DataExtractor.__call__,
+        'handler publish': VictronMqttDeviceHandler.publish,
+        'MQTT publish': Client.publish,
+    }
+
+
+def get_function_key(function) -> tuple[str, int, str]:
+    """
+    Returns the key of the function in pstats data.
+
+    >>> get_function_key(get_function_key)[2]
+    'get_function_key'
+    """
+    code = function.__code__
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def get_function_label(key: tuple[str, int, str]) -> str:
+    """
+    >>> get_function_label(('/foo/bar/victron_ble2mqtt/mqtt.py', 123, 'publish'))
+    'victron_ble2mqtt/mqtt.py:123(publish)'
+    >>> get_function_label(('~', 0, "<method 'decrypt' of 'Cipher' objects>"))
+    "<method 'decrypt' of 'Cipher' objects>"
+    """
+    filename, lineno, name = key
+    if filename == '~':  # Built-in functions
+        return name
+    path = Path(filename)
+    return f'{path.parent.name}/{path.name}:{lineno}({name})'
+
+
+class RollingProfiler:
+    """
+    Collect a cProfile profile for `interval` seconds, write it into `directory` and start the next one.
+    Only the newest `keep` profiles are stored.
+    """
+
+    def __init__(self, *, directory: Path, interval: float, keep: int):
+        assert keep > 0, f'Invalid {keep=}'  # paths[:-0] would keep all files
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+
+        self.profile: cProfile.Profile | None = None
+        self.window_start: float | None = None
+        self.dumps = 0  # Makes the file names unique, if two windows start in the same millisecond
+
+    def start(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        profile = self.profile = cProfile.Profile()
+        self.window_start = time.time()
+        profile.enable()
+
+    def dump(self) -> Path:
+        """
+        Write the current window and start a new one.
+        """
+        profile, window_start = self.profile, self.window_start
+        assert profile is not None and window_start is not None, 'Profiler not started'
+        profile.disable()
+        self.dumps += 1
+        timestamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(window_start))
+        milliseconds = int(window_start * 1000) % 1000
+        path = self.directory / f'profile-{timestamp}.{milliseconds:03d}-{self.dumps:04d}{PROFILE_SUFFIX}'
+        profile.dump_stats(path)
+        logger.info('Profile of %.1f sec. written to %s', time.time() - window_start, path)
+
+        self.remove_old_dumps()
+        self.start()
+        return path
+
+    def stop(self) -> Path | None:
+        """
+        Write the last window. Returns None, if the profiler was not started, e.g.: The publish loop failed before.
+        """
+        if self.profile is None:
+            return None
+        path = self.dump()
+        self.profile.disable()  # The new window of dump()
+        self.profile = None
+        return path
+
+    def remove_old_dumps(self) -> None:
+        paths = get_profile_files(self.directory)
+        for path in paths[: -self.keep]:
+            logger.debug('Remove old profile %s', path)
+            path.unlink()
+
+    async def run(self) -> None:
+        import asyncio  # Not needed at CLI startup, e.g.: for "profile-summary"
+
+        self.start()
+        while True:
+            await asyncio.sleep(self.interval)
+            self.dump()
+
+
+def get_profile_files(path: Path) -> list[Path]:
+    """
+    Returns the given profile file or all profile files of the given directory, sorted by name (== time).
+    """
+    if path.is_file():
+        return [path]
+    return sorted(path.glob(f'*{PROFILE_SUFFIX}'))
+
+
+@dataclasses.dataclass
+class FunctionStats:
+    label: str
+    calls: int
+    total_time: float  # Time spent in the function itself
+    cumulative_time: float  # Time including all sub calls
+
+
+def load_profiles(paths: list[Path]) -> pstats.Stats:
+    assert paths, 'No profile files'
+    stats = pstats.Stats(str(paths[0]))
+    for path in paths[1:]:
+        stats.add(str(path))
+    return stats
+
+
+def get_raw_stats(stats: pstats.Stats) -> dict[tuple[str, int, str], tuple]:
+    """
+    Returns the raw data of the pstats, key -> (primitive calls, calls, total time, cumulative time, callers)
+    Note: Not declared in the typeshed stubs of pstats.Stats
+    """
+    return stats.stats  # type: ignore[attr-defined]
+
+
+def get_function_stats(stats: pstats.Stats, key: tuple[str, int, str]) -> FunctionStats:
+    _, calls, total_time, cumulative_time, _ = get_raw_stats(stats).get(key, (0, 0, 0.0, 0.0, {}))
+    return FunctionStats(
+        label=get_function_label(key),
+        calls=calls,
+        total_time=total_time,
+        cumulative_time=cumulative_time,
+    )
+
+
+def get_stage_stats(stats: pstats.Stats) -> dict[str, FunctionStats]:
+    """
+    Returns the stats of the pipeline stages. Note: The cumulative times are nested,
+    e.g.: "BLE callback" contains all other stages, if the frames are published inside the callback.
+    """
+    return {
+        stage: get_function_stats(stats, get_function_key(function))
+        for stage, function in get_stage_functions().items()
+    }
+
+
+def get_hot_spots(stats: pstats.Stats, *, limit: int) -> list[FunctionStats]:
+    """
+    Returns the functions with the highest own time.
+    """
+    raw_stats = get_raw_stats(stats)
+    keys = sorted(raw_stats, key=lambda key: raw_stats[key][2], reverse=True)
+    return [get_function_stats(stats, key) for key in keys[:limit]]
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+from collections.abc import Hashable
+
+
+logger = logging.getLogger(__name__)
+
+
+class CoalescingQueue:
+    """
+    A bounded asyncio queue with one pending item per key (e.g.: the MAC address).
+
+    A new item for a key that is still waiting replaces the old one (the newest frame wins)
+    and keeps its position in the queue. If the queue is full, the oldest item is dropped.
+
+    >>> queue = CoalescingQueue(max_size=2)
+    >>> queue.put('AA', 'frame 1')
+    >>> queue.put('BB', 'frame 2')
+    >>> queue.put('AA', 'frame 3')  # Replaces 'frame 1'
+    >>> queue.get_nowait()
+    'frame 3'
+    >>> queue.get_stats()
+    {'depth': 1, 'max_depth': 2, 'queued': 3, 'coalesced': 1, 'dropped': 0}
+    """
+
+    def __init__(self, *, max_size: int):
+        assert max_size > 0, f'Invalid {max_size=}'
+        self.max_size = max_size
+
+        self._items = {}  # key -> item, in insertion order
+        self._event = asyncio.Event()
+
+        self.max_depth = 0
+        self.queued = 0
+        self.coalesced = 0  # Items replaced by a newer item for the same key
+        self.dropped = 0  # Items removed because the queue was full
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, key: Hashable, item) -> None:
+        self.queued += 1
+        if key in self._items:
+            self.coalesced += 1
+        elif len(self._items) >= self.max_size:
+            oldest_key = next(iter(self._items))
+            del self._items[oldest_key]
+            self.dropped += 1
+            logger.debug('Publish queue full: Drop frame from %s', oldest_key)
+
+        self._items[key] = item
+        self.max_depth = max(self.max_depth, len(self._items))
+        self._event.set()
+
+    def get_nowait(self):
+        key = next(iter(self._items))  # Raises StopIteration if the queue is empty
+        item = self._items.pop(key)
+        if not self._items:
+            self._event.clear()
+        return item
+
+    async def get(self):
+        while not self._items:
+            await self._event.wait()
+        return self.get_nowait()
+
+    def get_stats(self) -> dict:
+        return {
+            'depth': len(self._items),
+            'max_depth': self.max_depth,
+            'queued': self.queued,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+        }
+
+
+class DurationStats:
+    """
+    Collect count, total and max. duration of a code block.
+
+    >>> durations = DurationStats()
+    >>> with durations:
+    ...     pass
+    >>> durations.count
+    1
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = time.perf_counter() - self._start
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the durations in milliseconds.
+        """
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            'max_ms': round(self.max * 1000, 3),
+        }
@@ -0,0 +1,105 @@
+import logging
+import time
+from collections import Counter
+
+
+logger = logging.getLogger(__name__)
+
+
+class PublishScheduler:
+    """
+    Decide per device (MAC address) if a received frame should be published to MQTT.
+
+    Every device has its own throttle window, so a chatty device can't steal the publish slots of other devices.
+    With `max_per_minute` a global rate cap can be set, that is shared fairly between all known devices.
+    """
+
+    def __init__(self, *, throttle_seconds: float, max_per_minute: int = 0):
+        self.throttle_seconds = throttle_seconds
+        self.max_per_minute = max_per_minute  # 0 == unlimited
+
+        self.next_publish = {}  # MAC address -> time.monotonic() value of the next allowed publish
+
+        self.published = Counter()  # MAC address -> published frames
+        self.dropped = Counter()  # MAC address -> throttled frames since last publish
+        self.dropped_total = Counter()  # MAC address -> all throttled frames
+
+        # Token bucket for the global rate cap (allows a burst of one second):
+        self._max_tokens = max(1.0, max_per_minute / 60)
+        self._tokens = self._max_tokens
+        self._last_refill = time.monotonic()
+
+    def get_interval(self) -> float:
+        """
+        Minimum time between two publishes of the same device.
+        With a global rate cap, the available rate is split between all known devices.
+        """
+        interval = self.throttle_seconds
+        if self.max_per_minute > 0:
+            interval = max(interval, len(self.next_publish) * 60 / self.max_per_minute)
+        return interval
+
+    def _take_token(self, now: float) -> bool:
+        if self.max_per_minute <= 0:
+            return True
+
+        self._tokens = min(self._max_tokens, self._tokens + (now - self._last_refill) * self.max_per_minute / 60)
+        self._last_refill = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _drop(self, address: str) -> bool:
+        self.dropped[address] += 1
+        self.dropped_total[address] += 1
+        return False
+
+    def should_publish(self, address: str) -> bool:
+        now = time.monotonic()
+
+        next_publish = self.next_publish.get(address)
+        if next_publish is not None and now < next_publish:
+            return self._drop(address)
+
+        if not self._take_token(now):
+            logger.debug('Global publish rate reached: skip %s', address)
+            return self._drop(address)
+
+        self.next_publish.setdefault(address, now)  # Count a new device in get_interval(), too
+        self.next_publish[address] = now + self.get_interval()
+        self.published[address] += 1
+
+        if dropped := self.dropped.pop(address, 0):
+            logger.debug('Publish %s (%i frames throttled since last publish)', address, dropped)
+        return True
+
+    def remove(self, address: str) -> None:
+        """
+        Forget a device, e.g.: if it was not seen for a long time.
+        """
+        self.next_publish.pop(address, None)
+        for counter in (self.published, self.dropped, self.dropped_total):
+            counter.pop(address, None)
+
+    def get_stats(self) -> dict:
+        """
+        Published and throttled frames per device.
+
+        >>> scheduler = PublishScheduler(throttle_seconds=60)
+        >>> scheduler.should_publish('AA:BB'), scheduler.should_publish('AA:BB'), scheduler.should_publish('CC:DD')
+        (True, False, True)
+        >>> scheduler.get_stats()
+        {'AA:BB': {'published': 1, 'dropped': 1}, 'CC:DD': {'published': 1, 'dropped': 0}}
+        """
+        return {
+            address: {
+                'published': self.published[address],
+                'dropped': self.dropped_total[address],
+            }
+            for address in sorted(self.next_publish)
+        }
+
+    def log_stats(self) -> None:
+        for address, stats in self.get_stats().items():
+            logger.info('%s: %i frames published, %i frames throttled', address, stats['published'], stats['dropped'])
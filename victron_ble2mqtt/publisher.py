@@ -0,0 +1,363 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import Counter, defaultdict
+from collections.abc import Awaitable, Callable
+
+from bleak import AdvertisementData, BLEDevice
+from paho.mqtt.client import Client
+from victron_ble import devices
+from victron_ble.exceptions import AdvertisementKeyMismatchError
+
+from victron_ble2mqtt.device_cache import DeviceCache, find_key, get_key_hash
+from victron_ble2mqtt.election import GatewayElection
+from victron_ble2mqtt.energy import EnergyStore
+from victron_ble2mqtt.frame_cache import FrameCache
+from victron_ble2mqtt.metrics import PublishLoopMetrics
+from victron_ble2mqtt.mqtt import VictronMqttDeviceHandler, get_handler, get_handler_class
+from victron_ble2mqtt.publish_queue import CoalescingQueue, DurationStats
+from victron_ble2mqtt.publish_scheduler import PublishScheduler
+from victron_ble2mqtt.registry import ExpiringRegistry
+from victron_ble2mqtt.user_settings import UserSettings
+from victron_ble2mqtt.victron_ble_utils import DeviceHandler, GenericDevice, get_key_check_byte
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADAPTER = 'default'
+RSSI_MAX_AGE = 60  # Only adapters that received the device in the last seconds are used for the best RSSI
+
+
+class MqttPublisher:
+    """
+    Decode Victron advertisements and publish them via MQTT.
+
+    The advertisements can come from a live BLE scanner or from a capture replay:
+    Both just call detection_callback() for every received advertisement.
+
+    With a `queue_size` the new frames are only queued in the detection callback
+    and run_worker() decrypts and publishes them. Otherwise everything is done inline.
+
+    With `metrics` the publisher counts advertisements, errors, publish latency and
+    the MQTT messages per device. The `mqtt_client` must count the `sent` messages and `sent_bytes` in this case,
+    like the TrackingClient of the MQTT transports or the CountingMqttClient of the replay.
+
+    With a `energy_store` the derived power values of all frames are integrated into energy counters.
+
+    Multiple scanners (e.g.: one per Bluetooth adapter) can feed the same publisher, see: get_detection_callback()
+    The same frame received by several adapters is processed only once (see: FrameCache)
+    and the best RSSI of all adapters is published.
+
+    With a gateway `election` only the devices owned by this gateway are published.
+
+    With a `device_cache` all published devices are remembered. Call restore_devices() on startup,
+    to set up the known devices before their first advertisement arrives.
+    """
+
+    def __init__(
+        self,
+        *,
+        keys: list[str],
+        user_settings: UserSettings,
+        mqtt_client: Client,
+        queue_size: int = 0,
+        metrics: PublishLoopMetrics | None = None,
+        energy_store: EnergyStore | None = None,
+        election: GatewayElection | None = None,
+        device_cache: DeviceCache | None = None,
+    ):
+        self.device_handler = DeviceHandler(
+            keys,
+            reject_ttl=user_settings.unknown_device_ttl_seconds,
+            device_ttl=user_settings.device_expire_seconds,
+            max_addresses=user_settings.max_tracked_addresses,
+            on_device_evict=self.on_device_evict,
+        )
+        self.victron_mqtt_handler = VictronMqttDeviceHandler(user_settings=user_settings, energy_store=energy_store)
+        self.mqtt_client = mqtt_client
+
+        self.rssi_info = ExpiringRegistry(  # address -> {adapter: (RSSI, time.monotonic())}
+            name='rssi',
+            max_size=user_settings.max_tracked_addresses,
+            ttl=user_settings.device_expire_seconds,
+            on_evict=self.on_address_evict,
+        )
+
+        self.scheduler = PublishScheduler(
+            throttle_seconds=user_settings.publish_throttle_seconds,
+            max_per_minute=user_settings.publish_max_per_minute,
+        )
+
+        # In aggregation mode every frame is needed for the window statistics, see: BaseHandler.publish_window()
+        self.aggregation = bool(user_settings.aggregation_window_seconds)
+
+        self.frame_cache = FrameCache(
+            max_size=user_settings.max_tracked_addresses,
+            ttl=user_settings.device_expire_seconds,
+        )
+
+        self.queue = CoalescingQueue(max_size=queue_size) if queue_size else None
+        self.intake_durations = DurationStats()  # Time spent in the BLE detection callback
+        self.process_durations = DurationStats()  # Time spent to decrypt and publish one frame
+        self.metrics = metrics
+        self.adapter_stats = defaultdict(Counter)  # adapter -> Counter(address -> received Victron advertisements)
+        self.election = election
+        self.device_cache = device_cache
+
+    def restore_devices(self) -> int:
+        """
+        Set up the handlers of all cached devices and remember their keys. Returns the number of restored devices.
+        """
+        restored = 0
+        for address, entry in list(self.device_cache.devices.items()):
+            try:
+                key = find_key(self.device_handler.keys, key_index=entry['key_index'], key_hash=entry['key_hash'])
+                DeviceClass = getattr(devices, entry['device_class'], None)
+                HandlerClass = get_handler_class(entry['handler'])
+                setup_data = entry['setup_data']
+            except (KeyError, TypeError) as err:
+                logger.warning('Ignore invalid device cache entry of %s: %s', address, err)
+                self.device_cache.remove(address)
+                continue
+
+            if key is None or DeviceClass is None:
+                logger.info('Device %s: Key or device class is gone', address)
+                self.device_cache.remove(address)
+                continue
+
+            victron_device = DeviceClass(key)
+            if HandlerClass is None:
+                HandlerClass = get_handler(victron_device=victron_device)
+
+            self.device_handler.restore(address, key)
+            self.victron_mqtt_handler.restore(
+                ble_device=BLEDevice(address=address, name=entry.get('name'), details={}),
+                victron_device=victron_device,
+                HandlerClass=HandlerClass,
+                setup_data=setup_data,
+                mqtt_client=self.mqtt_client,
+            )
+            restored += 1
+        logger.info('Restored %i devices from the device cache', restored)
+        return restored
+
+    def remember_device(self, ble_device: BLEDevice, generic_device: GenericDevice) -> None:
+        address = ble_device.address
+        handler = self.victron_mqtt_handler.handler_map.peek(address)
+        if handler is None or handler.setup_data is None:
+            return
+
+        key = self.device_handler.address2key[address]
+        try:
+            key_index = self.device_handler.keys.index(key)
+        except ValueError:  # The keys were changed in the meantime
+            return
+
+        self.device_cache.add(
+            address,
+            name=ble_device.name,
+            device_class=type(generic_device.victron_device).__name__,
+            key_index=key_index,
+            key_hash=get_key_hash(key),
+            handler=type(handler).__name__,
+            setup_data=handler.setup_data,
+        )
+        self.device_cache.save()  # New devices are rare: Don't wait for the next periodic save
+
+    def on_device_evict(self, mac_address: str, generic_device: GenericDevice) -> None:
+        self.scheduler.remove(mac_address)
+        self.frame_cache.remove(mac_address)
+
+    def on_address_evict(self, address: str, adapters: dict) -> None:
+        for received in self.adapter_stats.values():
+            received.pop(address, None)
+        if self.metrics is not None:
+            self.metrics.remove_address(address)
+
+    def update_rssi(self, address: str, rssi: int, adapter: str) -> None:
+        adapters = self.rssi_info.get(address)
+        if adapters is None:
+            adapters = self.rssi_info[address] = {}
+        adapters[adapter] = (rssi, time.monotonic())
+
+    def get_rssi(self, address: str) -> int | None:
+        """
+        Returns the best RSSI of all adapters, that received the device recently.
+        """
+        adapters = self.rssi_info.peek(address)
+        if not adapters:
+            return None
+        deadline = time.monotonic() - RSSI_MAX_AGE
+        return max((rssi for rssi, last_seen in adapters.values() if last_seen >= deadline), default=None)
+
+    def get_adapter_stats(self) -> dict:
+        """
+        Received Victron advertisements and the last RSSI per adapter and device.
+        """
+        stats = {}
+        for adapter, received in sorted(self.adapter_stats.items()):
+            stats[adapter] = {}
+            for address, count in received.most_common():
+                rssi, _ = self.rssi_info.peek(address, {}).get(adapter, (None, None))
+                stats[adapter][address] = {'received': count, 'rssi': rssi}
+        return stats
+
+    def expire(self) -> None:
+        self.device_handler.expire()
+        self.victron_mqtt_handler.handler_map.expire()
+        self.rssi_info.expire()
+        self.frame_cache.expire()
+
+    def log_stats(self) -> None:
+        self.scheduler.log_stats()
+        logger.info('Device handler: %s', self.device_handler.get_stats())
+        logger.info('MQTT handlers: %s', self.victron_mqtt_handler.handler_map.get_stats())
+        logger.info('RSSI info: %s', self.rssi_info.get_stats())
+        logger.info('Repeated frames: %s', self.frame_cache.get_stats())
+        logger.info('Detection callback: %s', self.intake_durations.get_stats())
+        logger.info('Frame processing: %s', self.process_durations.get_stats())
+        if self.queue is not None:
+            logger.info('Publish queue: %s', self.queue.get_stats())
+        if self.election is not None:
+            logger.info('Gateway election: %s', self.election.get_stats())
+        for adapter, stats in self.get_adapter_stats().items():
+            logger.info('Adapter %s: %s', adapter, stats)
+
+    def get_detection_callback(self, adapter: str) -> Callable[[BLEDevice, AdvertisementData], None]:
+        """
+        Returns the detection callback for the scanner of the given Bluetooth adapter.
+        """
+        return functools.partial(self.detection_callback, adapter=adapter)
+
+    def detection_callback(self, device: BLEDevice, advertisement: AdvertisementData, adapter: str = DEFAULT_ADAPTER):
+        with self.intake_durations:
+            self.intake(device, advertisement, adapter)
+
+    def intake(self, device: BLEDevice, advertisement: AdvertisementData, adapter: str = DEFAULT_ADAPTER):
+        self.update_rssi(device.address, advertisement.rssi, adapter)
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.advertisements.inc()
+
+        # Filter for Victron devices and instant readout advertisements.
+        # Note: Don't use the global de-duplication of BaseScanner:
+        # Repeated frames are handled per device, see: FrameCache
+        data = advertisement.manufacturer_data.get(0x02E1)
+        if not data or not data.startswith(b'\x10'):
+            return
+
+        if metrics is not None:
+            metrics.get_device(device.address).advertisements.inc()
+        self.adapter_stats[adapter][device.address] += 1
+
+        election = self.election
+        if election is not None and get_key_check_byte(data) in self.device_handler.key_index:
+            # Take part in the election only for devices, we have a key for:
+            election.observe(device.address, advertisement.rssi)
+
+        if self.frame_cache.is_repeated(device.address, data):
+            # Same nonce and payload as the last processed frame (maybe from another adapter) -> nothing to decrypt.
+            # Just mark the device as seen:
+            self.device_handler.devices.get(device.address)
+            handler = self.victron_mqtt_handler.handler_map.get(device.address)
+            if handler is None:
+                return
+            handler.extend_power()
+            if not handler.is_heartbeat_due():
+                return
+            # A device with constant values sends always the same frame: Process it for the heartbeat.
+
+        if election is not None and not election.is_owner(device.address):
+            return  # Another gateway publishes this device
+
+        if self.queue is None:
+            self.process(device, data, advertisement)
+        else:
+            # Keep only the newest frame per device:
+            self.queue.put(device.address, (device, data, advertisement))
+
+    def process(self, device: BLEDevice, data: bytes, advertisement: AdvertisementData):
+        with self.process_durations:
+            self.callback(device, data, advertisement)
+
+    async def run_worker(self, *, wait_for_capacity: Callable[[], Awaitable] | None = None):
+        """
+        Process all queued frames, started as task in the publish loop.
+        `wait_for_capacity` is awaited before every frame, e.g.: to wait for a slow MQTT broker.
+        """
+        while True:
+            if wait_for_capacity is not None:
+                await wait_for_capacity()
+            device, data, advertisement = await self.queue.get()
+            try:
+                self.process(device, data, advertisement)
+            except Exception:
+                logger.exception('Error processing frame from %s', device.address)
+            await asyncio.sleep(0)  # Let bleak deliver new advertisements between the frames
+
+    def publish(self, ble_device: BLEDevice, raw_data: bytes, generic_device: GenericDevice):
+        self.victron_mqtt_handler.publish(
+            ble_device=ble_device,
+            raw_data=raw_data,
+            generic_device=generic_device,
+            rssi=self.get_rssi(ble_device.address),
+            mqtt_client=self.mqtt_client,
+        )
+
+    def publish_with_metrics(self, ble_device: BLEDevice, raw_data: bytes, generic_device: GenericDevice):
+        metrics = self.metrics
+        mqtt_client = self.mqtt_client
+
+        # Don't count the messages since the last frame to this device, e.g.: gateway election, backfill:
+        self.victron_mqtt_handler.handle_birth(mqtt_client)
+        metrics.count_mqtt(None, messages=mqtt_client.sent, payload_bytes=mqtt_client.sent_bytes)
+
+        start = time.perf_counter()
+        try:
+            self.publish(ble_device, raw_data, generic_device)
+        except AdvertisementKeyMismatchError:
+            metrics.key_mismatches.inc()
+            raise
+        except ValueError:
+            metrics.parse_errors.inc()
+            raise
+        metrics.publish_latency.observe(time.perf_counter() - start)
+        metrics.frames_decrypted.inc()
+        metrics.count_mqtt(
+            metrics.get_device(ble_device.address),
+            messages=mqtt_client.sent,
+            payload_bytes=mqtt_client.sent_bytes,
+        )
+
+    def callback(self, ble_device: BLEDevice, raw_data: bytes, advertisement: AdvertisementData):
+        logger.debug(f'Received data from {ble_device.address.lower()}: {raw_data.hex()}')
+        logger.debug('advertisement: %r', advertisement)
+
+        if generic_device := self.device_handler.get_generic_device(ble_device, raw_data):
+            if not self.aggregation and not self.scheduler.should_publish(ble_device.address):
+                logger.debug(f'Skipping publish for {ble_device.name} ({ble_device.address}) due to throttle.')
+                if self.victron_mqtt_handler.energy_store is not None:
+                    # Count the energy of all frames, not only of the published ones:
+                    decrypted = self.victron_mqtt_handler.integrate(
+                        ble_device=ble_device,
+                        raw_data=raw_data,
+                        generic_device=generic_device,
+                    )
+                    if decrypted:
+                        # The energy of repeated frames is extended without decryption (see: extend_power):
+                        self.frame_cache.remember(ble_device.address, raw_data)
+                        if self.metrics is not None:
+                            self.metrics.frames_decrypted.inc()
+                return
+
+            if self.metrics is None:
+                self.publish(ble_device, raw_data, generic_device)
+            else:
+                self.publish_with_metrics(ble_device, raw_data, generic_device)
+            self.frame_cache.remember(ble_device.address, raw_data)
+            if self.device_cache is not None and ble_device.address not in self.device_cache:
+                self.remember_device(ble_device, generic_device)
+        else:
+            # Note: DeviceHandler logs a warning once per "unknown_device_ttl_seconds"
+            logger.debug(f'Unsupported: {ble_device.name} ({ble_device.address})')
@@ -0,0 +1,141 @@
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Iterator
+
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiringRegistry:
+    """
+    A dict like registry with bounded memory:
+
+     * `max_size`: The least recently used entry is evicted, if the registry is full.
+     * `ttl`: Entries that are not used for this time (in seconds) are expired.
+
+    Use 0 to disable one of the limits. `on_evict` will be called for every removed entry.
+
+    >>> registry = ExpiringRegistry(name='example', max_size=2)
+    >>> registry['a'] = 1
+    >>> registry['b'] = 2
+    >>> registry['a']
+    1
+    >>> list(registry)  # 'b' is the least recently used entry
+    ['b', 'a']
+    >>> registry.get_stats()
+    {'size': 2, 'max_size': 2, 'evicted': 0, 'expired': 0}
+    """
+
+    def __init__(
+        self,
+        *,
+        name: str,
+        max_size: int = 0,
+        ttl: float = 0,
+        on_evict: Callable | None = None,
+    ):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+
+        self._items = OrderedDict()  # key -> (value, time.monotonic() of the last usage)
+
+        self.evicted = 0  # Removed because of max_size
+        self.expired = 0  # Removed because of ttl
+
+    def __setitem__(self, key: Hashable, value) -> None:
+        now = time.monotonic()
+        if key in self._items:
+            self._items.move_to_end(key)
+        else:
+            self.expire(now=now)
+            if self.max_size and len(self._items) >= self.max_size:
+                old_key, (old_value, _) = self._items.popitem(last=False)
+                self.evicted += 1
+                self._evict(old_key, old_value)
+        self._items[key] = (value, now)
+
+    def __getitem__(self, key: Hashable):
+        value, _ = self._items[key]
+        self._items[key] = (value, time.monotonic())
+        self._items.move_to_end(key)
+        return value
+
+    def get(self, key: Hashable, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def peek(self, key: Hashable, default=None):
+        """
+        Get a value without marking the entry as used.
+        """
+        try:
+            value, _ = self._items[key]
+        except KeyError:
+            return default
+        return value
+
+    def pop(self, key: Hashable, default=None):
+        try:
+            value, _ = self._items.pop(key)
+        except KeyError:
+            return default
+        return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator:
+        return iter(self._items)
+
+    def items(self) -> Iterator[tuple]:
+        for key, (value, _) in self._items.items():
+            yield key, value
+
+    def values(self) -> Iterator:
+        for value, _ in self._items.values():
+            yield value
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def _evict(self, key: Hashable, value) -> None:
+        logger.debug('Remove %r from %s registry', key, self.name)
+        if self.on_evict:
+            self.on_evict(key, value)
+
+    def expire(self, *, now: float | None = None) -> None:
+        """
+        Remove all entries that are not used in the last `ttl` seconds.
+        """
+        if not self.ttl:
+            return
+        if now is None:
+            now = time.monotonic()
+
+        deadline = now - self.ttl
+        while self._items:
+            key, (value, last_used) = next(iter(self._items.items()))
+            if last_used > deadline:
+                break  # All other entries are used later
+            del self._items[key]
+            self.expired += 1
+            self._evict(key, value)
+
+    def get_stats(self) -> dict:
+        return {
+            'size': len(self._items),
+            'max_size': self.max_size,
+            'evicted': self.evicted,
+            'expired': self.expired,
+        }
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.name} {self.get_stats()}>'
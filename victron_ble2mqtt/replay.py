@@ -0,0 +1,218 @@
+"""
+    Replay recorded advertisements (see: capture.py) through the complete publish pipeline.
+"""
+
+import dataclasses
+import importlib
+import inspect
+import logging
+import sys
+import time
+from collections.abc import Callable, Iterable
+from contextlib import ExitStack
+from types import ModuleType
+from unittest.mock import patch
+
+from bleak import AdvertisementData, BLEDevice
+from ha_services.mqtt4homeassistant.device import BaseMqttDevice
+from ha_services.mqtt4homeassistant.mocks.mqtt_client_mock import MqttClientMock
+
+from victron_ble2mqtt.capture import CaptureRecord
+from victron_ble2mqtt.publisher import MqttPublisher
+
+
+logger = logging.getLogger(__name__)
+
+
+# All modules with a time.monotonic() based throttle/expiry in the publish pipeline.
+# A new module of the pipeline that uses time.monotonic() must be added here, see: get_clock_module()
+CLOCK_MODULES = (
+    'ha_services.mqtt4homeassistant.components',  # State/config throttle of the sensors
+    'victron_ble2mqtt.change_detection',
+    'victron_ble2mqtt.mqtt',
+    'victron_ble2mqtt.publish_scheduler',
+    'victron_ble2mqtt.publisher',
+    'victron_ble2mqtt.registry',
+    'victron_ble2mqtt.victron_ble_utils',
+)
+
+
+class CountingMqttClient(MqttClientMock):
+    """
+    In-process fake MQTT client, that only counts the published messages.
+    Same as ha_services MqttClientMock, but without storing all messages.
+    Has the same counters as the TrackingClient of the MQTT transports.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sent = 0
+        self.sent_bytes = 0
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False, properties=None) -> None:
+        self.sent += 1
+        if payload is not None:
+            self.sent_bytes += len(payload if isinstance(payload, bytes) else str(payload).encode())
+
+
+def get_clock_module(name: str) -> ModuleType:
+    """
+    Returns the module, whose `time` will be replaced by the CaptureClock.
+    Fails, if the module doesn't use `time.monotonic()` (anymore), e.g.: if monotonic() is imported directly
+    """
+    module = importlib.import_module(name)
+    assert getattr(module, 'time', None) is sys.modules['time'], f'{name} has no "import time"'
+    assert 'time.monotonic()' in inspect.getsource(module), f'{name} does not use "time.monotonic()"'
+    return module
+
+
+class CaptureClock:
+    """
+    Replaces the `time` module in the CLOCK_MODULES, so that all throttles see the capture time
+    (like the FakeClock of the benchmarks): Independent of the replay speed, the pipeline behaves
+    like it received the advertisements live. All other functions are the real ones.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.now = self.start
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def set_capture_time(self, seconds: float) -> None:
+        self.now = self.start + seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@dataclasses.dataclass
+class DeviceReplayStats:
+    frames: int = 0
+    cpu_time: float = 0.0  # Process time in seconds
+    latency_total: float = 0.0  # Wall clock time in seconds
+    latency_max: float = 0.0
+
+
+@dataclasses.dataclass
+class ReplayStats:
+    frames: int = 0
+    duration: float = 0.0  # Wall clock time of the whole replay in seconds
+    capture_duration: float = 0.0  # Time span of the replayed records in seconds
+    devices: dict = dataclasses.field(default_factory=dict)  # MAC address -> DeviceReplayStats
+
+    def add(self, address: str, *, cpu_time: float, latency: float) -> None:
+        self.frames += 1
+        try:
+            device_stats = self.devices[address]
+        except KeyError:
+            device_stats = self.devices[address] = DeviceReplayStats()
+        device_stats.frames += 1
+        device_stats.cpu_time += cpu_time
+        device_stats.latency_total += latency
+        device_stats.latency_max = max(device_stats.latency_max, latency)
+
+    def get_frames_per_second(self) -> float:
+        if not self.duration:
+            return 0.0
+        return self.frames / self.duration
+
+
+class ReplaySource:
+    """
+    Feed capture records into MqttPublisher.detection_callback(), just like the live BLE scanner does.
+
+    speed: 1 = real time, N = N× faster, 0 = as fast as possible
+    throttle: False = Bypass the state throttle of the sensors (ha_services "throttle_sec")
+
+    If the publisher has a publish queue, the frames go through the queue, like in the publish loop.
+    But the queue is processed directly after every advertisement (There is no event loop),
+    so the frames are never coalesced.
+    """
+
+    def __init__(
+        self,
+        *,
+        publisher: MqttPublisher,
+        speed: float = 1.0,
+        throttle: bool = True,
+        sleep: Callable = time.sleep,
+    ):
+        self.publisher = publisher
+        self.speed = speed
+        self.throttle = throttle
+        self.sleep = sleep
+        self.ble_devices = {}  # MAC address -> BLEDevice, like bleak reuses the BLEDevice instances
+
+    def get_ble_device(self, record: CaptureRecord) -> BLEDevice:
+        try:
+            return self.ble_devices[record.address]
+        except KeyError:
+            ble_device = self.ble_devices[record.address] = BLEDevice(
+                address=record.address,
+                name=record.name,
+                details={},
+            )
+            return ble_device
+
+    def replay(self, records: Iterable[CaptureRecord]) -> ReplayStats:
+        """
+        Note: The system sensors of the main device are not polled, like in the benchmarks:
+        They would measure the replaying host in capture time, e.g.: Nonsense CPU usage at max. speed.
+        """
+        clock = CaptureClock()
+        main_mqtt_device = self.publisher.victron_mqtt_handler.main_mqtt_device
+        with ExitStack() as stack:
+            for name in CLOCK_MODULES:
+                stack.enter_context(patch.object(get_clock_module(name), 'time', clock))
+            stack.enter_context(patch.object(main_mqtt_device, 'poll_and_publish', lambda client: None))
+            return self.replay_records(records, clock=clock)
+
+    def replay_records(self, records: Iterable[CaptureRecord], *, clock: CaptureClock) -> ReplayStats:
+        stats = ReplayStats()
+        detection_callback = self.publisher.detection_callback
+        process = self.publisher.process
+        queue = self.publisher.queue
+
+        first_timestamp = None
+        start_time = time.monotonic()
+        for record in records:
+            if first_timestamp is None:
+                first_timestamp = record.timestamp
+            stats.capture_duration = record.timestamp - first_timestamp
+
+            if self.speed:
+                delay = start_time + stats.capture_duration / self.speed - time.monotonic()
+                if delay > 0:
+                    self.sleep(delay)
+
+            advertisement = AdvertisementData(
+                local_name=record.name,
+                manufacturer_data={record.company_id: record.data},
+                service_data={},
+                service_uuids=[],
+                tx_power=None,
+                rssi=record.rssi,
+                platform_data=(),
+            )
+            ble_device = self.get_ble_device(record)
+
+            clock.set_capture_time(stats.capture_duration)
+            if not self.throttle:
+                for component in BaseMqttDevice.components.values():
+                    component._next_publish = 0
+
+            cpu_start = time.process_time()
+            callback_start = time.perf_counter()
+            detection_callback(ble_device, advertisement)
+            while queue:  # The publish worker of the publish loop
+                process(*queue.get_nowait())
+            stats.add(
+                record.address,
+                cpu_time=time.process_time() - cpu_start,
+                latency=time.perf_counter() - callback_start,
+            )
+
+        stats.duration = time.monotonic() - start_time
+        return stats
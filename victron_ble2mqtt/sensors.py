@@ -0,0 +1,136 @@
+"""
+    Declarative sensor descriptions, shared by all devices of the same model.
+
+    A SensorSpec is created and validated once at import time.
+    The per device SpecSensor only stores the device related values (uid, topic prefix, state, throttling)
+    and reads the static attributes (name, device class, unit, precision, ...) from the spec.
+"""
+
+import dataclasses
+from functools import cache
+
+from ha_services.ha_data.validators import validate_sensor
+from ha_services.mqtt4homeassistant.components.sensor import Sensor
+from ha_services.mqtt4homeassistant.data_classes import NO_STATE
+from ha_services.mqtt4homeassistant.device import MqttDevice
+from ha_services.mqtt4homeassistant.utilities.assertments import assert_uid
+
+from victron_ble2mqtt.aggregation import STATISTICS
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class SensorSpec:
+    """
+    Static attributes of one sensor. Validated only once, on creation.
+
+    >>> SensorSpec(name='Load', uid='load', data_key='external_device_load').key
+    'external_device_load'
+    """
+
+    name: str
+    uid: str
+    #
+    # Check available combinations here:
+    # https://developers.home-assistant.io/docs/core/entity/sensor/#available-device-classes
+    device_class: str | None = None
+    state_class: str | None = None
+    unit_of_measurement: str | None = None
+    suggested_display_precision: int | None = None
+    #
+    # Optional min/max validation of int/float values:
+    min_value: int | float | None = None
+    max_value: int | float | None = None
+
+    data_key: str | None = None  # Key in the data dict of the device, if it's not the same as the uid
+
+    def __post_init__(self):
+        assert_uid(self.uid)
+        validate_sensor(
+            device_class=self.device_class,
+            state_class=self.state_class,
+            unit_of_measurement=self.unit_of_measurement,
+        )
+
+    @property
+    def key(self) -> str:
+        return self.data_key or self.uid
+
+
+@cache
+def get_statistic_specs(spec: SensorSpec) -> dict[str, SensorSpec]:
+    """
+    The specs of the window statistics of the given sensor, e.g.: "current_max", see: BaseHandler.publish_window()
+
+    >>> specs = get_statistic_specs(SensorSpec(name='Current', uid='current', unit_of_measurement='A'))
+    >>> specs['max'].name, specs['max'].uid, specs['max'].unit_of_measurement
+    ('Current Max', 'current_max', 'A')
+    >>> specs is get_statistic_specs(SensorSpec(name='Current', uid='current', unit_of_measurement='A'))
+    True
+    """
+    return {
+        name: dataclasses.replace(spec, name=f'{spec.name} {suffix}', uid=f'{spec.uid}_{name}', data_key=None)
+        for name, suffix in STATISTICS.items()
+    }
+
+
+class SpecSensor(Sensor):
+    """
+    A sensor of one device, described by a shared SensorSpec.
+
+    Note: __slots__ would not save anything, because the ha_services base classes have a __dict__.
+    Instead, only the per device values are stored in the instance: Sensor.__init__() and
+    BaseComponent.__init__() are skipped, the static values are class attributes or read from the spec.
+    """
+
+    component = 'sensor'
+    qos = 0
+    retain = False
+
+    def __init__(self, *, device: MqttDevice, spec: SensorSpec):
+        self.spec = spec
+        self.device = device
+        self.uid = f'{device.uid}-{spec.uid}'
+        device.register_component(component=self)
+        self.topic_prefix = f'{device.topic_prefix}/{self.component}/{device.uid}/{self.uid}'
+        self.state = NO_STATE
+        self._config_kwargs_cache = None
+
+        # Always publish first config+state:
+        self._next_config_publish = 0
+        self._next_publish = 0
+
+    @property
+    def name(self) -> str:
+        return self.spec.name
+
+    @property
+    def throttle_sec(self) -> int:
+        return self.device.throttle_sec
+
+    @property
+    def config_throttle_sec(self) -> int:
+        return self.device.config_throttle_sec
+
+    @property
+    def device_class(self) -> str | None:
+        return self.spec.device_class
+
+    @property
+    def state_class(self) -> str | None:
+        return self.spec.state_class
+
+    @property
+    def unit_of_measurement(self) -> str | None:
+        return self.spec.unit_of_measurement
+
+    @property
+    def suggested_display_precision(self) -> int | None:
+        return self.spec.suggested_display_precision
+
+    @property
+    def min_value(self) -> int | float | None:
+        return self.spec.min_value
+
+    @property
+    def max_value(self) -> int | float | None:
+        return self.spec.max_value
@@ -0,0 +1,304 @@
+"""
+    Store-and-forward of MQTT messages during broker outages, see: "store_forward" settings.
+
+    While the MQTT client is not connected, the not retained messages (sensor states) are appended
+    to a ring buffer on disk, instead of being dropped. The buffer is split into segment files:
+
+        <directory>/000000000000.seg, <directory>/000000000001.seg, ...
+
+    Every record starts with a fixed size struct (Unix timestamp, topic length, payload length),
+    followed by the topic and the payload. If the size cap is reached, the oldest segment is deleted.
+    The read position in the oldest segment is stored in <directory>/position, so a restart doesn't send
+    the same messages twice.
+
+    When the connection returns, the buffer is drained in batches at a limited rate. The messages
+    are not sent to their original topic (that would overwrite newer states), but to:
+
+        <backfill topic>/<original topic> -> {"timestamp": <Unix timestamp>, "payload": <original payload>}
+
+    So consumers can insert the readings at the right time. A batch is removed from the buffer only after
+    the broker acknowledged all messages (QoS 1), otherwise it's sent again. So consumers may get duplicates.
+"""
+
+import asyncio
+import json
+import logging
+import struct
+import time
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+from typing import BinaryIO
+
+from paho.mqtt.client import MQTT_ERR_SUCCESS, Client
+
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.seg'
+POSITION_FILE_NAME = 'position'
+SEGMENTS = 10  # The size cap is split into this number of segment files
+
+RECORD_HEADER = struct.Struct('<dHI')  # Unix timestamp, length of the topic, length of the payload
+ACK_TIMEOUT = 30  # Seconds to wait for the acknowledgements of a backfill batch, before it's sent again
+
+
+def get_segment_path(directory: Path, number: int) -> Path:
+    """
+    >>> get_segment_path(Path('/tmp'), 12)
+    PosixPath('/tmp/000000000012.seg')
+    """
+    return directory / f'{number:012d}{SEGMENT_SUFFIX}'
+
+
+def read_record(file: BinaryIO) -> tuple[float, str, bytes] | None:
+    """
+    Returns the next (timestamp, topic, payload) record or None, if the rest of the file is truncated.
+    """
+    header = file.read(RECORD_HEADER.size)
+    if len(header) < RECORD_HEADER.size:
+        return None
+    timestamp, topic_length, payload_length = RECORD_HEADER.unpack(header)
+    data = file.read(topic_length + payload_length)
+    if len(data) < topic_length + payload_length:
+        return None
+    return timestamp, data[:topic_length].decode(), data[topic_length:]
+
+
+class DiskRingBuffer:
+    """
+    Append-only ring buffer of (timestamp, topic, payload) records with a size cap.
+    Only the oldest segment is read and only the newest segment is written.
+    """
+
+    def __init__(self, *, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_size = max(max_bytes // SEGMENTS, RECORD_HEADER.size)
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segments = {  # Segment number -> file size
+            int(path.stem): path.stat().st_size for path in sorted(self.directory.glob(f'*{SEGMENT_SUFFIX}'))
+        }
+        self.read_offset = self.load_position()
+        self.file = None  # The newest segment, opened for appending
+
+        self.stored = 0
+        self.drained = 0
+        self.evicted_bytes = 0  # Lost because of the size cap
+
+    @property
+    def position_path(self) -> Path:
+        return self.directory / POSITION_FILE_NAME
+
+    def load_position(self) -> int:
+        if not self.segments:
+            return 0
+        try:
+            number, offset = map(int, self.position_path.read_text().split())
+        except (FileNotFoundError, ValueError):
+            return 0
+        if number != min(self.segments):
+            return 0  # The segment was evicted in the meantime
+        return offset
+
+    def save_position(self) -> None:
+        if self.segments:
+            self.position_path.write_text(f'{min(self.segments)} {self.read_offset}')
+        else:
+            self.position_path.unlink(missing_ok=True)
+
+    @property
+    def size(self) -> int:
+        """
+        Bytes of the not drained records.
+        """
+        return sum(self.segments.values()) - self.read_offset
+
+    def __bool__(self) -> bool:
+        return self.size > 0
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def append(self, timestamp: float, topic: str, payload: bytes) -> None:
+        topic_bytes = topic.encode()
+        record = RECORD_HEADER.pack(timestamp, len(topic_bytes), len(payload)) + topic_bytes + payload
+
+        number = max(self.segments, default=-1)
+        if self.file is None or self.segments[number] + len(record) > self.segment_size:
+            # Start a new segment. Never append to a segment of a previous run: It may end with a truncated record.
+            self.close()
+            number += 1
+            self.segments[number] = 0
+            self.file = get_segment_path(self.directory, number).open('ab')
+
+        self.file.write(record)
+        self.file.flush()  # Readable by pop_batch() and not lost on a crash of the process
+        self.segments[number] += len(record)
+        self.stored += 1
+
+        while sum(self.segments.values()) > self.max_bytes and len(self.segments) > 1:
+            self.evict_oldest()
+
+    def evict_oldest(self) -> None:
+        number = min(self.segments)
+        lost = self.segments.pop(number) - self.read_offset
+        logger.warning('Store-and-forward buffer is full: Drop %i bytes of the oldest messages', lost)
+        self.evicted_bytes += lost
+        self.read_offset = 0
+        get_segment_path(self.directory, number).unlink(missing_ok=True)
+        self.save_position()
+
+    def remove_segment(self, number: int) -> None:
+        """
+        The segment is completely drained.
+        """
+        if number == max(self.segments):
+            self.close()  # The next append() starts a new segment
+        del self.segments[number]
+        get_segment_path(self.directory, number).unlink(missing_ok=True)
+
+    def read_batch(self, count: int) -> tuple[list[tuple[float, str, bytes]], tuple[int, int]]:
+        """
+        Returns up to `count` of the oldest records and the read position (segment number, offset) after them.
+        The records stay in the buffer until advance() is called with this position.
+        """
+        records = []
+        if not self.segments:
+            return records, (0, 0)
+
+        number, offset = min(self.segments), self.read_offset
+        while len(records) < count and number in self.segments:
+            size = self.segments[number]
+            with get_segment_path(self.directory, number).open('rb') as file:
+                file.seek(offset)
+                while len(records) < count and offset < size:
+                    if (record := read_record(file)) is None:
+                        logger.error('Skip truncated record in %s', file.name)
+                        offset = size
+                        break
+                    records.append(record)
+                    offset = file.tell()
+
+            if offset < size or (self.file is not None and number == max(self.segments)):
+                break  # Not completely read or new records may be appended to this segment
+            number, offset = number + 1, 0
+
+        return records, (number, offset)
+
+    def advance(self, position: tuple[int, int], *, records: int) -> None:
+        """
+        Remove the records before the given read position, see: read_batch()
+        """
+        number, offset = position
+        for old_number in sorted(self.segments):
+            if old_number < number:
+                self.remove_segment(old_number)
+
+        if number in self.segments and offset >= self.segments[number]:
+            self.remove_segment(number)  # The newest segment is completely read
+            offset = 0
+        elif number not in self.segments:
+            offset = 0  # Completely read or evicted in the meantime
+        self.read_offset = offset
+
+        self.drained += records
+        self.save_position()
+
+    def pop_batch(self, count: int) -> list[tuple[float, str, bytes]]:
+        """
+        Returns up to `count` of the oldest records and removes them from the buffer.
+        """
+        records, position = self.read_batch(count)
+        self.advance(position, records=len(records))
+        return records
+
+    def get_stats(self) -> dict:
+        return {
+            'segments': len(self.segments),
+            'size': self.size,
+            'stored': self.stored,
+            'drained': self.drained,
+            'evicted_bytes': self.evicted_bytes,
+        }
+
+
+class StoreAndForward:
+    def __init__(self, *, buffer: DiskRingBuffer, backfill_topic: str, batch_size: int, batch_interval: float):
+        self.buffer = buffer
+        self.backfill_topic = backfill_topic
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+
+        self.in_flight = []  # MQTTMessageInfo of the sent batch
+        self.batch_position = None  # Read position after the sent batch
+        self.batch_sent = 0.0
+        self.resent_batches = 0
+
+    def store(self, topic: str, payload: bytes | None) -> None:
+        """
+        Called by the MQTT client for every not retained message, while it's not connected.
+        """
+        if topic.startswith(f'{self.backfill_topic}/'):
+            return  # QoS 1: paho will send it again after the reconnect
+        self.buffer.append(time.time(), topic, payload or b'')
+
+    def drain_batch(self, mqtt_client: Client) -> int:
+        """
+        Publish the next batch of stored messages to the backfill topic. Returns the number of messages.
+        The messages stay in the buffer until the broker acknowledged them, see: confirm_batch()
+        """
+        records, self.batch_position = self.buffer.read_batch(self.batch_size)
+        self.in_flight = [
+            mqtt_client.publish(
+                topic=f'{self.backfill_topic}/{topic}',
+                payload=json.dumps({'timestamp': timestamp, 'payload': payload.decode(errors='replace')}),
+                qos=1,
+            )
+            for timestamp, topic, payload in records
+        ]
+        self.batch_sent = time.monotonic()
+        return len(records)
+
+    def confirm_batch(self) -> bool:
+        """
+        Remove the sent batch from the buffer, if all messages are acknowledged.
+        Returns True, if the next batch can be sent.
+        """
+        if not self.in_flight:
+            return True
+
+        acknowledged = sum(1 for info in self.in_flight if info.rc == MQTT_ERR_SUCCESS and info.is_published())
+        if acknowledged == len(self.in_flight):
+            self.buffer.advance(self.batch_position, records=acknowledged)
+            logger.info('Backfill: %i messages sent, %i bytes left', acknowledged, self.buffer.size)
+        elif (
+            any(info.rc != MQTT_ERR_SUCCESS for info in self.in_flight)
+            or time.monotonic() - self.batch_sent > ACK_TIMEOUT
+        ):
+            # e.g.: The connection was lost while draining: Read the same records again.
+            lost = len(self.in_flight) - acknowledged
+            logger.warning('Backfill: %i of %i messages not acknowledged: Send them again', lost, len(self.in_flight))
+            self.resent_batches += 1
+        else:
+            return False  # Wait for the acknowledgements
+
+        self.in_flight = []
+        return True
+
+    async def run(self, mqtt_client: Client, *, wait_for_capacity: Callable[[], Awaitable] | None = None) -> None:
+        while True:
+            await asyncio.sleep(self.batch_interval)
+            if self.confirm_batch() and self.buffer and mqtt_client.is_connected():
+                if wait_for_capacity is not None:
+                    await wait_for_capacity()
+                self.drain_batch(mqtt_client)
+
+    def get_stats(self) -> dict:
+        return {
+            **self.buffer.get_stats(),
+            'in_flight': len(self.in_flight),
+            'resent_batches': self.resent_batches,
+        }
@@ -0,0 +1,58 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from ha_services.mqtt4homeassistant.device import BaseMqttDevice
+
+from victron_ble2mqtt.benchmarks.device_data import iter_device_classes
+from victron_ble2mqtt.benchmarks.pipeline import (
+    MEMORY_RESULT,
+    STAGES,
+    add_memory_results,
+    benchmark_handler_memory,
+    benchmark_pipeline,
+    load_results,
+    save_results,
+)
+from victron_ble2mqtt.benchmarks.startup import STARTUP_STAGES, benchmark_startup
+
+
+def fake_measure(func, *, repeat: int = 3) -> float:
+    func()  # Call it once: All stages must work
+    return 1.0
+
+
+class BenchmarkTestCase(TestCase):
+    def test_benchmark_pipeline(self):
+        components_before = dict(BaseMqttDevice.components)
+        with (
+            patch('victron_ble2mqtt.benchmarks.pipeline.measure', fake_measure),
+            self.assertLogs('victron_ble2mqtt'),
+        ):
+            results = benchmark_pipeline()
+        self.assertEqual(BaseMqttDevice.components, components_before)
+
+        self.assertEqual(list(results), [DeviceClass.__name__ for DeviceClass in iter_device_classes()])
+        for name, stage_results in results.items():
+            with self.subTest(name):
+                self.assertEqual(tuple(stage_results), STAGES)
+
+        with self.assertLogs('victron_ble2mqtt'):
+            memory = benchmark_handler_memory(count=2)
+        self.assertEqual(BaseMqttDevice.components, components_before)
+        self.assertEqual(list(memory), list(results))
+        self.assertTrue(all(allocated > 0 for allocated in memory.values()))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            json_path = Path(temp_dir) / 'benchmark.json'
+            save_results(json_path, add_memory_results(results, memory))
+            loaded = load_results(json_path)
+        self.assertEqual(loaded, results)
+        self.assertEqual(loaded['BatteryMonitor'][MEMORY_RESULT], memory['BatteryMonitor'])
+        self.assertIn('handler_setup', loaded['BatteryMonitor'])
+
+    def test_startup_benchmark(self):
+        results = benchmark_startup(repeat=1)
+        self.assertEqual(tuple(results), tuple(STARTUP_STAGES))
+        self.assertGreater(results['first_callback'], results['python'])
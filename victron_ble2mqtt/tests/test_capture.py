@@ -0,0 +1,145 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from bleak import AdvertisementData, BLEDevice
+
+from victron_ble2mqtt.capture import (
+    FLAG_INSTANT_READOUT,
+    FLAG_LOCAL_NAME,
+    CaptureReader,
+    CaptureRecord,
+    CaptureWriter,
+    get_capture_files,
+    iter_capture,
+)
+
+
+def make_record(timestamp: float) -> CaptureRecord:
+    return CaptureRecord(
+        timestamp=timestamp,
+        address='AA:BB:CC:DD:EE:FF',
+        rssi=-70,
+        flags=FLAG_INSTANT_READOUT,
+        company_id=0x02E1,
+        name='SmartShunt',
+        data=bytes.fromhex('100089a3020100010694267ba398480c6b2b9f649be476cb'),
+    )
+
+
+class CaptureTestCase(TestCase):
+    def test_write_and_read_slices(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            directory = Path(temp_dir)
+            with CaptureWriter(directory=directory, max_file_size=10_000, index_interval=10) as writer:
+                for number in range(1000):
+                    writer.write_record(make_record(timestamp=number / 10))
+
+            self.assertEqual(writer.records, 1000)
+            capture_files = get_capture_files(directory)
+            self.assertEqual(len(capture_files), writer.file_number + 1)
+            self.assertGreater(len(capture_files), 1)
+            for capture_file in capture_files:
+                self.assertLessEqual(capture_file.stat().st_size, 10_000)
+
+            records = list(iter_capture(capture_files))
+            self.assertEqual(len(records), 1000)
+            self.assertEqual(records[0], make_record(timestamp=0))
+            self.assertEqual([record.timestamp for record in records], [number / 10 for number in range(1000)])
+
+            # Time-range slice:
+            records = list(iter_capture(capture_files, start=50, end=52))
+            self.assertEqual(len(records), 21)
+            self.assertEqual((records[0].timestamp, records[-1].timestamp), (50, 52))
+
+    def test_index_seek(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            directory = Path(temp_dir)
+            with CaptureWriter(directory=directory, index_interval=100) as writer:
+                for number in range(1000):
+                    writer.write_record(make_record(timestamp=number))
+
+            reader = CaptureReader(writer.file_path)
+            self.assertEqual(len(reader.index_timestamps), 10)
+            self.assertEqual(reader.get_start_offset(None), reader.get_start_offset(0))
+            self.assertGreater(reader.get_start_offset(550), reader.get_start_offset(0))
+
+            with patch.object(reader, 'get_start_offset', wraps=reader.get_start_offset) as get_start_offset:
+                records = list(reader.iter_records(start=550, end=551))
+            get_start_offset.assert_called_once_with(550)
+            self.assertEqual([record.timestamp for record in records], [550, 551])
+
+    def test_several_sessions(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            directory = Path(temp_dir)
+            for session_start, stem in ((1000.0, 'second'), (900.0, 'first')):
+                with (
+                    patch('time.time', return_value=session_start),
+                    CaptureWriter(directory=directory, stem=stem, max_file_size=1000) as writer,
+                ):
+                    for number in range(30):
+                        writer.write_record(make_record(timestamp=number * 5))
+                self.assertGreater(writer.file_number, 0)
+
+            # The timestamps are seconds since the start of the first session:
+            capture_files = get_capture_files(directory)
+            with self.assertLogs('victron_ble2mqtt', level='INFO'):
+                timestamps = [record.timestamp for record in iter_capture(capture_files)]
+            self.assertEqual(len(timestamps), 60)
+            self.assertEqual(timestamps, sorted(timestamps))
+            self.assertEqual(timestamps[:3], [0, 5, 10])
+            self.assertEqual(timestamps[-3:], [235, 240, 245])  # 100 sec. after the first session
+
+            # The overlapping range of both sessions:
+            with self.assertLogs('victron_ble2mqtt', level='INFO'):
+                records = list(iter_capture(capture_files, start=100, end=110))
+            self.assertEqual([record.timestamp for record in records], [100, 100, 105, 105, 110, 110])
+
+    def test_long_name(self):
+        record = CaptureRecord(
+            timestamp=0,
+            address='AA:BB:CC:DD:EE:FF',
+            rssi=-70,
+            flags=FLAG_LOCAL_NAME,
+            company_id=0x02E1,
+            name='☀' * 100,  # 300 bytes UTF-8
+            data=b'\x10\x00data',
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            directory = Path(temp_dir)
+            with CaptureWriter(directory=directory) as writer:
+                writer.write_record(record)
+            (read_record,) = iter_capture(get_capture_files(directory))
+        self.assertEqual(read_record.name, '☀' * 85)  # Only complete characters
+        self.assertEqual(read_record.data, b'\x10\x00data')
+
+    def test_write_advertisement(self):
+        device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        advertisement = AdvertisementData(
+            local_name=None,
+            manufacturer_data={0x02E1: b'\x10\x00data'},
+            service_data={},
+            service_uuids=[],
+            tx_power=None,
+            rssi=-80,
+            platform_data=(),
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            directory = Path(temp_dir)
+            with CaptureWriter(directory=directory) as writer:
+                writer.write_advertisement(device, advertisement)
+                writer.write_advertisement(
+                    BLEDevice(address='2A1B6A2C-F7E5-4D86-8C38-1A2B3C4D5E6F', name=None, details={}),  # macOS
+                    advertisement,
+                )
+            self.assertEqual(writer.get_stats()['records'], 1)
+            self.assertEqual(writer.get_stats()['skipped'], 1)
+
+            (record,) = iter_capture(get_capture_files(directory))
+            self.assertEqual(record.address, 'AA:BB:CC:DD:EE:FF')
+            self.assertEqual(record.rssi, -80)
+            self.assertEqual(record.name, 'SmartShunt')
+            self.assertEqual(record.data, b'\x10\x00data')
+            self.assertEqual(record.flags, FLAG_INSTANT_READOUT)
+            self.assertFalse(record.flags & FLAG_LOCAL_NAME)
@@ -0,0 +1,33 @@
+import asyncio
+import json
+import os
+import signal
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from victron_ble2mqtt.cli_app.mqtt import run_forever
+from victron_ble2mqtt.energy import EnergyStore
+
+
+class PublishLoopTestCase(TestCase):
+    def test_save_energy_on_sigterm(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            state_file = Path(temp_dir) / 'energy.json'
+            energy_store = EnergyStore(path=state_file, max_gap=60)
+            energy_store.get_integrator('foo-power').count(3600)  # 1 Wh
+
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.call_later(0.01, os.kill, os.getpid(), signal.SIGTERM)  # e.g.: "systemctl restart"
+                with self.assertLogs('victron_ble2mqtt', level='DEBUG'):
+                    run_forever(on_shutdown=energy_store.save)
+            finally:
+                loop.close()
+                asyncio.set_event_loop(None)
+
+            self.assertEqual(
+                json.loads(state_file.read_text()),
+                {'foo-power': {'positive_wh': 1.0, 'negative_wh': 0.0}},
+            )
@@ -0,0 +1,174 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from paho.mqtt.client import Client, MQTTMessage, topic_matches_sub
+from paho.mqtt.enums import CallbackAPIVersion
+
+from victron_ble2mqtt.election import GatewayElection
+
+
+class FakeBroker:
+    """
+    Deliver (retained) messages between the clients of several in-process gateways.
+    """
+
+    def __init__(self):
+        self.clients = []
+        self.retained = {}
+
+    def deliver(self, client: 'FakeClient', topic: str, payload: bytes) -> None:
+        for subscription, callback in client.callbacks.items():
+            if subscription in client.subscriptions and topic_matches_sub(subscription, topic):
+                message = MQTTMessage(topic=topic.encode())
+                message.payload = payload
+                callback(client, None, message)
+
+    def publish(self, topic: str, payload: bytes, retain: bool) -> None:
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for client in self.clients:
+            self.deliver(client, topic, payload)
+
+
+class FakeClient(Client):
+    def __init__(self, broker: FakeBroker):
+        super().__init__(CallbackAPIVersion.VERSION2)
+        self.broker = broker
+        self.callbacks = {}
+        self.subscriptions = set()
+
+    def message_callback_add(self, subscription: str, callback) -> None:
+        self.callbacks[subscription] = callback
+
+    def connect(self) -> None:
+        self.broker.clients.append(self)
+        self.on_connect(self, None, None, 0, None)
+
+    def subscribe(self, subscription: str) -> None:
+        self.subscriptions.add(subscription)
+        for topic, payload in list(self.broker.retained.items()):
+            self.broker.deliver(self, topic, payload)
+
+    def publish(self, topic: str, payload: str | None = None, retain: bool = False) -> None:
+        self.broker.publish(topic, payload.encode() if payload else b'', retain)
+
+
+ADDRESS = 'AA:BB:CC:DD:EE:FF'
+
+
+class GatewayElectionTestCase(TestCase):
+    def test_election(self):
+        broker = FakeBroker()
+        gateways = {}
+        for gateway_id in ('pi-1', 'pi-2', 'pi-3'):
+            election = GatewayElection(gateway_id=gateway_id, topic='test/gateways', interval=10, hysteresis=5)
+            client = FakeClient(broker)
+            election.subscribe(client)
+            client.connect()
+            gateways[gateway_id] = (election, client)
+
+        def receive(rssi_values: dict[str, int]):
+            for gateway_id, rssi in rssi_values.items():
+                gateways[gateway_id][0].observe(ADDRESS, rssi)
+
+        def announce():
+            for election, client in gateways.values():
+                election.announce(client)
+
+        def get_owners() -> set[str]:
+            for election, _ in gateways.values():
+                election.process_announcements()
+            return {election.owners.get(ADDRESS) for election, _ in gateways.values()}
+
+        def get_publishers() -> list[str]:
+            return [gateway_id for gateway_id, (election, _) in gateways.items() if election.is_owner(ADDRESS)]
+
+        with self.assertLogs('victron_ble2mqtt', level='INFO'), patch('time.monotonic', return_value=100):
+            # Until the first announcements, every gateway publishes:
+            receive({'pi-1': -80, 'pi-2': -70})
+            self.assertEqual(get_publishers(), ['pi-1', 'pi-2', 'pi-3'])
+
+            announce()
+            self.assertEqual(get_owners(), {'pi-2'})  # All gateways elect the same owner
+            self.assertEqual(get_publishers(), ['pi-2'])
+            self.assertEqual(len(broker.retained), 2)  # pi-3 doesn't receive the device
+
+            # pi-3 is slightly better, but inside the hysteresis:
+            receive({'pi-3': -67})
+            announce()
+            self.assertEqual(get_owners(), {'pi-2'})
+
+            # pi-3 is much better (smoothed):
+            for _ in range(20):
+                receive({'pi-3': -50})
+            announce()
+            self.assertEqual(get_owners(), {'pi-3'})
+            self.assertEqual(get_publishers(), ['pi-3'])
+
+        # Failover: pi-3 and pi-2 stop hearing the device, pi-1 still receives it:
+        with self.assertLogs('victron_ble2mqtt', level='INFO'), patch('time.monotonic', return_value=140):
+            receive({'pi-1': -80})
+            announce()
+        self.assertEqual(get_owners(), {'pi-1'})
+        self.assertEqual(list(broker.retained), ['test/gateways/aabbccddeeff/pi-1'])
+
+        election = gateways['pi-2'][0]
+        self.assertEqual(
+            election.get_stats(),
+            {'gateway_id': 'pi-2', 'devices': 1, 'owned': 0, 'owner_changes': 3, 'dropped': 1},
+        )
+
+        # A new gateway gets the retained announcements:
+        late = GatewayElection(gateway_id='pi-4', topic='test/gateways', interval=10, hysteresis=5)
+        client = FakeClient(broker)
+        late.subscribe(client)
+        client.connect()
+        with self.assertLogs('victron_ble2mqtt', level='INFO'):
+            self.assertFalse(late.is_owner(ADDRESS))  # The messages from the network thread are processed first
+
+    def test_late_joiner_within_hysteresis(self):
+        broker = FakeBroker()
+
+        def start_gateway(gateway_id: str) -> tuple[GatewayElection, FakeClient]:
+            election = GatewayElection(gateway_id=gateway_id, topic='test/gateways', interval=10, hysteresis=5)
+            client = FakeClient(broker)
+            election.subscribe(client)
+            return election, client
+
+        with self.assertLogs('victron_ble2mqtt', level='INFO'), patch('time.monotonic', return_value=100):
+            owner, owner_client = start_gateway('pi-1')
+            owner_client.connect()
+            owner.observe(ADDRESS, -70)
+            owner.announce(owner_client)
+            self.assertTrue(owner.is_owner(ADDRESS))
+
+            # A new gateway with a slightly better RSSI receives the device,
+            # before it gets the retained announcement of the current owner:
+            late, late_client = start_gateway('pi-2')
+            late.observe(ADDRESS, -68)
+            self.assertTrue(late.is_owner(ADDRESS))
+            late_client.connect()
+
+            # The late gateway takes over the claimed owner, because it's not `hysteresis` dB better:
+            self.assertFalse(late.is_owner(ADDRESS))
+            for _ in range(3):
+                owner.announce(owner_client)
+                late.announce(late_client)
+                self.assertEqual([owner.is_owner(ADDRESS), late.is_owner(ADDRESS)], [True, False])
+        self.assertEqual(owner.owner_changes, 1)
+
+        # Both gateways start at the same time: They may claim themselves for a moment, but agree on one owner:
+        broker = FakeBroker()
+        with self.assertLogs('victron_ble2mqtt', level='INFO'), patch('time.monotonic', return_value=100):
+            gateways = [start_gateway('pi-1'), start_gateway('pi-2')]
+            for (election, client), rssi in zip(gateways, (-70, -68)):
+                election.observe(ADDRESS, rssi)
+                election.announce(client)  # Not connected yet: Only the other gateway receives it
+                client.connect()
+            for _ in range(3):
+                for election, client in gateways:
+                    election.announce(client)
+                self.assertEqual([election.is_owner(ADDRESS) for election, _ in gateways].count(True), 1)
@@ -0,0 +1,145 @@
+import asyncio
+import socket
+from pathlib import Path
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from bleak import AdvertisementData, BLEDevice
+from ha_services.mqtt4homeassistant.data_classes import MqttSettings
+from ha_services.mqtt4homeassistant.device import BaseMqttDevice
+from ha_services.tests.base import ComponentTestMixin
+from victron_ble.devices import BatteryMonitor
+
+from victron_ble2mqtt.benchmarks.device_data import encrypt_frame
+from victron_ble2mqtt.energy import EnergyStore
+from victron_ble2mqtt.metrics import PublishLoopMetrics, handle_request
+from victron_ble2mqtt.mqtt_transport import ThreadedMqttTransport
+from victron_ble2mqtt.publisher import MqttPublisher
+from victron_ble2mqtt.replay import CountingMqttClient
+from victron_ble2mqtt.user_settings import UserSettings
+
+
+KEY = '0123456789abcdef0123456789abcdef'
+
+
+def get_advertisement(*, key: str, iv: int) -> AdvertisementData:
+    return AdvertisementData(
+        local_name=None,
+        manufacturer_data={0x02E1: encrypt_frame(BatteryMonitor, key=key, iv=iv)},
+        service_data={},
+        service_uuids=[],
+        tx_power=None,
+        rssi=-70,
+        platform_data=(),
+    )
+
+
+class MetricsTestCase(ComponentTestMixin, IsolatedAsyncioTestCase):
+    async def get_response(self, metrics: PublishLoopMetrics, request: bytes) -> str:
+        client_sock, server_sock = socket.socketpair()
+        server_reader, server_writer = await asyncio.open_connection(sock=server_sock)
+        reader, writer = await asyncio.open_connection(sock=client_sock)
+        writer.write(request)
+        await handle_request(metrics.registry, server_reader, server_writer)
+        response = await reader.read()
+        writer.close()
+        return response.decode()
+
+    async def test_publish_metrics(self):
+        metrics = PublishLoopMetrics()
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), publish_throttle_seconds=0)
+        publisher = MqttPublisher(
+            keys=[KEY],
+            user_settings=user_settings,
+            mqtt_client=CountingMqttClient(),
+            metrics=metrics,
+        )
+        metrics.bind(
+            publisher=publisher,
+            transport=ThreadedMqttTransport(settings=MqttSettings(), verbosity=0),
+        )
+
+        smart_shunt = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        foreign = BLEDevice(address='11:22:33:44:55:66', name='Foreign', details={})
+        with self.assertLogs('victron_ble2mqtt', level='INFO'):
+            publisher.detection_callback(smart_shunt, get_advertisement(key=KEY, iv=1))
+            publisher.detection_callback(smart_shunt, get_advertisement(key=KEY, iv=1))  # Repeated frame
+            publisher.mqtt_client.publish('test/gateways/aabbccddeeff/pi-1', payload='{}')  # e.g.: Gateway election
+            publisher.detection_callback(smart_shunt, get_advertisement(key=KEY, iv=2))
+            publisher.detection_callback(foreign, get_advertisement(key='fe' * 16, iv=1))
+        self.assertIn('foo_bar-aabbccddeeff-soc', BaseMqttDevice.components)
+
+        response = await self.get_response(metrics, b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        self.assertTrue(response.startswith('HTTP/1.1 200 OK\r\n'), response)
+        body = response.split('\r\n\r\n', 1)[1]
+        lines = body.splitlines()
+
+        self.assertIn('victron_ble_advertisements_total 4', lines)
+        self.assertIn('victron_ble_device_advertisements_total{address="AA:BB:CC:DD:EE:FF"} 3', lines)
+        self.assertIn('victron_ble_device_advertisements_total{address="11:22:33:44:55:66"} 1', lines)
+        self.assertIn('victron_ble_frames_total{result="decrypted"} 2', lines)
+        self.assertIn('victron_ble_frames_total{result="deduplicated"} 1', lines)
+        self.assertIn('victron_ble_frames_total{result="throttled"} 0', lines)
+        self.assertIn('victron_ble_discovery_errors_total{error="key_mismatch"} 0', lines)
+        self.assertIn('victron_ble_rejected_addresses_total 1', lines)  # No matching key for the foreign device
+        self.assertIn('victron_ble_handler_publish_seconds_count 2', lines)
+        self.assertIn('victron_mqtt_pending_messages 0', lines)
+
+        # The messages between two frames are not counted for the device:
+        mqtt_messages = metrics.mqtt_messages.labels('AA:BB:CC:DD:EE:FF').value
+        self.assertEqual(mqtt_messages, publisher.mqtt_client.sent - 1)
+        self.assertIn(f'victron_mqtt_messages_total{{address="AA:BB:CC:DD:EE:FF"}} {mqtt_messages}', lines)
+        self.assertIn('victron_mqtt_messages_total{address="other"} 1', lines)
+        self.assertEqual(
+            metrics.mqtt_bytes.labels('AA:BB:CC:DD:EE:FF').value,
+            publisher.mqtt_client.sent_bytes - len(b'{}'),
+        )
+
+        # The per device values are bound once:
+        device_metrics = metrics.get_device('AA:BB:CC:DD:EE:FF')
+        self.assertIs(device_metrics.advertisements, metrics.device_advertisements.labels('AA:BB:CC:DD:EE:FF'))
+        self.assertIs(device_metrics.mqtt_messages, metrics.mqtt_messages.labels('AA:BB:CC:DD:EE:FF'))
+
+        # The per device metrics are removed together with the RSSI info:
+        adapters = publisher.rssi_info.pop('11:22:33:44:55:66')
+        publisher.on_address_evict('11:22:33:44:55:66', adapters)
+        self.assertNotIn('11:22:33:44:55:66', metrics.registry.render())
+        self.assertNotIn('11:22:33:44:55:66', metrics.devices)
+
+        response = await self.get_response(metrics, b'GET / HTTP/1.1\r\n\r\n')
+        self.assertTrue(response.startswith('HTTP/1.1 404 Not Found\r\n'), response)
+
+    async def test_decrypted_throttled_frames(self):
+        metrics = PublishLoopMetrics()
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), publish_throttle_seconds=60)
+        publisher = MqttPublisher(
+            keys=[KEY],
+            user_settings=user_settings,
+            mqtt_client=CountingMqttClient(),
+            metrics=metrics,
+            energy_store=EnergyStore(path=Path('/not/used.json'), max_gap=60),
+        )
+        smart_shunt = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        with self.assertLogs('victron_ble2mqtt', level='INFO'):
+            for iv in range(3):
+                publisher.detection_callback(smart_shunt, get_advertisement(key=KEY, iv=iv))
+
+            # The throttled frames are decrypted for the energy counters:
+            self.assertEqual(publisher.scheduler.dropped_total.total(), 2)
+            self.assertEqual(metrics.frames_decrypted.value, 3)
+
+            # A repeated throttled frame is not decrypted again, the energy is just extended:
+            handler = publisher.victron_mqtt_handler.handler_map['AA:BB:CC:DD:EE:FF']
+            with patch.object(handler, 'extend_power', wraps=handler.extend_power) as extend_power:
+                publisher.detection_callback(smart_shunt, get_advertisement(key=KEY, iv=2))
+        extend_power.assert_called_once_with()
+        self.assertEqual(metrics.frames_decrypted.value, 3)
+        self.assertEqual(publisher.frame_cache.hits, 1)
+
+    async def test_loop_lag(self):
+        metrics = PublishLoopMetrics()
+        task = asyncio.create_task(metrics.measure_loop_lag(interval=0.01))
+        while metrics.loop_lag.count < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        self.assertGreaterEqual(metrics.loop_lag.sum, 0)
@@ -1,15 +1,28 @@
+import json
+import tempfile
+from pathlib import Path
 from unittest import TestCase
+from unittest.mock import patch
 
-from bleak import BLEDevice
+from bleak import AdvertisementData, BLEDevice
+from ha_services.ha_data.validators import ValidationError
+from ha_services.mqtt4homeassistant.components.sensor import Sensor
 from ha_services.mqtt4homeassistant.data_classes import MqttSettings
-from ha_services.mqtt4homeassistant.device import MainMqttDevice
+from ha_services.mqtt4homeassistant.device import BaseMqttDevice, MainMqttDevice, MqttDevice
+from ha_services.mqtt4homeassistant.mocks.mqtt_client_mock import MqttClientMock
 from ha_services.tests.base import ComponentTestMixin
-from paho.mqtt.client import Client
+from paho.mqtt.client import MQTT_ERR_NO_CONN, Client, MQTTMessage, MQTTMessageInfo
 from paho.mqtt.enums import CallbackAPIVersion
-from victron_ble.devices import BatteryMonitor
+from victron_ble.devices import BatteryMonitor, SolarCharger
 
-from victron_ble2mqtt.mqtt import BatteryMonitorHandler, SolarChargerHandler
+from victron_ble2mqtt.benchmarks.device_data import encrypt_frame
+from victron_ble2mqtt.energy import EnergyStore
+from victron_ble2mqtt.mqtt import BatteryMonitorHandler, SolarChargerHandler, VictronMqttDeviceHandler
+from victron_ble2mqtt.publisher import MqttPublisher
+from victron_ble2mqtt.replay import CountingMqttClient
+from victron_ble2mqtt.sensors import SensorSpec, SpecSensor
 from victron_ble2mqtt.user_settings import UserSettings
+from victron_ble2mqtt.victron_ble_utils import DeviceHandler
 
 
 class MqttTestCase(ComponentTestMixin, TestCase):
@@ -32,7 +45,7 @@ class MqttTestCase(ComponentTestMixin, TestCase):
             user_settings=user_settings,
         )
 
-        # Now the test: Initialize all sensors, so that ha-services will validate them:
+        # Now the test: Initialize all sensors (The SensorSpec are validated on import):
         handler.setup(data_dict={'model_name': 'SmartShunt 500A/50mV'})
 
     def test_solar_charger_handler(self):
@@ -54,5 +67,582 @@ class MqttTestCase(ComponentTestMixin, TestCase):
             user_settings=user_settings,
         )
 
-        # Now the test: Initialize all sensors, so that ha-services will validate them:
+        # Now the test: Initialize all sensors (The SensorSpec are validated on import):
         handler.setup(data_dict={'model_name': 'SmartSolar MPPT 100|20 48V'})
+
+    def test_shared_sensor_specs(self):
+        main_mqtt_device = MainMqttDevice(name='foo', uid='bar')
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'))
+        handlers = []
+        for address in ('AA:BB:CC:DD:EE:01', 'AA:BB:CC:DD:EE:02'):
+            handler = SolarChargerHandler(
+                ble_device=BLEDevice(address=address, name='SmartSolar', details={}),
+                main_mqtt_device=main_mqtt_device,
+                victron_device=SolarCharger(advertisement_key='fake-key'),
+                mqtt_client=CountingMqttClient(),
+                user_settings=user_settings,
+            )
+            handler.setup(data_dict={'model_name': 'SmartSolar MPPT 100|20 48V'})
+            handlers.append(handler)
+
+        first, second = handlers
+        self.assertEqual(list(first.sensors), [spec.key for spec in SolarChargerHandler.SENSORS])
+        self.assertIn('external_device_load', first.sensors)  # Data key differs from the uid 'load'
+        for key, sensor in first.sensors.items():
+            other = second.sensors[key]
+            self.assertIsNot(sensor, other)
+            self.assertIs(sensor.spec, other.spec)  # Only the per device state is duplicated
+            self.assertNotEqual(sensor.topic_prefix, other.topic_prefix)
+
+        load = first.sensors['external_device_load']
+        self.assertEqual(load.uid, 'bar-aabbccddee01-load')
+        self.assertEqual(
+            (load.device_class, load.unit_of_measurement, load.suggested_display_precision),
+            ('current', 'A', 1),
+        )
+
+        # Invalid combinations are detected on creation of the spec:
+        with self.assertRaises(ValidationError):
+            SensorSpec(name='Voltage', uid='voltage', device_class='voltage', unit_of_measurement='°C')
+
+    def test_expire_handler(self):
+        key = '0123456789abcdef0123456789abcdef'
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        raw_data = encrypt_frame(BatteryMonitor, key=key)
+        generic_device = DeviceHandler([key]).get_generic_device(ble_device, raw_data)
+
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), device_expire_seconds=60)
+        victron_mqtt_handler = VictronMqttDeviceHandler(user_settings=user_settings)
+        with patch('victron_ble2mqtt.registry.time.monotonic', return_value=100):
+            victron_mqtt_handler.publish(
+                ble_device=ble_device,
+                raw_data=raw_data,
+                generic_device=generic_device,
+                rssi=-70,
+                mqtt_client=MqttClientMock(),
+            )
+        self.assertIn('foo_bar-aabbccddeeff-rssi', BaseMqttDevice.components)
+        self.assertIn('foo_bar-aabbccddeeff-soc', BaseMqttDevice.components)
+
+        with patch('victron_ble2mqtt.registry.time.monotonic', return_value=161):
+            victron_mqtt_handler.handler_map.expire()
+        self.assertEqual(len(victron_mqtt_handler.handler_map), 0)
+        self.assertNotIn('foo_bar-aabbccddeeff-rssi', BaseMqttDevice.components)
+        self.assertNotIn('foo_bar-aabbccddeeff-soc', BaseMqttDevice.components)
+        self.assertIn('foo_bar-hostname', BaseMqttDevice.components)
+
+    def test_change_detection(self):
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'))
+        self.assertEqual(user_settings.change_detection.max_silence_seconds, 300)
+        mqtt_client = MqttClientMock()
+        handler = BatteryMonitorHandler(
+            ble_device=ble_device,
+            main_mqtt_device=MainMqttDevice(name='foo', uid='bar'),
+            victron_device=BatteryMonitor(advertisement_key='fake-key'),
+            mqtt_client=mqtt_client,
+            user_settings=user_settings,
+        )
+        data_dict = {
+            'aux_mode': 'midpoint_voltage',
+            'consumed_ah': -1.2,
+            'current': 1.343,
+            'midpoint_voltage': 13.03,
+            'model_name': 'SmartShunt 500A/50mV',
+            'soc': 98.5,
+            'voltage': 26.22,
+        }
+
+        def get_published_uids(**changes):
+            mqtt_client.messages.clear()
+            handler.publish(data_dict={**data_dict, **changes}, rssi=-70)
+            return sorted(
+                message['topic'].split('/')[-2].removeprefix('bar-aabbccddeeff-')
+                for message in mqtt_client.get_state_messages()
+                if '-aabbccddeeff-' in message['topic']
+            )
+
+        with patch('victron_ble2mqtt.change_detection.time.monotonic', return_value=100):
+            self.assertEqual(
+                get_published_uids(),
+                [
+                    'aux_mode',
+                    'consumed_ah',
+                    'current',
+                    'midpoint_shift',
+                    'midpoint_shift_percent',
+                    'midpoint_voltage',
+                    'power',
+                    'rssi',
+                    'soc',
+                    'voltage',
+                ],
+            )
+
+        with patch('victron_ble2mqtt.change_detection.time.monotonic', return_value=101):
+            # Nothing changed:
+            self.assertEqual(get_published_uids(), [])
+
+            # Changes below the display precision are ignored:
+            self.assertEqual(get_published_uids(soc=98.51), [])
+
+            self.assertEqual(get_published_uids(current=1.5), ['current', 'power'])
+
+        # max. silence reached: Publish all values again:
+        with patch('victron_ble2mqtt.change_detection.time.monotonic', return_value=400):
+            self.assertEqual(len(get_published_uids()), 10)
+
+        # The MQTT client is not connected: paho drops the messages
+        def drop_message(**kwargs) -> MQTTMessageInfo:
+            info = MQTTMessageInfo(mid=0)
+            info.rc = MQTT_ERR_NO_CONN
+            return info
+
+        with patch('victron_ble2mqtt.change_detection.time.monotonic', return_value=401):
+            with patch.object(mqtt_client, 'publish', drop_message):
+                handler.publish(data_dict={**data_dict, 'current': 2.0}, rssi=-70)
+
+            # The dropped value is still a change after the reconnect:
+            self.assertEqual(get_published_uids(current=2.0), ['current', 'power'])
+            self.assertEqual(get_published_uids(current=2.0), [])
+
+    def test_aggregation_window(self):
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), aggregation_window_seconds=30)
+        user_settings.change_detection.enabled = False
+        mqtt_client = MqttClientMock()
+        handler = BatteryMonitorHandler(
+            ble_device=ble_device,
+            main_mqtt_device=MainMqttDevice(name='foo', uid='bar'),
+            victron_device=BatteryMonitor(advertisement_key='fake-key'),
+            mqtt_client=mqtt_client,
+            user_settings=user_settings,
+        )
+        data_dict = {
+            'aux_mode': 'starter_voltage',
+            'current': 1.0,
+            'model_name': 'SmartShunt 500A/50mV',
+            'voltage': 25.0,
+        }
+
+        def publish(monotonic, **changes):
+            mqtt_client.messages.clear()
+            with patch('victron_ble2mqtt.mqtt.time.monotonic', return_value=monotonic):
+                handler.publish(data_dict={**data_dict, **changes}, rssi=-70)
+                handler.publish_window()
+            return {
+                message['topic'].split('/')[-2].removeprefix('bar-aabbccddeeff-'): message['payload']
+                for message in mqtt_client.get_state_messages()
+                if '-aabbccddeeff-' in message['topic']
+            }
+
+        # The first values are published directly:
+        states = publish(100)
+        self.assertEqual(states['current'], 1.0)
+        self.assertEqual(states['current_max'], 1.0)
+        self.assertNotIn('aux_mode_max', states)  # Only measurements have statistics
+
+        # Collect the values until the end of the window:
+        self.assertEqual(publish(110, current=30.0), {})
+        self.assertEqual(publish(120, current=-2.0, aux_mode='temperature'), {})
+        states = publish(130, current=2.0)
+        self.assertEqual(states['current'], 2.0)  # The last value
+        self.assertEqual(states['current_mean'], 10.0)
+        self.assertEqual(states['current_min'], -2.0)
+        self.assertEqual(states['current_max'], 30.0)  # The peak is not lost
+        self.assertEqual(states['power_max'], 750.0)
+        self.assertEqual(states['aux_mode'], 'starter_voltage')
+        self.assertEqual(len(handler.window), 0)
+
+        # The next window starts at the last publish:
+        self.assertEqual(publish(150), {})
+
+    def test_energy_integration(self):
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'))
+        user_settings.change_detection.enabled = False
+        mqtt_client = MqttClientMock()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            state_file = Path(temp_dir) / 'state' / 'energy.json'
+            energy_store = EnergyStore(path=state_file, max_gap=60)
+            with self.assertLogs('victron_ble2mqtt', level='INFO'):
+                energy_store.load()  # No state file yet
+            handler = BatteryMonitorHandler(
+                ble_device=ble_device,
+                main_mqtt_device=MainMqttDevice(name='foo', uid='bar'),
+                victron_device=BatteryMonitor(advertisement_key='fake-key'),
+                mqtt_client=mqtt_client,
+                user_settings=user_settings,
+                energy_store=energy_store,
+            )
+
+            def publish(monotonic, *, current):
+                mqtt_client.messages.clear()
+                with patch('victron_ble2mqtt.mqtt.time.monotonic', return_value=monotonic):
+                    data_dict = {'model_name': 'SmartShunt 500A/50mV', 'current': current, 'voltage': 25.0}
+                    handler.publish(data_dict=data_dict, rssi=-70)
+                    handler.integrate_power(data_dict)
+                    handler.publish_energy()
+                return {
+                    message['topic'].split('/')[-2].removeprefix('bar-aabbccddeeff-'): message['payload']
+                    for message in mqtt_client.get_state_messages()
+                    if '-aabbccddeeff-' in message['topic']
+                }
+
+            states = publish(100, current=4.0)  # 100 W charging
+            self.assertEqual(states['charged_energy'], 0)
+            self.assertEqual(states['discharged_energy'], 0)
+
+            # Not published frames with the same power:
+            with patch('victron_ble2mqtt.mqtt.time.monotonic', return_value=118):
+                handler.extend_power()
+
+            states = publish(136, current=4.0)
+            self.assertEqual(states['charged_energy'], 1.0)  # 100 W * 36 sec.
+
+            states = publish(172, current=-4.0)  # Zero crossing after 18 sec.
+            self.assertEqual(states['charged_energy'], 1.25)
+            self.assertEqual(states['discharged_energy'], 0.25)
+
+            config = BaseMqttDevice.components['bar-aabbccddeeff-charged_energy'].get_config().payload
+            self.assertEqual(config['state_class'], 'total_increasing')
+            self.assertEqual(config['unit_of_measurement'], 'Wh')
+
+            # The counters survive a restart:
+            energy_store.save()
+            new_store = EnergyStore(path=state_file, max_gap=60)
+            with self.assertLogs('victron_ble2mqtt', level='INFO'):
+                new_store.load()
+            integrator = new_store.integrators['bar-aabbccddeeff-power']
+            self.assertEqual((integrator.positive_wh, integrator.negative_wh), (1.25, 0.25))
+
+    def test_energy_of_throttled_frames(self):
+        key = '0123456789abcdef0123456789abcdef'
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), publish_throttle_seconds=60)
+        energy_store = EnergyStore(path=Path('/not/used.json'), max_gap=60)
+        publisher = MqttPublisher(
+            keys=[key],
+            user_settings=user_settings,
+            mqtt_client=CountingMqttClient(),
+            energy_store=energy_store,
+        )
+        with self.assertLogs('victron_ble2mqtt', level='INFO'):
+            for monotonic, iv in ((100, 1), (110, 2)):
+                raw_data = encrypt_frame(BatteryMonitor, key=key, iv=iv)
+                advertisement = AdvertisementData(
+                    local_name=None,
+                    manufacturer_data={0x02E1: raw_data},
+                    service_data={},
+                    service_uuids=[],
+                    tx_power=None,
+                    rssi=-70,
+                    platform_data=(),
+                )
+                with patch('victron_ble2mqtt.mqtt.time.monotonic', return_value=monotonic):
+                    publisher.process(ble_device, raw_data, advertisement)
+        self.assertEqual(publisher.scheduler.get_stats(), {'AA:BB:CC:DD:EE:FF': {'published': 1, 'dropped': 1}})
+        self.assertEqual(energy_store.integrators['foo_bar-aabbccddeeff-power'].last_time, 110)
+
+    def test_json_state(self):
+        key = '0123456789abcdef0123456789abcdef'
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        raw_data = encrypt_frame(BatteryMonitor, key=key)
+        generic_device = DeviceHandler([key]).get_generic_device(ble_device, raw_data)
+
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), json_state=True)
+        victron_mqtt_handler = VictronMqttDeviceHandler(user_settings=user_settings)
+        mqtt_client = MqttClientMock()
+
+        def publish():
+            victron_mqtt_handler.publish(
+                ble_device=ble_device,
+                raw_data=raw_data,
+                generic_device=generic_device,
+                rssi=-70,
+                mqtt_client=mqtt_client,
+            )
+            device_messages = [
+                message for message in mqtt_client.messages if '/foo_bar-aabbccddeeff/' in message['topic']
+            ]
+            mqtt_client.messages.clear()
+            return device_messages
+
+        messages = publish()
+        state_messages = [message for message in messages if message['topic'].endswith('/state')]
+        self.assertEqual(
+            state_messages,
+            [
+                {
+                    'topic': 'homeassistant/sensor/foo_bar-aabbccddeeff/state',
+                    'payload': (
+                        '{"rssi": -70, "aux_mode": "starter_voltage", "consumed_ah": 0.0, "current": 0.0,'
+                        ' "remaining_mins": 0, "soc": 0.0, "voltage": 0.0, "power": 0.0}'
+                    ),
+                }
+            ],
+        )
+        configs = {
+            json.loads(message['payload'])['unique_id']: json.loads(message['payload'])
+            for message in messages
+            if message['topic'].endswith('/config')
+        }
+        self.assertEqual(len(configs), 8)  # Same entities as without JSON state
+        soc_config = configs['foo_bar-aabbccddeeff-soc']
+        self.assertEqual(soc_config['state_topic'], 'homeassistant/sensor/foo_bar-aabbccddeeff/state')
+        self.assertEqual(soc_config['value_template'], '{{ value_json.soc }}')
+
+        # Nothing changed -> No new state message:
+        self.assertEqual(publish(), [])
+
+    def test_discovery_on_ha_birth(self):
+        key = '0123456789abcdef0123456789abcdef'
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        raw_data = encrypt_frame(BatteryMonitor, key=key)
+        generic_device = DeviceHandler([key]).get_generic_device(ble_device, raw_data)
+
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'))
+        victron_mqtt_handler = VictronMqttDeviceHandler(user_settings=user_settings)
+        mqtt_client = MqttClientMock()
+
+        def publish(monotonic):
+            with patch('ha_services.mqtt4homeassistant.components.time.monotonic', return_value=monotonic):
+                victron_mqtt_handler.publish(
+                    ble_device=ble_device,
+                    raw_data=raw_data,
+                    generic_device=generic_device,
+                    rssi=-70,
+                    mqtt_client=mqtt_client,
+                )
+            device_topics = [
+                message['topic'] for message in mqtt_client.messages if '/foo_bar-aabbccddeeff/' in message['topic']
+            ]
+            mqtt_client.messages.clear()
+            return device_topics
+
+        def count_configs(topics):
+            return len([topic for topic in topics if topic.endswith('/config')])
+
+        topics = publish(monotonic=100)
+        self.assertEqual(count_configs(topics), 8)
+        self.assertEqual(len(topics), 16)
+
+        # The configs are not published again by time:
+        self.assertEqual(count_configs(publish(monotonic=100_000)), 0)
+
+        # Other status messages are ignored:
+        message = MQTTMessage(topic=b'homeassistant/status')
+        message.payload = b'offline'
+        with self.assertLogs('victron_ble2mqtt', level='INFO'):
+            victron_mqtt_handler.on_ha_status(mqtt_client, None, message)
+        self.assertEqual(count_configs(publish(monotonic=100_001)), 0)
+
+        # Home Assistant was restarted -> all configs and the last states are published again:
+        message.payload = b'online'
+        with self.assertLogs('victron_ble2mqtt', level='INFO'):
+            victron_mqtt_handler.on_ha_status(mqtt_client, None, message)
+            topics = publish(monotonic=100_002)
+        self.assertEqual(count_configs(topics), 8)
+        self.assertEqual(len(topics), 16)
+        self.assertFalse(victron_mqtt_handler.republish_requested)
+
+    def test_discovery_after_connect(self):
+        key = '0123456789abcdef0123456789abcdef'
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        raw_data = encrypt_frame(BatteryMonitor, key=key)
+        generic_device = DeviceHandler([key]).get_generic_device(ble_device, raw_data)
+
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'))
+        victron_mqtt_handler = VictronMqttDeviceHandler(user_settings=user_settings)
+        mqtt_client = MqttClientMock()
+
+        def drop_message(**kwargs) -> MQTTMessageInfo:
+            info = MQTTMessageInfo(mid=0)
+            info.rc = MQTT_ERR_NO_CONN
+            return info
+
+        def publish(monotonic) -> list[str]:
+            with patch('ha_services.mqtt4homeassistant.components.time.monotonic', return_value=monotonic):
+                victron_mqtt_handler.publish(
+                    ble_device=ble_device,
+                    raw_data=raw_data,
+                    generic_device=generic_device,
+                    rssi=-70,
+                    mqtt_client=mqtt_client,
+                )
+            topics = [message['topic'] for message in mqtt_client.messages]
+            mqtt_client.messages.clear()
+            return [topic for topic in topics if topic.endswith('/config')]
+
+        # The first frames arrive before the CONNACK: paho drops all messages
+        with patch.object(mqtt_client, 'publish', drop_message):
+            self.assertEqual(publish(monotonic=100), [])
+
+        # Connected: All configs are published, also the ones of the main device sensors:
+        victron_mqtt_handler.on_connect(mqtt_client, None, {}, 0, None)
+        with self.assertLogs('victron_ble2mqtt', level='INFO'):
+            config_topics = publish(monotonic=101)
+        self.assertEqual(len([topic for topic in config_topics if '/foo_bar-aabbccddeeff-' in topic]), 8)
+        self.assertIn('homeassistant/sensor/foo_bar/foo_bar-process_cpu_usage/config', config_topics)
+
+        # ...and only once:
+        self.assertEqual(publish(monotonic=102), [])
+
+    def test_subscribe_ha_status(self):
+        victron_mqtt_handler = VictronMqttDeviceHandler(
+            user_settings=UserSettings(mqtt=MqttSettings(main_uid='foo_bar')),
+        )
+        mqtt_client = Client(callback_api_version=CallbackAPIVersion.VERSION2)
+        connects = []
+        mqtt_client.on_connect = lambda *args: connects.append(args)
+        victron_mqtt_handler.subscribe_ha_status(mqtt_client)
+
+        with patch.object(mqtt_client, 'subscribe') as subscribe:
+            mqtt_client.on_connect(mqtt_client, None, {}, 0, None)
+        subscribe.assert_called_once_with('homeassistant/status')
+        self.assertEqual(connects, [(mqtt_client, None, {}, 0, None)])
+        self.assertTrue(victron_mqtt_handler.republish_requested)  # Discovery messages may be dropped before
+
+    def test_device_discovery(self):
+        key = '0123456789abcdef0123456789abcdef'
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        raw_data = encrypt_frame(BatteryMonitor, key=key)
+        generic_device = DeviceHandler([key]).get_generic_device(ble_device, raw_data)
+
+        def publish(user_settings):
+            BaseMqttDevice.components.clear()
+            victron_mqtt_handler = VictronMqttDeviceHandler(user_settings=user_settings)
+            mqtt_client = MqttClientMock()
+            victron_mqtt_handler.publish(
+                ble_device=ble_device,
+                raw_data=raw_data,
+                generic_device=generic_device,
+                rssi=-70,
+                mqtt_client=mqtt_client,
+            )
+            return [message for message in mqtt_client.messages if 'foo_bar-aabbccddeeff' in message['topic']]
+
+        component_messages = publish(UserSettings(mqtt=MqttSettings(main_uid='foo_bar')))
+        component_configs = [message for message in component_messages if message['topic'].endswith('/config')]
+        self.assertEqual(len(component_configs), 8)
+
+        with self.assertLogs('victron_ble2mqtt', level='INFO') as logs:
+            device_messages = publish(UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), device_discovery=True))
+        self.assertIn(
+            'INFO:victron_ble2mqtt.mqtt:Publishing foo_bar-aabbccddeeff device config with 8 components',
+            logs.output,
+        )
+        device_configs = [message for message in device_messages if message['topic'].endswith('/config')]
+        self.assertEqual(len(device_configs), 1)
+        device_config = device_configs[0]
+        self.assertEqual(device_config['topic'], 'homeassistant/device/foo_bar-aabbccddeeff/config')
+        self.assertIs(device_config['retain'], True)
+
+        payload = json.loads(device_config['payload'])
+        self.assertEqual(payload['dev']['identifiers'], 'foo_bar-aabbccddeeff')
+        self.assertEqual(
+            payload['cmps']['foo_bar-aabbccddeeff-soc'],
+            {
+                'device_class': 'battery',
+                '~': 'homeassistant/sensor/foo_bar-aabbccddeeff/foo_bar-aabbccddeeff-soc',
+                'json_attributes_topic': '~/attributes',
+                'name': 'State of Charge',
+                'p': 'sensor',
+                'state_class': 'measurement',
+                'state_topic': '~/state',
+                'suggested_display_precision': 1,
+                'unique_id': 'foo_bar-aabbccddeeff-soc',
+                'unit_of_measurement': '%',
+            },
+        )
+        self.assertEqual(
+            sorted(payload['cmps']),
+            sorted(json.loads(message['payload'])['unique_id'] for message in component_configs),
+        )
+
+        # The device block is sent only once:
+        self.assertLess(
+            len(device_config['payload']),
+            sum(len(message['payload']) for message in component_configs) * 0.6,
+        )
+
+        # The states are published again after the device config, because they were unknown before:
+        device_states = [message for message in device_messages if message['topic'].endswith('/state')]
+        self.assertEqual(len(device_states), 16)
+        self.assertEqual(device_messages.index(device_config), 8)
+
+    def test_device_discovery_not_connected(self):
+        key = '0123456789abcdef0123456789abcdef'
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        raw_data = encrypt_frame(BatteryMonitor, key=key)
+        generic_device = DeviceHandler([key]).get_generic_device(ble_device, raw_data)
+
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), device_discovery=True)
+        victron_mqtt_handler = VictronMqttDeviceHandler(user_settings=user_settings)
+        mqtt_client = MqttClientMock()
+
+        def drop_message(**kwargs) -> MQTTMessageInfo:
+            info = MQTTMessageInfo(mid=0)
+            info.rc = MQTT_ERR_NO_CONN
+            return info
+
+        with self.assertLogs('victron_ble2mqtt', level='INFO'), patch.object(mqtt_client, 'publish', drop_message):
+            victron_mqtt_handler.publish(
+                ble_device=ble_device,
+                raw_data=raw_data,
+                generic_device=generic_device,
+                rssi=-70,
+                mqtt_client=mqtt_client,
+            )
+        handler = victron_mqtt_handler.handler_map['AA:BB:CC:DD:EE:FF']
+        self.assertTrue(handler.device_config_changed)
+
+        # Connected: The device config is published with the next frame
+        with self.assertLogs('victron_ble2mqtt', level='INFO'):
+            self.assertTrue(handler.publish_device_config())
+        self.assertFalse(handler.device_config_changed)
+        self.assertEqual(
+            [message['topic'] for message in mqtt_client.messages],
+            ['homeassistant/device/foo_bar-aabbccddeeff/config'],
+        )
+        self.assertFalse(handler.publish_device_config())
+
+    def test_spec_sensor(self):
+        device = MqttDevice(main_device=MainMqttDevice(name='foo', uid='bar'), name='SmartShunt', uid='aabbccddeeff')
+        spec = SensorSpec(name='Current', uid='current', device_class='current', unit_of_measurement='A')
+        with self.assertLogs('ha_services', level='INFO'):
+            sensor = Sensor(
+                device=device,
+                name=spec.name,
+                uid=spec.uid,
+                device_class=spec.device_class,
+                unit_of_measurement=spec.unit_of_measurement,
+            )
+        BaseMqttDevice.components.pop(sensor.uid)
+        spec_sensor = SpecSensor(device=device, spec=spec)
+
+        # Only the per device values are stored in the instance:
+        self.assertEqual(
+            sorted(vars(spec_sensor)),
+            [
+                '_config_kwargs_cache',
+                '_next_config_publish',
+                '_next_publish',
+                'device',
+                'spec',
+                'state',
+                'topic_prefix',
+                'uid',
+            ],
+        )
+        self.assertLess(len(vars(spec_sensor)), len(vars(sensor)))
+
+        # ...but it's the same as a ha_services Sensor:
+        self.assertEqual(spec_sensor.get_config(), sensor.get_config())
+        spec_sensor.set_state(1.5)
+        sensor.set_state(1.5)
+        self.assertEqual(spec_sensor.get_state(), sensor.get_state())
+        self.assertEqual(
+            (spec_sensor.throttle_sec, spec_sensor.config_throttle_sec, spec_sensor.qos, spec_sensor.retain),
+            (sensor.throttle_sec, sensor.config_throttle_sec, sensor.qos, sensor.retain),
+        )
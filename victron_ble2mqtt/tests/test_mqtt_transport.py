@@ -0,0 +1,135 @@
+import asyncio
+import socket
+import time
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+import paho.mqtt.client as mqtt
+from ha_services.mqtt4homeassistant.data_classes import MqttSettings
+
+from victron_ble2mqtt.mqtt_transport import AsyncioMqttTransport, ThreadedMqttTransport
+
+
+CONNACK = bytes((0x20, 0x02, 0x00, 0x00))
+
+MQTT_SETTINGS = MqttSettings(host='127.0.0.1', port=1883, user_name='', password='')
+
+
+class MinimalBroker:
+    """
+    Just enough MQTT 3.1.1 to accept a connection and receive QoS 0 messages.
+    """
+
+    def __init__(self):
+        self.topics = []
+        self.disconnected = asyncio.Event()
+
+    async def read_packet(self, reader: asyncio.StreamReader) -> tuple[int, bytes]:
+        packet_type = (await reader.readexactly(1))[0] >> 4
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return packet_type, await reader.readexactly(length)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                packet_type, body = await self.read_packet(reader)
+                if packet_type == 1:  # CONNECT
+                    writer.write(CONNACK)
+                    await writer.drain()
+                elif packet_type == 3:  # PUBLISH
+                    topic_length = int.from_bytes(body[:2], 'big')
+                    self.topics.append(body[2 : 2 + topic_length].decode())
+                elif packet_type == 14:  # DISCONNECT
+                    break
+        except asyncio.IncompleteReadError:
+            pass
+        writer.close()
+        self.disconnected.set()
+
+
+class AsyncioMqttTransportTestCase(IsolatedAsyncioTestCase):
+    async def test_publish_and_flush(self):
+        # Connect paho via a socket pair to the broker: Tests should not make real requests.
+        client_sock, broker_sock = socket.socketpair()
+        broker = MinimalBroker()
+        reader, writer = await asyncio.open_connection(sock=broker_sock)
+        broker_task = asyncio.create_task(broker.handle_client(reader, writer))
+
+        transport = AsyncioMqttTransport(
+            settings=MQTT_SETTINGS,
+            verbosity=0,
+            max_pending=2,
+        )
+        with self.assertLogs('victron_ble2mqtt', level='DEBUG'):
+            with patch('socket.create_connection', return_value=client_sock):
+                await transport.start()
+            for number in range(5):
+                transport.client.publish(topic=f'test/{number}', payload='foo')
+            self.assertGreaterEqual(transport.client.pending, 2)
+
+            # The I/O is done by the event loop:
+            await transport.wait_for_capacity()
+            self.assertLess(transport.client.pending, 2)
+            self.assertTrue(await transport.flush(timeout=5))
+
+            for _ in range(100):
+                if len(broker.topics) == 5:
+                    break
+                await asyncio.sleep(0.01)
+
+            transport.stop()
+            await asyncio.wait_for(broker.disconnected.wait(), timeout=5)
+        await broker_task
+
+        self.assertEqual(broker.topics, ['test/0', 'test/1', 'test/2', 'test/3', 'test/4'])
+        self.assertEqual(transport.get_stats()['published'], 5)
+        self.assertEqual(transport.backpressure_waits, 1)
+
+    async def test_broker_down_at_boot(self):
+        for TransportClass in (AsyncioMqttTransport, ThreadedMqttTransport):
+            with self.subTest(transport=TransportClass.name):
+                transport = TransportClass(settings=MQTT_SETTINGS, verbosity=0)
+                with (
+                    self.assertLogs('victron_ble2mqtt', level='DEBUG'),
+                    patch('socket.create_connection', side_effect=ConnectionRefusedError('Connection refused')),
+                ):
+                    await transport.start()  # Should not raise
+                    self.assertFalse(transport.client.is_connected())
+
+                    # Without a StoreAndForward the messages are dropped, until the broker is reachable:
+                    info = transport.client.publish(topic='test/0', payload='foo')
+                    self.assertEqual(info.rc, mqtt.MQTT_ERR_NO_CONN)
+                    transport.stop()
+
+    async def test_unreachable_broker(self):
+        def create_connection(*args, **kwargs):
+            time.sleep(0.3)  # e.g.: No route to the broker: Wait for the TCP connect timeout
+            raise TimeoutError('timed out')
+
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker_task = asyncio.create_task(ticker())
+        transport = AsyncioMqttTransport(settings=MQTT_SETTINGS, verbosity=0)
+        with (
+            self.assertLogs('victron_ble2mqtt', level='WARNING'),
+            patch('socket.create_connection', create_connection),
+        ):
+            await transport.start()
+            await asyncio.sleep(0.1)  # misc_loop() retries the connect in the background
+            transport.stop()
+        ticker_task.cancel()
+
+        # The event loop was not blocked by the connect attempts:
+        self.assertGreater(ticks, 20)
@@ -0,0 +1,83 @@
+import io
+import tempfile
+from contextlib import redirect_stdout
+from pathlib import Path
+from unittest import TestCase
+
+from bleak import AdvertisementData, BLEDevice
+from ha_services.mqtt4homeassistant.data_classes import MqttSettings
+from ha_services.mqtt4homeassistant.device import BaseMqttDevice
+from ha_services.tests.base import ComponentTestMixin
+from victron_ble.devices import BatteryMonitor
+
+from victron_ble2mqtt.benchmarks.device_data import encrypt_frame
+from victron_ble2mqtt.cli_app.profiling import profile_summary
+from victron_ble2mqtt.profiling import RollingProfiler, get_profile_files, get_stage_stats, load_profiles
+from victron_ble2mqtt.publisher import MqttPublisher
+from victron_ble2mqtt.replay import CountingMqttClient
+from victron_ble2mqtt.user_settings import UserSettings
+
+
+KEY = '0123456789abcdef0123456789abcdef'
+
+
+class ProfilingTestCase(ComponentTestMixin, TestCase):
+    def test_rolling_profiler(self):
+        publisher = MqttPublisher(
+            keys=[KEY],
+            user_settings=UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), publish_throttle_seconds=0),
+            mqtt_client=CountingMqttClient(),
+        )
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+
+        # Build the frames before profiling: encrypt_frame() uses values2dict(), too.
+        advertisements = [
+            AdvertisementData(
+                local_name=None,
+                manufacturer_data={0x02E1: encrypt_frame(BatteryMonitor, key=KEY, iv=iv)},
+                service_data={},
+                service_uuids=[],
+                tx_power=None,
+                rssi=-70,
+                platform_data=(),
+            )
+            for iv in range(4)
+        ]
+
+        with tempfile.TemporaryDirectory() as temp_dir, self.assertLogs('victron_ble2mqtt', level='INFO'):
+            directory = Path(temp_dir) / 'profiles'
+            profiler = RollingProfiler(directory=directory, interval=60, keep=1)
+            self.assertIsNone(profiler.stop())  # Not started yet
+            profiler.start()
+            for advertisement in advertisements[:3]:
+                publisher.detection_callback(ble_device, advertisement)
+            first_path = profiler.dump()
+            publisher.detection_callback(ble_device, advertisements[3])
+            last_path = profiler.stop()
+
+            self.assertIsNone(profiler.profile)
+            self.assertNotEqual(first_path, last_path)
+            self.assertEqual(get_profile_files(directory), [last_path])  # Only the newest is kept
+
+            stage_stats = get_stage_stats(load_profiles([last_path]))
+            self.assertEqual(stage_stats['BLE callback'].calls, 1)
+            self.assertEqual(stage_stats['decrypt'].calls, 1)
+            self.assertEqual(stage_stats['values2dict'].calls, 1)
+            self.assertEqual(stage_stats['handler publish'].calls, 1)
+            self.assertEqual(stage_stats['MQTT publish'].calls, 0)  # CountingMqttClient is used
+            self.assertIn('foo_bar-aabbccddeeff-soc', BaseMqttDevice.components)
+
+            with redirect_stdout(io.StringIO()) as buffer:
+                profile_summary(verbosity=0, path=directory, limit=5)
+            output = buffer.getvalue()
+            self.assertIn('Pipeline stages', output)
+            self.assertIn('values2dict', output)
+            self.assertIn('Top 5 hot spots', output)
+
+    def test_keep_no_files(self):
+        with self.assertRaisesRegex(AssertionError, 'Invalid keep=0'):
+            RollingProfiler(directory=Path('/not/used'), interval=60, keep=0)
+
+        profiler = RollingProfiler(directory=Path('/not/used'), interval=60, keep=1)
+        with self.assertRaisesRegex(AssertionError, 'Profiler not started'):
+            profiler.dump()
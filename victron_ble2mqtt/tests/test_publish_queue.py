@@ -0,0 +1,76 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from bleak import AdvertisementData, BLEDevice
+from ha_services.mqtt4homeassistant.data_classes import MqttSettings
+from ha_services.mqtt4homeassistant.device import BaseMqttDevice
+from ha_services.tests.base import ComponentTestMixin
+from victron_ble.devices import BatteryMonitor
+
+from victron_ble2mqtt.benchmarks.device_data import encrypt_frame
+from victron_ble2mqtt.publish_queue import CoalescingQueue
+from victron_ble2mqtt.publisher import MqttPublisher
+from victron_ble2mqtt.replay import CountingMqttClient
+from victron_ble2mqtt.user_settings import UserSettings
+
+
+KEY = '0123456789abcdef0123456789abcdef'
+
+
+def get_advertisement(*, iv: int) -> AdvertisementData:
+    return AdvertisementData(
+        local_name=None,
+        manufacturer_data={0x02E1: encrypt_frame(BatteryMonitor, key=KEY, iv=iv)},
+        service_data={},
+        service_uuids=[],
+        tx_power=None,
+        rssi=-70,
+        platform_data=(),
+    )
+
+
+class PublishQueueTestCase(ComponentTestMixin, IsolatedAsyncioTestCase):
+    async def test_drop_oldest(self):
+        queue = CoalescingQueue(max_size=2)
+        queue.put('AA', 'frame 1')
+        queue.put('BB', 'frame 2')
+        with self.assertLogs('victron_ble2mqtt', level='DEBUG') as logs:
+            queue.put('CC', 'frame 3')  # Queue is full -> drop the oldest
+        self.assertEqual(logs.output, ['DEBUG:victron_ble2mqtt.publish_queue:Publish queue full: Drop frame from AA'])
+        self.assertEqual(await queue.get(), 'frame 2')
+        self.assertEqual(queue.get_stats(), {'depth': 1, 'max_depth': 2, 'queued': 3, 'coalesced': 0, 'dropped': 1})
+
+    async def test_coalescing_worker(self):
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), publish_throttle_seconds=0)
+        publisher = MqttPublisher(
+            keys=[KEY],
+            user_settings=user_settings,
+            mqtt_client=CountingMqttClient(),
+            queue_size=10,
+        )
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+
+        # A burst of frames from the same device, before the worker can run:
+        for iv in range(5):
+            publisher.detection_callback(ble_device, get_advertisement(iv=iv))
+        self.assertEqual(publisher.queue.get_stats()['depth'], 1)
+        self.assertEqual(publisher.queue.coalesced, 4)
+        self.assertEqual(publisher.intake_durations.count, 5)
+        self.assertEqual(publisher.process_durations.count, 0)
+        self.assertNotIn('foo_bar-aabbccddeeff-soc', BaseMqttDevice.components)
+
+        worker = asyncio.create_task(publisher.run_worker())
+        with self.assertLogs('victron_ble2mqtt', level='INFO'):
+            for _ in range(5):
+                await asyncio.sleep(0)
+        worker.cancel()
+
+        # Only the newest frame is processed:
+        self.assertEqual(len(publisher.queue), 0)
+        self.assertEqual(publisher.process_durations.count, 1)
+        self.assertEqual(publisher.scheduler.published, {'AA:BB:CC:DD:EE:FF': 1})
+        self.assertIn('foo_bar-aabbccddeeff-soc', BaseMqttDevice.components)
+        self.assertEqual(
+            publisher.frame_cache.frames.peek('AA:BB:CC:DD:EE:FF'),
+            get_advertisement(iv=4).manufacturer_data[0x02E1][5:],
+        )
@@ -0,0 +1,53 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from victron_ble2mqtt.publish_scheduler import PublishScheduler
+
+
+class PublishSchedulerTestCase(TestCase):
+    def test_throttle_per_device(self):
+        scheduler = PublishScheduler(throttle_seconds=10)
+
+        with patch('victron_ble2mqtt.publish_scheduler.time.monotonic', return_value=100):
+            self.assertTrue(scheduler.should_publish('chatty'))
+            for _ in range(5):
+                self.assertFalse(scheduler.should_publish('chatty'))
+
+            # The chatty device doesn't block other devices:
+            self.assertTrue(scheduler.should_publish('quiet'))
+
+        with patch('victron_ble2mqtt.publish_scheduler.time.monotonic', return_value=110):
+            self.assertTrue(scheduler.should_publish('chatty'))
+            self.assertTrue(scheduler.should_publish('quiet'))
+
+        self.assertEqual(
+            scheduler.get_stats(),
+            {
+                'chatty': {'published': 2, 'dropped': 5},
+                'quiet': {'published': 2, 'dropped': 0},
+            },
+        )
+
+    def test_global_rate_cap(self):
+        with patch('victron_ble2mqtt.publish_scheduler.time.monotonic', return_value=0):
+            scheduler = PublishScheduler(throttle_seconds=1, max_per_minute=60)
+            self.assertTrue(scheduler.should_publish('one'))
+            self.assertFalse(scheduler.should_publish('two'))  # No token left
+
+        with patch('victron_ble2mqtt.publish_scheduler.time.monotonic', return_value=1):
+            self.assertTrue(scheduler.should_publish('two'))
+
+        # Two devices share one publish per second -> every device may publish every 2 seconds:
+        self.assertEqual(scheduler.get_interval(), 2)
+
+        with patch('victron_ble2mqtt.publish_scheduler.time.monotonic', return_value=2):
+            self.assertFalse(scheduler.should_publish('two'))
+            self.assertTrue(scheduler.should_publish('one'))
+
+        self.assertEqual(
+            scheduler.get_stats(),
+            {
+                'one': {'published': 2, 'dropped': 0},
+                'two': {'published': 1, 'dropped': 2},
+            },
+        )
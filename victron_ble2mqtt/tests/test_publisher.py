@@ -0,0 +1,186 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from bleak import AdvertisementData, BLEDevice
+from ha_services.mqtt4homeassistant.data_classes import MqttSettings
+from ha_services.mqtt4homeassistant.device import BaseMqttDevice
+from ha_services.tests.base import ComponentTestMixin
+from victron_ble.devices import BatteryMonitor
+
+from victron_ble2mqtt.benchmarks.device_data import encrypt_frame
+from victron_ble2mqtt.device_cache import DeviceCache, get_key_hash
+from victron_ble2mqtt.election import GatewayElection
+from victron_ble2mqtt.publisher import MqttPublisher
+from victron_ble2mqtt.replay import CountingMqttClient
+from victron_ble2mqtt.user_settings import UserSettings
+
+
+KEY = '0123456789abcdef0123456789abcdef'
+OTHER_KEY = '0123456789abcdef0123456789abcdff'  # Same key check byte
+
+
+def get_advertisement(*, iv: int, rssi: int) -> AdvertisementData:
+    return AdvertisementData(
+        local_name=None,
+        manufacturer_data={0x02E1: encrypt_frame(BatteryMonitor, key=KEY, iv=iv)},
+        service_data={},
+        service_uuids=[],
+        tx_power=None,
+        rssi=rssi,
+        platform_data=(),
+    )
+
+
+class MqttPublisherTestCase(ComponentTestMixin, TestCase):
+    def test_multiple_adapters(self):
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), publish_throttle_seconds=0)
+        publisher = MqttPublisher(keys=[KEY], user_settings=user_settings, mqtt_client=CountingMqttClient())
+        hci0 = publisher.get_detection_callback('hci0')
+        hci1 = publisher.get_detection_callback('hci1')
+
+        smart_shunt = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        with self.assertLogs('victron_ble2mqtt', level='INFO'):
+            hci1(smart_shunt, get_advertisement(iv=1, rssi=-60))
+            hci0(smart_shunt, get_advertisement(iv=1, rssi=-90))  # Same frame from the other adapter
+            hci0(smart_shunt, get_advertisement(iv=2, rssi=-92))
+
+        # The duplicate frame is not processed again:
+        self.assertEqual(publisher.process_durations.count, 2)
+        self.assertEqual(publisher.frame_cache.hits, 1)
+
+        # The best RSSI of both adapters is published:
+        self.assertEqual(publisher.get_rssi('AA:BB:CC:DD:EE:FF'), -60)
+        self.assertEqual(BaseMqttDevice.components['foo_bar-aabbccddeeff-rssi'].state, -60)
+
+        self.assertEqual(
+            publisher.get_adapter_stats(),
+            {
+                'hci0': {'AA:BB:CC:DD:EE:FF': {'received': 2, 'rssi': -92}},
+                'hci1': {'AA:BB:CC:DD:EE:FF': {'received': 1, 'rssi': -60}},
+            },
+        )
+
+        # Forget evicted devices:
+        adapters = publisher.rssi_info.pop('AA:BB:CC:DD:EE:FF')
+        publisher.on_address_evict('AA:BB:CC:DD:EE:FF', adapters)
+        self.assertEqual(publisher.get_adapter_stats(), {'hci0': {}, 'hci1': {}})
+
+    def test_heartbeat_of_repeated_frames(self):
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), publish_throttle_seconds=0)
+        self.assertEqual(user_settings.change_detection.max_silence_seconds, 300)
+        mqtt_client = CountingMqttClient()
+        publisher = MqttPublisher(keys=[KEY], user_settings=user_settings, mqtt_client=mqtt_client)
+
+        smart_shunt = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        with self.assertLogs('victron_ble2mqtt', level='INFO'):
+            with patch('victron_ble2mqtt.change_detection.time.monotonic', return_value=100):
+                publisher.detection_callback(smart_shunt, get_advertisement(iv=1, rssi=-60))
+            sent = mqtt_client.sent
+
+            # A device with constant values sends always the same frame:
+            with patch('victron_ble2mqtt.change_detection.time.monotonic', return_value=200):
+                publisher.detection_callback(smart_shunt, get_advertisement(iv=1, rssi=-70))
+            self.assertEqual(publisher.process_durations.count, 1)
+            self.assertEqual(mqtt_client.sent, sent)
+
+            # max. silence reached: The repeated frame is published again
+            with patch('victron_ble2mqtt.change_detection.time.monotonic', return_value=401):
+                publisher.detection_callback(smart_shunt, get_advertisement(iv=1, rssi=-70))
+            self.assertEqual(publisher.process_durations.count, 2)
+            self.assertGreater(mqtt_client.sent, sent)
+            self.assertEqual(BaseMqttDevice.components['foo_bar-aabbccddeeff-rssi'].state, -70)
+            sent = mqtt_client.sent
+
+            with patch('victron_ble2mqtt.change_detection.time.monotonic', return_value=402):
+                publisher.detection_callback(smart_shunt, get_advertisement(iv=1, rssi=-70))
+            self.assertEqual(publisher.process_durations.count, 2)
+            self.assertEqual(mqtt_client.sent, sent)
+        self.assertEqual(publisher.frame_cache.hits, 3)
+
+    def test_device_of_other_gateway(self):
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), publish_throttle_seconds=0)
+        election = GatewayElection(gateway_id='pi-1', topic='test/gateways', interval=10, hysteresis=5)
+        publisher = MqttPublisher(
+            keys=[KEY],
+            user_settings=user_settings,
+            mqtt_client=CountingMqttClient(),
+            election=election,
+        )
+        election.owners['AA:BB:CC:DD:EE:FF'] = 'pi-2'
+
+        smart_shunt = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        publisher.detection_callback(smart_shunt, get_advertisement(iv=1, rssi=-60))
+
+        # The frame is dropped before decryption, but the RSSI is collected for the next election:
+        self.assertEqual(publisher.process_durations.count, 0)
+        self.assertEqual(election.dropped, 1)
+        self.assertEqual(election.rssi, {'AA:BB:CC:DD:EE:FF': -60})
+
+    def test_device_cache(self):
+        user_settings = UserSettings(mqtt=MqttSettings(main_uid='foo_bar'), publish_throttle_seconds=0)
+        smart_shunt = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_path = Path(temp_dir) / 'devices.json'
+
+            device_cache = DeviceCache(path=cache_path)
+            publisher = MqttPublisher(
+                keys=[OTHER_KEY, KEY],
+                user_settings=user_settings,
+                mqtt_client=CountingMqttClient(),
+                device_cache=device_cache,
+            )
+            with self.assertLogs('victron_ble2mqtt', level='INFO'):
+                publisher.detection_callback(smart_shunt, get_advertisement(iv=1, rssi=-60))
+            self.assertEqual(publisher.device_handler.decrypt_attempts, 2)  # The other key is tried first
+            entry = device_cache.devices['AA:BB:CC:DD:EE:FF']
+            self.assertEqual(
+                {key: value for key, value in entry.items() if key != 'setup_data'},
+                {
+                    'name': 'SmartShunt',
+                    'device_class': 'BatteryMonitor',
+                    'key_index': 1,
+                    'key_hash': get_key_hash(KEY),
+                    'handler': 'BatteryMonitorHandler',
+                },
+            )
+            self.assertEqual(entry['setup_data']['model_name'], 'SmartShunt 500A/50mV')
+            self.assertTrue(cache_path.exists())  # A new device is saved immediately
+            self.assertFalse(device_cache.changed)
+
+            # Restart:
+            BaseMqttDevice.components.clear()
+            device_cache = DeviceCache(path=cache_path)
+            with self.assertLogs('victron_ble2mqtt', level='INFO'):
+                device_cache.load()
+                publisher = MqttPublisher(
+                    keys=[OTHER_KEY, KEY],
+                    user_settings=user_settings,
+                    mqtt_client=CountingMqttClient(),
+                    device_cache=device_cache,
+                )
+                self.assertEqual(publisher.restore_devices(), 1)
+
+            # The sensors are set up before the first advertisement:
+            self.assertIn('foo_bar-aabbccddeeff-soc', BaseMqttDevice.components)
+            self.assertFalse(device_cache.changed)
+
+            publisher.detection_callback(smart_shunt, get_advertisement(iv=2, rssi=-60))
+            self.assertEqual(publisher.device_handler.decrypt_attempts, 1)  # The cached key is tried first
+            self.assertEqual(publisher.process_durations.count, 1)
+            self.assertEqual(BaseMqttDevice.components['foo_bar-aabbccddeeff-rssi'].state, -60)
+
+            # The key was removed from the settings:
+            BaseMqttDevice.components.clear()
+            publisher = MqttPublisher(
+                keys=[OTHER_KEY],
+                user_settings=user_settings,
+                mqtt_client=CountingMqttClient(),
+                device_cache=device_cache,
+            )
+            with self.assertLogs('victron_ble2mqtt', level='INFO'):
+                self.assertEqual(publisher.restore_devices(), 0)
+            self.assertEqual(device_cache.devices, {})
+            self.assertTrue(device_cache.changed)
@@ -0,0 +1,76 @@
+import random
+import time
+import tracemalloc
+from unittest import TestCase
+from unittest.mock import patch
+
+from bleak import BLEDevice
+from victron_ble.devices import BatteryMonitor
+
+from victron_ble2mqtt import registry, victron_ble_utils
+from victron_ble2mqtt.benchmarks.device_data import encrypt_frame
+from victron_ble2mqtt.registry import ExpiringRegistry
+from victron_ble2mqtt.victron_ble_utils import DeviceHandler
+
+
+def random_address(rnd: random.Random) -> str:
+    return ':'.join(f'{rnd.randrange(256):02X}' for _ in range(6))
+
+
+class ExpiringRegistryTestCase(TestCase):
+    def test_ttl(self):
+        evicted = []
+        registry = ExpiringRegistry(name='test', ttl=10, on_evict=lambda key, value: evicted.append((key, value)))
+
+        with patch('victron_ble2mqtt.registry.time.monotonic', return_value=100):
+            registry['old'] = 1
+            registry['used'] = 2
+        with patch('victron_ble2mqtt.registry.time.monotonic', return_value=105):
+            self.assertEqual(registry['used'], 2)
+        with patch('victron_ble2mqtt.registry.time.monotonic', return_value=111):
+            registry['new'] = 3  # Will expire the 'old' entry
+
+        self.assertEqual(list(registry.items()), [('used', 2), ('new', 3)])
+        self.assertEqual(evicted, [('old', 1)])
+
+        with patch('victron_ble2mqtt.registry.time.monotonic', return_value=200):
+            registry.expire()
+        self.assertEqual(len(registry), 0)
+        self.assertEqual(registry.get_stats(), {'size': 0, 'max_size': 0, 'evicted': 0, 'expired': 3})
+
+    def test_soak_random_addresses(self):
+        """
+        A churn of random BLE addresses must not grow the memory usage.
+        """
+        rnd = random.Random(1)
+        raw_data = encrypt_frame(BatteryMonitor, key='fe' * 16)  # No matching key -> rejected
+        device_handler = DeviceHandler(keys=['01' * 16], max_addresses=100)
+        rssi_info = ExpiringRegistry(name='rssi', max_size=100)
+
+        def churn(count):
+            for _ in range(count):
+                address = random_address(rnd)
+                rssi_info[address] = -80
+                device = BLEDevice(address=address, name=None, details={})
+                self.assertIsNone(device_handler.get_generic_device(device, raw_data))
+
+        # Don't log the "Ignore ..." warnings and "Remove ..." debug messages:
+        with patch.object(victron_ble_utils.logger, 'disabled', True), patch.object(registry.logger, 'disabled', True):
+            tracemalloc.start()
+            try:
+                churn(500)  # Fill all registries
+                start_size, _ = tracemalloc.get_traced_memory()
+                start_time = time.monotonic()
+                churn(3_000)
+                end_size, _ = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+        self.assertEqual(len(device_handler.rejected), 100)
+        self.assertEqual(len(rssi_info), 100)
+        self.assertEqual(device_handler.rejected.evicted, 3_500 - 100)
+        self.assertLess(
+            end_size - start_size,
+            50 * 1024,
+            f'Memory grows from {start_size} to {end_size} bytes in {time.monotonic() - start_time:.1f} sec.',
+        )
@@ -0,0 +1,165 @@
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from ha_services.mqtt4homeassistant.data_classes import MqttSettings
+from ha_services.mqtt4homeassistant.device import BaseMqttDevice
+from ha_services.tests.base import ComponentTestMixin
+from victron_ble.devices import BatteryMonitor
+
+import victron_ble2mqtt
+from victron_ble2mqtt.benchmarks.device_data import encrypt_frame
+from victron_ble2mqtt.capture import CaptureRecord, CaptureWriter, get_capture_files, iter_capture
+from victron_ble2mqtt.publisher import MqttPublisher
+from victron_ble2mqtt.replay import CLOCK_MODULES, CountingMqttClient, ReplaySource, get_clock_module
+from victron_ble2mqtt.user_settings import ChangeDetectionSettings, UserSettings
+
+
+KEY = '0123456789abcdef0123456789abcdef'
+
+
+def iter_records():
+    timestamp = 0
+    for iv in range(10):
+        raw_data = encrypt_frame(BatteryMonitor, key=KEY, iv=iv)
+        for _ in range(3):  # Devices repeat the same frame
+            yield CaptureRecord(
+                timestamp=timestamp,
+                address='AA:BB:CC:DD:EE:FF',
+                rssi=-70,
+                flags=1,
+                company_id=0x02E1,
+                name='SmartShunt',
+                data=raw_data,
+            )
+            yield CaptureRecord(
+                timestamp=timestamp,
+                address='11:22:33:44:55:66',
+                rssi=-90,
+                flags=1,
+                company_id=0x02E1,
+                name='Foreign',
+                data=encrypt_frame(BatteryMonitor, key='fe' * 16, iv=iv),
+            )
+            timestamp += 0.5
+
+
+def iter_fast_records(count: int):
+    for iv in range(count):
+        yield CaptureRecord(
+            timestamp=iv * 0.25,  # Faster than the state throttle of the sensors
+            address='AA:BB:CC:DD:EE:FF',
+            rssi=-70,
+            flags=1,
+            company_id=0x02E1,
+            name='SmartShunt',
+            data=encrypt_frame(BatteryMonitor, key=KEY, iv=iv),
+        )
+
+
+class ReplayTestCase(ComponentTestMixin, TestCase):
+    def get_publisher(self, *, throttle_seconds: int = 0, queue_size: int = 0) -> MqttPublisher:
+        user_settings = UserSettings(
+            mqtt=MqttSettings(main_uid='foo_bar'),
+            publish_throttle_seconds=throttle_seconds,
+            change_detection=ChangeDetectionSettings(enabled=False),
+            device_keys=[KEY],
+        )
+        return MqttPublisher(
+            keys=user_settings.device_keys,
+            user_settings=user_settings,
+            mqtt_client=CountingMqttClient(),
+            queue_size=queue_size,
+        )
+
+    def test_replay_capture(self):
+        publisher = self.get_publisher()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            directory = Path(temp_dir)
+            with CaptureWriter(directory=directory) as writer:
+                for record in iter_records():
+                    writer.write_record(record)
+
+            source = ReplaySource(publisher=publisher, speed=0)
+            with self.assertLogs('victron_ble2mqtt', level='WARNING'):  # "Ignore Foreign ..."
+                stats = source.replay(iter_capture(get_capture_files(directory)))
+
+        self.assertEqual(stats.frames, 60)
+        self.assertEqual(stats.capture_duration, 14.5)
+        self.assertEqual(stats.devices['AA:BB:CC:DD:EE:FF'].frames, 30)
+        self.assertEqual(stats.devices['11:22:33:44:55:66'].frames, 30)
+
+        # Only the first frame of every nonce is decrypted and published:
+        self.assertEqual(publisher.frame_cache.hits, 20)
+        self.assertEqual(publisher.scheduler.published, {'AA:BB:CC:DD:EE:FF': 10})
+        self.assertEqual(publisher.device_handler.decrypt_attempts, 1)
+        self.assertEqual(publisher.device_handler.rejected_count, 1)
+        self.assertGreater(publisher.mqtt_client.sent, 10)
+        self.assertIn('foo_bar-aabbccddeeff-soc', BaseMqttDevice.components)
+        self.assertNotIn('foo_bar-112233445566-soc', BaseMqttDevice.components)
+
+    def test_replay_speed(self):
+        sleeps = []
+        source = ReplaySource(publisher=self.get_publisher(), speed=10, sleep=sleeps.append)
+        # A stopped clock: The delays are the offsets to the replay start, independent of the test speed.
+        clock = SimpleNamespace(monotonic=lambda: 0.0, process_time=time.process_time, perf_counter=time.perf_counter)
+        with self.assertLogs('victron_ble2mqtt', level='WARNING'), patch('victron_ble2mqtt.replay.time', clock):
+            stats = source.replay(iter_records())
+        self.assertEqual(stats.frames, 60)
+
+        # 14.5 sec. capture with 10× speed -> The last frame is replayed after 1.45 sec.:
+        self.assertAlmostEqual(max(sleeps), 1.45)
+        self.assertEqual(len(sleeps), 58)  # The first two frames are replayed without delay
+
+    def test_capture_time_throttle(self):
+        # The throttles use the capture time, not the wall clock of the (fast) replay:
+        publisher = self.get_publisher(throttle_seconds=1)
+        source = ReplaySource(publisher=publisher, speed=0)
+        with self.assertLogs('victron_ble2mqtt', level='WARNING'):
+            source.replay(iter_records())
+        self.assertEqual(publisher.scheduler.published, {'AA:BB:CC:DD:EE:FF': 10})  # A new frame every 1.5 sec.
+
+    def test_no_throttle(self):
+        sent = {}
+        for throttle in (True, False):
+            BaseMqttDevice.components.clear()
+            publisher = self.get_publisher()
+            source = ReplaySource(publisher=publisher, speed=0, throttle=throttle)
+            source.replay(iter_fast_records(8))
+            sent[throttle] = publisher.mqtt_client.sent
+
+        # 8 frames in 1.75 sec. capture time: The throttled sensor states are published only every second
+        self.assertEqual(sent, {True: 24, False: 72})
+
+    def test_replay_with_queue(self):
+        publisher = self.get_publisher(queue_size=100)
+        source = ReplaySource(publisher=publisher, speed=0)
+        with self.assertLogs('victron_ble2mqtt', level='WARNING'):
+            stats = source.replay(iter_records())
+        self.assertEqual(stats.frames, 60)
+        self.assertEqual(publisher.scheduler.published, {'AA:BB:CC:DD:EE:FF': 10})
+        self.assertEqual(len(publisher.queue), 0)
+        # 10 new frames of the known device + every frame of the foreign device (can't be decrypted/remembered):
+        self.assertEqual(publisher.queue.get_stats()['queued'], 40)
+
+    def test_clock_modules(self):
+        for name in CLOCK_MODULES:
+            with self.subTest(name):
+                get_clock_module(name)
+
+        # All modules of the publish pipeline with a throttle/expiry must use the capture clock:
+        not_replayed = {'capture', 'election', 'replay', 'store_forward'}
+        package_path = Path(victron_ble2mqtt.__file__).parent
+        for path in sorted(package_path.glob('*.py')):
+            source = path.read_text()
+            with self.subTest(path.name):
+                self.assertNotIn('from time import', source)
+                if path.stem not in not_replayed and 'time.monotonic()' in source:
+                    self.assertIn(f'victron_ble2mqtt.{path.stem}', CLOCK_MODULES)
+
+        with self.assertRaisesRegex(AssertionError, 'victron_ble2mqtt.sensors has no "import time"'):
+            get_clock_module('victron_ble2mqtt.sensors')
@@ -0,0 +1,136 @@
+import json
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+import paho.mqtt.client as mqtt
+
+from victron_ble2mqtt.mqtt_transport import TrackingClient
+from victron_ble2mqtt.store_forward import ACK_TIMEOUT, RECORD_HEADER, DiskRingBuffer, StoreAndForward
+
+
+def get_record_size(topic: str, payload: bytes) -> int:
+    return RECORD_HEADER.size + len(topic) + len(payload)
+
+
+class DiskRingBufferTestCase(TestCase):
+    def test_ring_buffer(self):
+        record_size = get_record_size('test/0', b'1.0')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            directory = Path(temp_dir)
+            buffer = DiskRingBuffer(directory=directory, max_bytes=record_size * 20)  # 2 records per segment
+            for number in range(5):
+                buffer.append(1000.0 + number, f'test/{number}', b'1.0')
+            self.assertEqual(len(buffer.segments), 3)
+            self.assertEqual(buffer.size, record_size * 5)
+
+            self.assertEqual(
+                buffer.pop_batch(3),
+                [(1000.0, 'test/0', b'1.0'), (1001.0, 'test/1', b'1.0'), (1002.0, 'test/2', b'1.0')],
+            )
+            self.assertEqual(len(buffer.segments), 2)  # The first segment is completely drained
+            buffer.close()
+
+            # Restart: Continue at the stored position
+            buffer = DiskRingBuffer(directory=directory, max_bytes=record_size * 20)
+            self.assertEqual(buffer.size, record_size * 2)
+            buffer.append(1005.0, 'test/5', b'1.0')  # Starts a new segment
+            self.assertEqual([topic for _, topic, _ in buffer.pop_batch(10)], ['test/3', 'test/4', 'test/5'])
+            self.assertFalse(buffer)
+            self.assertEqual(list(directory.iterdir()), [])
+
+            # The oldest segments are dropped, if the size cap is reached:
+            with self.assertLogs('victron_ble2mqtt', level='WARNING'):
+                for number in range(25):
+                    buffer.append(2000.0 + number, f'test/{number % 10}', b'1.0')
+            self.assertLessEqual(buffer.size, record_size * 20)
+            self.assertEqual(buffer.get_stats()['evicted_bytes'], record_size * 6)
+            timestamp, _, _ = buffer.pop_batch(1)[0]
+            self.assertEqual(timestamp, 2006.0)
+            buffer.close()
+
+
+class StoreAndForwardTestCase(TestCase):
+    def test_store_and_forward(self):
+        published = []
+        infos = []
+
+        def publish(client, topic, payload=None, qos=0, retain=False, properties=None):
+            published.append((topic, payload, qos))
+            info = mqtt.MQTTMessageInfo(len(published))
+            infos.append(info)
+            return info
+
+        def get_backfill() -> list[tuple[str, dict]]:
+            return [(topic, json.loads(payload)) for topic, payload, _ in published if topic.startswith('backfill/')]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store_forward = StoreAndForward(
+                buffer=DiskRingBuffer(directory=Path(temp_dir), max_bytes=1024 * 1024),
+                backfill_topic='backfill',
+                batch_size=2,
+                batch_interval=1,
+            )
+            client = TrackingClient(mqtt.CallbackAPIVersion.VERSION2)
+            client.store_forward = store_forward
+
+            with patch.object(mqtt.Client, 'publish', publish):
+                # Broker is not reachable:
+                with patch.object(client, 'is_connected', return_value=False), patch('time.time', return_value=100.5):
+                    info = client.publish(topic='homeassistant/sensor/a/state', payload=12.5)
+                    client.publish(topic='homeassistant/sensor/b/state', payload='bulk')
+                    client.publish(topic='homeassistant/sensor/a/config', payload='{}', retain=True)
+                self.assertEqual(info.rc, mqtt.MQTT_ERR_NO_CONN)
+                self.assertEqual(published, [('homeassistant/sensor/a/config', b'{}', 0)])
+                self.assertEqual(client.sent, 1)
+                self.assertEqual(store_forward.get_stats()['stored'], 2)
+
+                # The connection is back:
+                published.clear()
+                infos.clear()
+                with patch.object(client, 'is_connected', return_value=True):
+                    client.publish(topic='homeassistant/sensor/a/state', payload=13.0)
+                    self.assertEqual(store_forward.drain_batch(client), 2)
+                self.assertEqual(published[0], ('homeassistant/sensor/a/state', b'13.0', 0))
+                self.assertEqual(
+                    get_backfill(),
+                    [
+                        ('backfill/homeassistant/sensor/a/state', {'timestamp': 100.5, 'payload': '12.5'}),
+                        ('backfill/homeassistant/sensor/b/state', {'timestamp': 100.5, 'payload': 'bulk'}),
+                    ],
+                )
+                self.assertEqual({qos for topic, _, qos in published if topic.startswith('backfill/')}, {1})
+
+                # Not acknowledged yet: The messages are still in the buffer, also after a restart
+                self.assertFalse(store_forward.confirm_batch())
+                self.assertEqual(store_forward.get_stats()['in_flight'], 2)
+                record_size = get_record_size('homeassistant/sensor/a/state', b'12.5')
+                store_forward.buffer.close()
+                store_forward.buffer = DiskRingBuffer(directory=Path(temp_dir), max_bytes=1024 * 1024)
+                self.assertEqual(store_forward.buffer.size, record_size * 2)
+
+                # The connection was lost, before the broker acknowledged the messages:
+                published.clear()
+                later = time.monotonic() + ACK_TIMEOUT + 1
+                with self.assertLogs('victron_ble2mqtt', level='WARNING'), patch('time.monotonic', return_value=later):
+                    self.assertTrue(store_forward.confirm_batch())
+                self.assertEqual(store_forward.get_stats()['resent_batches'], 1)
+                with patch.object(client, 'is_connected', return_value=True):
+                    self.assertEqual(store_forward.drain_batch(client), 2)  # The same messages again
+                self.assertEqual(
+                    [topic for topic, _ in get_backfill()],
+                    ['backfill/homeassistant/sensor/a/state', 'backfill/homeassistant/sensor/b/state'],
+                )
+
+                # The broker acknowledged the messages:
+                for info in infos[-2:]:
+                    info._set_as_published()
+                with self.assertLogs('victron_ble2mqtt', level='INFO'):
+                    self.assertTrue(store_forward.confirm_batch())
+                self.assertFalse(store_forward.buffer)
+                self.assertEqual(store_forward.get_stats()['drained'], 2)
+                self.assertEqual(store_forward.drain_batch(client), 0)
+
+            store_forward.buffer.close()
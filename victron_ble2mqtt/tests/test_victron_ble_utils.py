@@ -0,0 +1,73 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from bleak import BLEDevice
+from victron_ble.devices import BatteryMonitor
+
+from victron_ble2mqtt.benchmarks.device_data import encrypt_frame, get_device_data, iter_device_classes
+from victron_ble2mqtt.benchmarks.values2dict import reflection_values2dict
+from victron_ble2mqtt.victron_ble_utils import DeviceHandler, values2dict
+
+
+class VictronBleUtilsTestCase(TestCase):
+    def test_values2dict(self):
+        for DeviceClass in iter_device_classes():
+            with self.subTest(DeviceClass.__name__):
+                device_data = get_device_data(DeviceClass)
+                data = values2dict(device_data)
+                self.assertEqual(data, reflection_values2dict(device_data))
+                self.assertIn('model_name', data)
+
+    def test_device_handler_key_index(self):
+        # Many keys, but only one key with the same key check byte:
+        keys = [f'{index:02x}' + '00' * 15 for index in range(120)]
+        key = 'ff0102030405060708090a0b0c0d0e0f'
+        keys.insert(60, key)
+
+        device_handler = DeviceHandler(keys)
+        ble_device = BLEDevice(address='AA:BB:CC:DD:EE:FF', name='SmartShunt', details={})
+        raw_data = encrypt_frame(BatteryMonitor, key=key)
+
+        generic_device = device_handler.get_generic_device(ble_device, raw_data)
+        self.assertIsInstance(generic_device.victron_device, BatteryMonitor)
+        self.assertEqual(generic_device.victron_device.advertisement_key, key)
+        self.assertEqual(device_handler.decrypt_attempts, 1)
+        self.assertEqual(device_handler.address2key, {'AA:BB:CC:DD:EE:FF': key})
+
+        # Unknown key:
+        raw_data = encrypt_frame(BatteryMonitor, key='fe' * 16)
+        ble_device = BLEDevice(address='11:22:33:44:55:66', name='Foreign', details={})
+        self.assertIsNone(device_handler.get_generic_device(ble_device, raw_data))
+        self.assertEqual(device_handler.decrypt_attempts, 1)
+
+    def test_device_handler_negative_cache(self):
+        device_handler = DeviceHandler(keys=[], reject_ttl=60)
+        ble_device = BLEDevice(address='11:22:33:44:55:66', name='Foreign', details={})
+        key = 'fe' * 16
+        raw_data = encrypt_frame(BatteryMonitor, key=key)
+
+        with (
+            patch('victron_ble2mqtt.victron_ble_utils.time.monotonic', return_value=100),
+            self.assertLogs('victron_ble2mqtt', level='WARNING') as logs,
+        ):
+            for _ in range(3):
+                self.assertIsNone(device_handler.get_generic_device(ble_device, raw_data))
+        self.assertEqual(
+            logs.output,
+            [
+                'WARNING:victron_ble2mqtt.victron_ble_utils:'
+                'Ignore Foreign (11:22:33:44:55:66) for 60 sec.: No matching device key'
+            ],
+        )
+        self.assertEqual(device_handler.rejected_count, 1)
+        self.assertEqual(device_handler.rejected_hits, 2)
+
+        # Expired -> try again:
+        with patch('victron_ble2mqtt.victron_ble_utils.time.monotonic', return_value=160):
+            self.assertIsNone(device_handler.get_generic_device(ble_device, raw_data))
+        self.assertEqual(device_handler.rejected_count, 2)
+
+        # Add the key -> negative cache is cleared:
+        device_handler.set_keys([key])
+        self.assertEqual(len(device_handler.rejected), 0)
+        self.assertIsNotNone(device_handler.get_generic_device(ble_device, raw_data))
@@ -24,6 +24,94 @@ class SystemdServiceInfo(BaseSystemdServiceInfo):
     template_context: SystemdServiceTemplateContext = dataclasses.field(default_factory=SystemdServiceTemplateContext)
 
 
+@dataclasses.dataclass
+class ChangeDetectionSettings:
+    """
+    Publish sensor values only if they changed.
+    Numbers are compared with the display precision of the sensor.
+    Changes inside the absolute or relative (e.g.: 0.01 == 1%) deadband are ignored.
+    Unchanged values are published again after `max_silence_seconds`.
+    """
+
+    enabled: bool = True
+    absolute_deadband: float = 0.0
+    relative_deadband: float = 0.0
+    max_silence_seconds: int = 5 * 60
+
+
+@dataclasses.dataclass
+class EnergySettings:
+    """
+    Integrate the derived power sensors (e.g.: "Power" of a SmartShunt) into "total_increasing" energy sensors (Wh).
+    All received frames are counted, also the not published ones.
+    The counters are stored in `state_file` every 5 minutes and on exit, to survive restarts.
+    Gaps longer than `max_gap_seconds` (e.g.: device out of range) are not counted.
+    """
+
+    enabled: bool = False
+    state_file: str = '~/.local/state/victron-ble2mqtt/energy.json'
+    max_gap_seconds: int = 5 * 60
+
+
+@dataclasses.dataclass
+class StoreForwardSettings:
+    """
+    Store the sensor states on disk, while the MQTT broker is not reachable (max. `max_size_mb`, oldest are dropped).
+    After the reconnect they are sent in batches (`batch_size` every `batch_interval_seconds`)
+    as JSON with the original timestamp to: <backfill_topic>/<original topic>
+    """
+
+    enabled: bool = False
+    directory: str = '~/.local/state/victron-ble2mqtt/store-forward'
+    max_size_mb: int = 50
+    backfill_topic: str = 'victron-ble2mqtt/backfill'
+    batch_size: int = 100
+    batch_interval_seconds: float = 1.0
+
+
+@dataclasses.dataclass
+class DeviceCacheSettings:
+    """
+    Remember all published devices in `cache_file` (device class, handler and the index of the matching key).
+    After a restart the known devices are set up before their first advertisement arrives,
+    so the first frame is decrypted without trying all keys and published without delay.
+    """
+
+    enabled: bool = False
+    cache_file: str = '~/.local/state/victron-ble2mqtt/devices.json'
+
+
+@dataclasses.dataclass
+class GatewayElectionSettings:
+    """
+    Run several gateways with the same MQTT broker and "main_uid": Every device is published only by the gateway
+    with the best (smoothed) RSSI. The gateways announce their RSSI per device every `announce_interval_seconds`
+    as retained messages below `topic`. Another gateway takes over, if its RSSI is `hysteresis_db` better
+    or if the owner stops hearing the device.
+    Note: All gateways need the same device keys and synchronized clocks.
+    """
+
+    enabled: bool = False
+    gateway_id: str = ''  # Unique name of this gateway (empty = host name)
+    topic: str = 'victron-ble2mqtt/gateways'
+    announce_interval_seconds: int = 10
+    hysteresis_db: float = 5.0
+
+
+@dataclasses.dataclass
+class ProfilingSettings:
+    """
+    Profile the publish loop with cProfile (Can also be enabled via "publish-loop --profile").
+    Every `interval_seconds` a profile is written into `directory`, only the newest `keep_files` are stored.
+    Summarize them with the "profile-summary" command.
+    """
+
+    enabled: bool = False
+    directory: str = '~/.cache/victron-ble2mqtt/profiles'
+    interval_seconds: int = 5 * 60
+    keep_files: int = 24
+
+
 @dataclasses.dataclass
 class UserSettings:
     """
@@ -35,12 +123,38 @@ class UserSettings:
     """
 
     device_name: str = 'Victron'
-    publish_throttle_seconds: int = 1  # Minimum time between publishing messages to MQTT, in seconds.
+    publish_throttle_seconds: int = 1  # Minimum time between publishing messages to MQTT, in seconds, per device.
+    publish_max_per_minute: int = 0  # Max. publishes per minute for all devices together (0 = unlimited)
+    aggregation_window_seconds: int = 0  # Publish last/mean/min/max of all frames per window (0 = every frame)
+    publish_queue_size: int = 100  # Max. devices waiting for publishing (0 = publish inside the BLE callback)
+    json_state: bool = False  # Publish one JSON message per device update, instead of one message per sensor.
+    device_discovery: bool = False  # Announce all sensors of a device in one Home Assistant discovery message.
+    mqtt_transport: str = 'thread'  # "thread": paho network thread, "asyncio": MQTT I/O in the BLE event loop
+    mqtt_max_pending: int = 1000  # Stop processing new frames, while this number of MQTT messages is not sent
+    ha_status_topic: str = 'homeassistant/status'  # Republish discovery on HA birth ("" = republish periodically)
+    metrics_port: int = 0  # Serve Prometheus metrics on http://<metrics_host>:<metrics_port>/metrics (0 = disabled)
+    metrics_host: str = '127.0.0.1'
+    bluetooth_adapters: list[str] = dataclasses.field(default_factory=list)  # e.g.: ["hci0", "hci1"] (empty = default)
 
     # Add device keys here:
     device_keys: list[str] = dataclasses.field(default_factory=list)
+    unknown_device_ttl_seconds: int = 300  # Ignore devices without matching key or unknown type for this time.
+    device_expire_seconds: int = 60 * 60  # Forget devices that are not seen for this time (0 = never).
+    max_tracked_addresses: int = 1000  # Max. number of BLE addresses to remember (RSSI, ignored devices).
 
     # Information about the MQTT server:
     mqtt: dataclasses = dataclasses.field(default_factory=MqttSettings)
 
+    change_detection: dataclasses = dataclasses.field(default_factory=ChangeDetectionSettings)
+
+    energy: dataclasses = dataclasses.field(default_factory=EnergySettings)
+
+    device_cache: dataclasses = dataclasses.field(default_factory=DeviceCacheSettings)
+
+    store_forward: dataclasses = dataclasses.field(default_factory=StoreForwardSettings)
+
+    gateway_election: dataclasses = dataclasses.field(default_factory=GatewayElectionSettings)
+
+    profiling: dataclasses = dataclasses.field(default_factory=ProfilingSettings)
+
     systemd: dataclasses = dataclasses.field(default_factory=SystemdServiceInfo)
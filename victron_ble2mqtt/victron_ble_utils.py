@@ -1,65 +1,269 @@
 import inspect
 import logging
+import time
+import typing
+from collections.abc import Callable
 from enum import Enum
+from functools import cache
 
 from bleak import BLEDevice
 from victron_ble.devices import Device, DeviceData, detect_device_type
 from victron_ble.exceptions import AdvertisementKeyMismatchError
 
+from victron_ble2mqtt.registry import ExpiringRegistry
+
 
 logger = logging.getLogger(__name__)
 
 
-def values2dict(obj: DeviceData) -> dict:
-    data = {}
-    for name, method in inspect.getmembers(obj, predicate=inspect.ismethod):
-        if name.startswith("get_"):
-            value = method()
+def get_enum_classes(function) -> tuple[type[Enum], ...]:
+    """
+    Returns all Enum classes from the return type annotation of the given function.
+
+    >>> from victron_ble.devices import BatteryMonitorData
+    >>> get_enum_classes(BatteryMonitorData.get_aux_mode)
+    (<enum 'AuxMode'>,)
+    >>> get_enum_classes(BatteryMonitorData.get_voltage)
+    ()
+    """
+    try:
+        return_type = typing.get_type_hints(function).get('return')
+    except (NameError, TypeError) as err:  # e.g.: unresolvable forward references
+        logger.debug('Can not get type hints from %r: %s', function, err)
+        return ()
+
+    candidates = typing.get_args(return_type) or (return_type,)
+    return tuple(candidate for candidate in candidates if inspect.isclass(candidate) and issubclass(candidate, Enum))
+
+
+class DataExtractor:
+    """
+    Convert DeviceData instances of one class into a dict.
+
+    All "get_*" methods and lookup tables for Enum values are collected once,
+    so no reflection is needed for every received advertisement. Use get_extractor() to get a cached instance.
+    """
+
+    def __init__(self, data_class: type[DeviceData]):
+        self.data_class = data_class
+
+        self.getters = []  # (key, function) tuples, sorted by name, like inspect.getmembers() does
+        self.enum_names = {}  # Enum member -> lower case name
+        for name, function in inspect.getmembers(data_class, predicate=inspect.isfunction):
+            if name.startswith('get_'):
+                self.getters.append((name[4:], function))
+                for enum_class in get_enum_classes(function):
+                    for member in enum_class:
+                        self.enum_names[member] = member.name.lower()
+        self.getters = tuple(self.getters)
+
+    def __call__(self, obj: DeviceData) -> dict:
+        data = {}
+        enum_names = self.enum_names
+        for key, getter in self.getters:
+            value = getter(obj)
+            if value is None:
+                continue
             if isinstance(value, Enum):
-                value = value.name.lower()
-            if value is not None:
-                data[name[4:]] = value
-    return data
+                try:
+                    value = enum_names[value]
+                except KeyError:
+                    # Not annotated Enum return type
+                    value = enum_names[value] = value.name.lower()
+            data[key] = value
+        return data
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.data_class.__name__} ({len(self.getters)} getters)>'
+
+
+@cache
+def get_extractor(data_class: type[DeviceData]) -> DataExtractor:
+    """
+    >>> from victron_ble.devices import SolarChargerData
+    >>> get_extractor(SolarChargerData)
+    <DataExtractor SolarChargerData (8 getters)>
+    >>> get_extractor(SolarChargerData) is get_extractor(SolarChargerData)
+    True
+    """
+    return DataExtractor(data_class)
+
+
+def values2dict(obj: DeviceData) -> dict:
+    extractor = get_extractor(type(obj))
+    return extractor(obj)
 
 
 class GenericDevice:
     def __init__(self, victron_device: Device, ble_device: BLEDevice):
         self.victron_device = victron_device
         self.ble_device = ble_device
+        self.extractor = get_extractor(victron_device.data_type)
 
     def parse(self, *, raw_data) -> dict:
         device_data: DeviceData = self.victron_device.parse(raw_data)
-        data_dict = values2dict(device_data)
+        data_dict = self.extractor(device_data)
         return data_dict
 
 
+def get_key_check_byte(raw_data: bytes) -> int | None:
+    """
+    Returns the key check byte of a "instant readout" advertisement.
+    It's the first byte of the advertisement key, that was used to encrypt the data.
+
+    >>> get_key_check_byte(bytes.fromhex('100089a3020100010694267ba398480c'))
+    1
+    >>> get_key_check_byte(b'short') is None
+    True
+    """
+    if len(raw_data) > 7:
+        return raw_data[7]
+    return None
+
+
+def build_key_index(keys: list[str]) -> dict[int, list[str]]:
+    """
+    Index the advertisement keys by their first byte (the key check byte)
+
+    >>> build_key_index(['0123', 'ff00', '01ab'])
+    {1: ['0123', '01ab'], 255: ['ff00']}
+    """
+    key_index = {}
+    for key in keys:
+        try:
+            key_check_byte = bytes.fromhex(key)[0]
+        except (ValueError, IndexError):
+            logger.error('Invalid device key: %r', key)
+            continue
+        key_index.setdefault(key_check_byte, []).append(key)
+    return key_index
+
+
 class DeviceHandler:
-    def __init__(self, keys: list[str]):
+    def __init__(
+        self,
+        keys: list[str],
+        *,
+        reject_ttl: int = 300,
+        device_ttl: int = 0,
+        max_addresses: int = 0,
+        on_device_evict: Callable | None = None,
+    ):
+        self.keys = keys
+        self.key_index = build_key_index(keys)
+        self.devices = ExpiringRegistry(name='devices', ttl=device_ttl, on_evict=on_device_evict)
+        self.address2key = {}  # Remember the matching key for every MAC address
+
+        self.decrypt_attempts = 0  # Counts the trial decryptions to find the key of new devices
+        self.key_mismatches = 0  # Trial decryptions with a wrong key
+        self.parse_errors = 0  # Trial decryptions with a matching key, but invalid data
+
+        # Negative cache of unknown/unsupported devices:
+        self.reject_ttl = reject_ttl
+        self.rejected = ExpiringRegistry(  # MAC address -> time.monotonic() value until the address will be ignored
+            name='rejected',
+            max_size=max_addresses,
+            ttl=reject_ttl,
+        )
+        self.rejected_count = 0  # How many addresses are rejected
+        self.rejected_hits = 0  # How many advertisements are skipped because of the negative cache
+
+    def set_keys(self, keys: list[str]) -> None:
+        """
+        Use new device keys, e.g.: after the user added a key in the settings.
+        The negative cache will be cleared, so that all devices are tried again.
+        """
         self.keys = keys
-        self.devices = {}
+        self.key_index = build_key_index(keys)
+        self.clear_rejected()
+
+    def restore(self, address: str, key: str) -> None:
+        """
+        Try the given key first, if the device is seen the first time, e.g.: a device from the device cache.
+        """
+        self.address2key[address] = key
+
+    def clear_rejected(self) -> None:
+        logger.info('Clear %i rejected addresses', len(self.rejected))
+        self.rejected.clear()
+
+    def reject(self, device: BLEDevice, reason: str) -> None:
+        logger.warning('Ignore %s (%s) for %i sec.: %s', device.name, device.address, self.reject_ttl, reason)
+        self.rejected[device.address] = time.monotonic() + self.reject_ttl
+        self.rejected_count += 1
+
+    def is_rejected(self, address: str) -> bool:
+        expires = self.rejected.peek(address)
+        if expires is None:
+            return False
+
+        if time.monotonic() < expires:
+            self.rejected_hits += 1
+            return True
+
+        self.rejected.pop(address)
+        return False
+
+    def expire(self) -> None:
+        self.devices.expire()
+        self.rejected.expire()
+
+    def get_stats(self) -> dict:
+        return {
+            'devices': self.devices.get_stats(),
+            'rejected': self.rejected.get_stats(),
+            'decrypt_attempts': self.decrypt_attempts,
+            'key_mismatches': self.key_mismatches,
+            'parse_errors': self.parse_errors,
+            'rejected_count': self.rejected_count,
+            'rejected_hits': self.rejected_hits,
+        }
+
+    def get_key_candidates(self, address: str, raw_data: bytes) -> list[str]:
+        """
+        Returns all keys that may match to the given advertisement.
+        The last known key of the device is the first candidate.
+        """
+        candidates = self.key_index.get(get_key_check_byte(raw_data), [])
+        if (known_key := self.address2key.get(address)) in candidates:
+            candidates = [known_key, *(key for key in candidates if key != known_key)]
+        return candidates
 
     def get_generic_device(self, device: BLEDevice, raw_data: bytes) -> GenericDevice | None:
-        data = {"name": device.name, "address": device.address, "details": device.details}
-        logger.debug('Received data: %s', data)
         try:
             return self.devices[device.address]
         except KeyError:
+            if self.is_rejected(device.address):
+                return None
+
+            data = {"name": device.name, "address": device.address, "details": device.details}
+            logger.debug('Received data: %s', data)
+
             if DeviceClass := detect_device_type(raw_data):
                 logger.info('Device type: %s for %s', DeviceClass.__name__, data)
-                for key in self.keys:
+                parse_error = False
+                for key in self.get_key_candidates(device.address, raw_data):
                     victron_device = DeviceClass(key)
+                    self.decrypt_attempts += 1
                     try:
                         victron_device.parse(raw_data)
                     except AdvertisementKeyMismatchError:
+                        self.key_mismatches += 1
                         continue
                     except ValueError as err:
                         logger.warning('Error parsing data: %s', err)
+                        self.parse_errors += 1
+                        parse_error = True
                     else:
                         logger.info('New device: %s', device.name)
+                        self.address2key[device.address] = key
                         self.devices[device.address] = generic_device = GenericDevice(
                             victron_device,
                             ble_device=device,
                         )
                         return generic_device
+
+                if not parse_error:  # Don't ignore a device with matching key
+                    self.reject(device, reason='No matching device key')
             else:
-                logger.error('No keys for %s', data)
+                self.reject(device, reason='Unknown device type')